@@ -1,32 +1,238 @@
 import abc
+import bulkwriter
+import cohort
+import narrowstore
+import featurespec
 import pandas as pd
+import phasehooks
 import preprocessing as pp
 import random
 import re
-import tempfile
-
-
-def copy_to_sql(df, table_name, engine):
-    with tempfile.NamedTemporaryFile(mode='wt') as tmpfile:
-        df.to_csv(tmpfile, index=False)
-        tmpfile.flush()
-        engine.execute(pd.io.sql.get_schema(df, 'something_9999999').replace('"something_9999999"', table_name))
-        with engine.raw_connection().cursor() as curs, open(tmpfile.name, 'rt') as f:
-            curs.copy_expert("""COPY {table_name}
-                                FROM stdin
-                                WITH CSV HEADER DELIMITER ',' QUOTE '"';
-                            """.format(table_name=table_name), f)
+import sourcecache
+import studentpanel
+import uuid
+from collections import OrderedDict
 
 
 def random_string(N):
     return ''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(N))
 
 
+def unique_table_name():
+    """
+    name of a scratch table no other process picks. random_string() draws from the random module,
+    whose state is the same in every worker forked from one process
+    """
+    return 'temp_' + uuid.uuid4().hex
+
+
+def booleans_to_int(df):
+    """
+    returns a copy of df where boolean columns are converted to 0/1 so postgres can read them
+    """
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == bool:
+            df[column] = df[column].apply(lambda x: 1 if x else 0)
+    return df
+
+
+def update_batch_in_db(features, frames, table_name, conn):
+    """
+    writes the columns of several features to training.<table_name> at once. The frames are
+    joined on person_id in memory, copied to a single temp table and swapped into the features
+    table with one CREATE TABLE AS, instead of an ALTER/UPDATE rewrite per feature.
+
+    param features: feature objects, in the same order as frames
+    param frames: the preprocessed feature_code() outputs (person_id plus the feature column)
+    """
+    columns = [feature.feature_col for feature in features]
+    with phasehooks.phase(features, 'update_batch_in_db') as phase:
+        batch = pd.concat([frame.dropna(subset=['person_id']).set_index('person_id')[feature.feature_col]
+                           for feature, frame in zip(features, frames)], axis=1)
+        batch.index.name = 'person_id'
+        batch = booleans_to_int(batch.reset_index())
+        phase.frames = batch
+
+        temp_table_name = unique_table_name()
+        new_table_name = unique_table_name()
+        bulkwriter.write_frame(batch, temp_table_name, conn)
+        conn.execute("""
+                CREATE TABLE {schema}.{new_table_name} AS (
+                    SELECT tab.*, {new_columns}
+                      FROM {schema}.{table_name} tab
+                      LEFT JOIN {temp_table_name} temp_table
+                        ON tab.person_id = temp_table.person_id);
+                DROP TABLE {schema}.{table_name};
+                ALTER TABLE {schema}.{new_table_name} RENAME TO {table_name};
+                DROP TABLE {temp_table_name};
+                """.format(schema='training',
+                           table_name=table_name,
+                           new_table_name=new_table_name,
+                           temp_table_name=temp_table_name,
+                           new_columns=', '.join('CAST(temp_table.{col} AS {sql_type}) AS {col}'.format(
+                               col=feature.feature_col, sql_type=feature.feature_sql_type) for feature in features)))
+    with phasehooks.phase(features, 'update_dictionary_in_db'):
+        for feature in features:
+            feature.update_dictionary_in_db()
+    print("Updated data in db for {}".format(', '.join(columns)))
+
+
+def compute_fused(features):
+    """
+    computes features of the same fusion family with a single fused_feature_code() call, then
+    runs each one's preprocessing checks. returns (feature, frame) pairs
+    """
+    with phasehooks.phase(features, 'fused_feature_code') as phase:
+        frames = type(features[0]).fused_feature_code(features)
+        phase.frames = frames
+    computed = []
+    for feature in features:
+        print("Ran the fused feature code {}".format(feature.feature_col))
+        computed.append((feature, feature.preprocess(frames[feature.feature_col])))
+        print("Ran preprocessing code {}".format(feature.feature_col))
+    return computed
+
+
+def timeframe_of_table(table_name):
+    """
+    parses the timeframe out of a features table name: ('year', 2012) for features2012,
+    ('age', 15) for an age table
+    """
+    timeframe = int(re.sub(r"\D", "", table_name))
+    if timeframe > 1000:
+        rf_type = 'year'
+    else:
+        rf_type = 'age'
+    return rf_type, timeframe
+
+
+def panel_feature_frames(features, events, partials, finals, params, key='student_key'):
+    """
+    computes features of one family for several year tables in one pass. The filtered events are
+    rolled up once per (student, year), spread on a dense (student, year) grid and accumulated
+    with window aggregates, so every as-of year is read off the same scan instead of repeating it
+    with a different <= year predicate. The grid starts at the first as-of year less the longest
+    n_years, and the events of the years before it are rolled up into its first year, for the
+    accumulations over every year: the per-year and window aggregates have to compose (count and
+    sum, sum and sum, max and max...).
+
+    param features: feature objects, built for year tables
+    param events: FROM item (subquery with alias) of the source rows, with key and an integer year column
+    param partials: (name, per-year aggregate, window aggregate, n_years) tuples. n_years None accumulates
+                    every year up to the as-of year, otherwise the last n_years only
+    param finals: (feature, expression over the partial names) pairs, one per feature
+    param params: query parameters used by events, partials and finals
+    param key: column of training.mapping the events are keyed by, student_key or person_id. The
+               grid has a row per person_id (and student_key, like the per-table queries joining
+               training.mapping on it)
+    return: dict of (table_name, feature_col) -> dataframe of person_id and the feature column
+    """
+    years = sorted(set(timeframe_of_table(feature.table_name)[1] for feature in features))
+    lengths = sorted(set(n for _, _, _, n in partials if n is not None))
+    params = dict(params, grid_start=years[0] - (lengths[-1] if lengths else 0), last_year=years[-1],
+                  years=tuple(years))
+    grid_keys = 'person_id' if key == 'person_id' else 'person_id, student_key'
+    partition = ', '.join('grid.{}'.format(column) for column in grid_keys.split(', '))
+    windows = ['forever AS (PARTITION BY {} ORDER BY grid.year ROWS UNBOUNDED PRECEDING)'.format(partition)]
+    for n in lengths:
+        windows.append('last_{n} AS (PARTITION BY {partition} ORDER BY grid.year '
+                       'ROWS BETWEEN {preceding} PRECEDING AND CURRENT ROW)'.format(n=n, partition=partition,
+                                                                                   preceding=n - 1))
+
+    data = pd.read_sql_query("""
+            WITH yearly AS (
+            SELECT {key}, GREATEST(year, %(grid_start)s) AS year, {yearly}
+            FROM {events}
+            WHERE year <= %(last_year)s
+            GROUP BY {key}, GREATEST(year, %(grid_start)s)
+            ),
+            grid AS (
+            SELECT {grid_keys}, g.year
+            FROM (SELECT DISTINCT {grid_keys} FROM training.mapping) AS mapping
+            CROSS JOIN generate_series(%(grid_start)s, %(last_year)s) AS g(year)
+            ),
+            running AS (
+            SELECT grid.person_id, grid.year, {running}
+            FROM grid
+            LEFT JOIN yearly ON yearly.{key} = grid.{key} AND yearly.year = grid.year
+            WINDOW {windows}
+            )
+            SELECT person_id, year AS as_of_year, {finals}
+            FROM running
+            WHERE year IN %(years)s
+            """.format(key=key, grid_keys=grid_keys,
+                       yearly=',\n                   '.join('{} AS {}'.format(aggregate, name)
+                                                          for name, aggregate, _, _ in partials),
+                       events=events,
+                       running=',\n                   '.join(
+                           '{window_aggregate}(yearly.{name}) OVER {window} AS {name}'.format(
+                               window_aggregate=window_aggregate, name=name,
+                               window='forever' if n_years is None else 'last_{}'.format(n_years))
+                           for name, _, window_aggregate, n_years in partials),
+                       windows=',\n                   '.join(windows),
+                       finals=',\n                   '.join('{} AS {}'.format(expression, feature.feature_col)
+                                                          for feature, expression in finals)),
+            features[0].conn, params=params)
+
+    frames = {}
+    for feature in features:
+        year = timeframe_of_table(feature.table_name)[1]
+        frame = data.loc[data['as_of_year'] == year, ['person_id', feature.feature_col]]
+        frames[(feature.table_name, feature.feature_col)] = frame.reset_index(drop=True)
+    return frames
+
+
+def distinct_features(features):
+    """
+    one feature object per feature_col, for building the columns of a panel query once even
+    though every year table has its own feature object
+    """
+    return list(OrderedDict((feature.feature_col, feature) for feature in features).values())
+
+
+def compute_panel(features):
+    """
+    computes features of the same fusion family, built for several year tables, with a single
+    panel_feature_code() call, then runs each one's preprocessing checks. returns (feature, frame) pairs
+    """
+    with phasehooks.phase(features, 'panel_feature_code') as phase:
+        frames = type(features[0]).panel_feature_code(features)
+        phase.frames = frames
+    computed = []
+    for feature in features:
+        print("Ran the panel feature code {} for {}".format(feature.feature_col, feature.table_name))
+        computed.append((feature, feature.preprocess(frames[(feature.table_name, feature.feature_col)])))
+    return computed
+
+
 class AbstractFeature(object):
     '''
     Abstract representation of an feature.
     '''
 
+    # run-scoped sourcecache.SourceCache, set by the DataLoader building this feature
+    source_cache = None
+
+    # phasehooks.PhaseHook objects called around every phase of computing and writing the
+    # feature, set by the DataLoader building it
+    phase_hooks = ()
+
+    # write the feature to its own narrowstore table instead of a column of the features table,
+    # set by the DataLoader building it
+    narrow_storage = False
+
+    # features of the same family (and source table) are computed together by one call of the
+    # family's classmethod fused_feature_code(features), which returns a dict of feature_col ->
+    # dataframe of person_id and the feature column, instead of one query each. Families that
+    # also define panel_feature_code(features), returning a dict of (table_name, feature_col) ->
+    # dataframe, build every year table of a run in one pass
+    fusion_family = None
+
+    # schema qualified names of the tables the feature reads, which its fingerprint follows. None
+    # has fingerprint.source_tables() look for them in the code (or the spec) of the class
+    sources = None
+
     def __init__(self, table_name,conn):
         self.table_name = table_name
         self.conn = conn
@@ -58,6 +264,15 @@ class AbstractFeature(object):
     def feature_code(self):
         pass
 
+    def read_source(self, table):
+        """
+        returns one of the sourcecache.SOURCE_TABLES, from the run's cache when there is one.
+        The frame is shared with the other features: add or replace columns, don't edit values in place.
+        """
+        if self.source_cache is None:
+            return sourcecache.read_table(table, self.conn)
+        return self.source_cache.get(table)
+
     def preprocessing(self, feature_df):
         if feature_df[self.feature_col].isnull().any():
             raise ValueError("Feature type cannot contains NULL.")
@@ -89,14 +304,14 @@ class AbstractFeature(object):
         param conn: connection
         """
         # Convert booleans to something postgres will read
-        temp_table = temp_table.copy()
-        for column in temp_table.columns:
-            if temp_table[column].dtype == bool:
-                temp_table[column] = temp_table[column].apply(lambda x: 1 if x else 0)
-
-        temp_table_name = 'temp_' + random_string(32)
-        if self.feature_col == 'is_student_relevant':
-            self.is_student_relevant_update(temp_table,temp_table_name)
+        temp_table = booleans_to_int(temp_table)
+
+        temp_table_name = unique_table_name()
+        if self.feature_col == cohort.FEATURE:
+            # relevance is the cohort table of the features table, not one of its columns
+            cohort.write(temp_table, self.table_name, self.conn)
+        elif self.narrow_storage:
+            narrowstore.write(temp_table, self.table_name, self.feature_col, self.feature_sql_type, self.conn)
         else:
             self.conn.execute("""
                  ALTER TABLE {schema}.{table_name} ADD COLUMN {feature_col} {feature_type};
@@ -104,7 +319,7 @@ class AbstractFeature(object):
                        table_name=self.table_name,
                        feature_col=self.feature_col,
                        feature_type=self.feature_sql_type))
-            copy_to_sql(temp_table, temp_table_name, self.conn)
+            bulkwriter.write_frame(temp_table, temp_table_name, self.conn)
             self.conn.execute("""
                     UPDATE {schema_name}.{table_name} tab
                     SET {feature_col} = temp_table.{feature_col}
@@ -117,23 +332,40 @@ class AbstractFeature(object):
             self.conn.execute("DROP TABLE {temp_table_name};".format(temp_table_name=temp_table_name))
 
     def extract_timeframe_from_table_name(self):
-        timeframe = int(re.sub("\D", "", self.table_name))
-        if timeframe > 1000:
-            rf_type = 'year'
-        else:
-            rf_type = 'age'
-        return rf_type, timeframe
+        return timeframe_of_table(self.table_name)
 
-    def run(self):
-        feature_data, feature_name = self.feature_code()
+    def compute(self):
+        """
+        runs the feature code and the preprocessing checks, without writing anything to the db
+        """
+        with phasehooks.phase([self], 'feature_code') as phase:
+            feature_data, feature_name = self.feature_code()
+            phase.frames = feature_data
         print("Ran the feature code {}".format(self.feature_col))
-        feature_data = self.preprocessing(feature_data)
+        feature_data = self.preprocess(feature_data)
         print("Ran preprocessing code {}".format(self.feature_col))
-        self.update_data_in_db(feature_data)
+        return feature_data
+
+    def preprocess(self, feature_df):
+        """preprocessing(), as a phase"""
+        with phasehooks.phase([self], 'preprocessing') as phase:
+            feature_df = self.preprocessing(feature_df)
+            phase.frames = feature_df
+        return feature_df
+
+    def write(self, feature_data):
+        """writes the computed feature to the features table and the dictionary"""
+        with phasehooks.phase([self], 'update_data_in_db') as phase:
+            phase.frames = feature_data
+            self.update_data_in_db(feature_data)
         print("Updated data in db for {}".format(self.feature_col))
-        self.update_dictionary_in_db()
+        with phasehooks.phase([self], 'update_dictionary_in_db'):
+            self.update_dictionary_in_db()
         print("Done with {}".format(self.feature_col))
 
+    def run(self):
+        self.write(self.compute())
+
     def update_dictionary_in_db(self):
         sql_query = 'INSERT INTO training.feature_dictionary VALUES (%s,%s,%s,%s); '
         self.conn.execute(sql_query, (self.feature_id, self.feature_col, self.feature_type, self.feature_description))
@@ -148,63 +380,13 @@ class AbstractFeature(object):
             return 'text'
         raise ValueError ("Feature type must be either boolean, numerical or categorical")
 
-    def is_student_relevant_update(self, temp_table, temp_table_name):
-        self.conn.execute('DROP TABLE IF EXISTS training.is_student_relevant')
-        copy_to_sql(temp_table, 'training.is_student_relevant', self.conn)
-        #temp_table.to_sql(name='is_student_relevant', con=self.conn, schema='training', if_exists='replace',
-         #                 index=True, index_label=None, chunksize=None, dtype=None)
-
-        sql_query_create = '''CREATE TABLE training.{temp_table_name} as (
-                                SELECT a.*, b.is_student_relevant
-                                  FROM training.is_student_relevant b
-                                  JOIN training.{features_table} a
-                                    ON a.person_id = b.person_id);'''.format(temp_table_name=temp_table_name,
-                                                                           features_table=self.table_name)
-        sql_query_drop_former = 'DROP TABLE training.{table};'.format(table=self.table_name)
-        sql_query_alter_table_name = 'ALTER TABLE training.{temp_table_name} RENAME TO {features_table};'.format(temp_table_name = temp_table_name, features_table = self.table_name)
-        sql_query_drop_if_exists = 'DROP TABLE IF EXISTS training.{temp_table_name}'.format(temp_table_name = temp_table_name)
-        #cur = self.conn.cursor()
-        self.conn.execute(sql_query_drop_if_exists)
-        self.conn.execute(sql_query_create)
-        self.conn.execute(sql_query_drop_former)
-        self.conn.execute(sql_query_alter_table_name)
-
 
 class AbstractAssessmentFeature(AbstractFeature):
 
-    @property
-    def feature_col(self):
-        return self.__class__.__name__
-
-    @property
-    def feature_type(self):
-        return 'categorical'
+    fusion_family = 'assessment'
 
-    def feature_code(self):
-        _, test_year = self.extract_timeframe_from_table_name()
-        return pd.read_sql_query("""
-                    WITH test_scores AS (
-                    SELECT student_key, {aggregate_func}(test_primary_result_code) AS prc
-                    FROM edu_schema.{table}
-                    WHERE test_subject = %(test_subject)s
-                    AND test_type = %(test_type)s
-                    AND test_primary_result_code IN %(test_primary_result_code)s
-                    AND test_year <= %(test_year)s
-                    GROUP BY student_key
-                    )
-                    SELECT person_id,
-                    COALESCE(test_scores.prc, %(default_value)s) AS {feature_col}
-                    FROM training.mapping
-                    LEFT JOIN test_scores
-                    ON test_scores.student_key = mapping.student_key
-                    """.format(feature_col = self.feature_col, aggregate_func = self.aggregate_function, table = self.table), self.conn, params =
-                     {'test_subject': self.test_subject,
-                      'test_year': test_year,
-                     'test_type': self.test_type,
-                     'test_primary_result_code': self.test_primary_result_code,
-                     'default_value': self.default_value}
-                ), self.feature_col
-class AbstractAssessmentAggregates(AbstractFeature):
+    # scores of the last n_years only. None keeps every year up to the timeframe
+    n_years = None
 
     @property
     def feature_col(self):
@@ -215,31 +397,89 @@ class AbstractAssessmentAggregates(AbstractFeature):
         return 'categorical'
 
     def feature_code(self):
-        _, test_year = self.extract_timeframe_from_table_name()
-        return pd.read_sql_query("""
+        return self.fused_feature_code([self])[self.feature_col], self.feature_col
+
+    @classmethod
+    def fused_feature_code(cls, features):
+        """
+        one grouped query over edu_schema.<table> for any number of assessment features: every
+        feature is a conditional aggregate over the scores of its test_subject, test_type, result
+        codes and window
+        """
+        _, test_year = features[0].extract_timeframe_from_table_name()
+        params = {'test_year': test_year,
+                  'test_subjects': tuple(sorted(set(feature.test_subject for feature in features))),
+                  'test_types': tuple(sorted(set(feature.test_type for feature in features)))}
+        aggregates = []
+        columns = []
+        for i, feature in enumerate(features):
+            conditions = ['test_subject = %(test_subject_{})s'.format(i),
+                          'test_type = %(test_type_{})s'.format(i),
+                          'test_primary_result_code IN %(test_primary_result_code_{})s'.format(i)]
+            params['test_subject_{}'.format(i)] = feature.test_subject
+            params['test_type_{}'.format(i)] = feature.test_type
+            params['test_primary_result_code_{}'.format(i)] = feature.test_primary_result_code
+            params['default_value_{}'.format(i)] = feature.default_value
+            if feature.n_years is not None:
+                conditions.append('test_year > %(test_year)s - %(n_years_{})s'.format(i))
+                params['n_years_{}'.format(i)] = feature.n_years
+            aggregates.append('{aggregate_function}(test_primary_result_code) FILTER (WHERE {conditions}) AS {feature_col}'.format(
+                aggregate_function=feature.aggregate_function,
+                conditions=' AND '.join(conditions),
+                feature_col=feature.feature_col))
+            columns.append('COALESCE(test_scores.{feature_col}, %(default_value_{i})s) AS {feature_col}'.format(
+                feature_col=feature.feature_col, i=i))
+
+        data = pd.read_sql_query("""
                     WITH test_scores AS (
-                    SELECT student_key, {aggregate_function}(test_primary_result_code) AS prc
+                    SELECT student_key, {aggregates}
                     FROM edu_schema.{table}
-                    WHERE test_subject = %(test_subject)s
-                    AND test_type = %(test_type)s
-                    AND test_primary_result_code IN %(test_primary_result_code)s
+                    WHERE test_subject IN %(test_subjects)s
+                    AND test_type IN %(test_types)s
                     AND test_year <= %(test_year)s
-                    AND test_year > %(test_year)s - %(n_years)s
                     GROUP BY student_key
                     )
-                    SELECT person_id,
-                    COALESCE(test_scores.prc, %(default_value)s) AS {feature_col}
+                    SELECT person_id, {columns}
                     FROM training.mapping
                     LEFT JOIN test_scores
                     ON test_scores.student_key = mapping.student_key
-                    """.format(feature_col = self.feature_col, aggregate_function = self.aggregate_function, table = self.table), self.conn, params =
-                     {'test_subject': self.test_subject,
-                      'test_year': test_year,
-                      'n_years': self.n_years,
-                     'test_type': self.test_type,
-                     'test_primary_result_code': self.test_primary_result_code,
-                     'default_value': self.default_value}
-                ), self.feature_col
+                    """.format(aggregates=',\n                    '.join(aggregates),
+                               columns=',\n                    '.join(columns),
+                               table=features[0].table), features[0].conn, params=params)
+        return dict((feature.feature_col, data[['person_id', feature.feature_col]]) for feature in features)
+
+    @classmethod
+    def panel_feature_code(cls, features):
+        """
+        the fused assessment query for several year tables: the per-year aggregate of every
+        feature is accumulated over the years up to each as-of year (or its last n_years)
+        """
+        params = {'test_subjects': tuple(sorted(set(feature.test_subject for feature in features))),
+                  'test_types': tuple(sorted(set(feature.test_type for feature in features)))}
+        partials = []
+        finals = []
+        for i, feature in enumerate(distinct_features(features)):
+            params['test_subject_{}'.format(i)] = feature.test_subject
+            params['test_type_{}'.format(i)] = feature.test_type
+            params['test_primary_result_code_{}'.format(i)] = feature.test_primary_result_code
+            params['default_value_{}'.format(i)] = feature.default_value
+            partials.append(('score_{}'.format(i),
+                             '{aggregate_function}(test_primary_result_code) FILTER (WHERE test_subject = %(test_subject_{i})s '
+                             'AND test_type = %(test_type_{i})s AND test_primary_result_code IN %(test_primary_result_code_{i})s)'.format(
+                                 aggregate_function=feature.aggregate_function, i=i),
+                             feature.aggregate_function, feature.n_years))
+            finals.append((feature, 'COALESCE(score_{i}, %(default_value_{i})s)'.format(i=i)))
+        events = """(SELECT student_key, test_year AS year, test_subject, test_type, test_primary_result_code
+                     FROM edu_schema.{table}
+                     WHERE test_subject IN %(test_subjects)s
+                     AND test_type IN %(test_types)s) AS scores""".format(table=features[0].table)
+        return panel_feature_frames(features, events, partials, finals, params)
+
+
+class AbstractAssessmentAggregates(AbstractAssessmentFeature):
+    '''
+    Assessment feature over the last n_years only. Subclasses set n_years.
+    '''
 
 
 class AbstractAssessmentSlope(AbstractFeature):
@@ -299,47 +539,114 @@ class AbstractAssessmentSlope(AbstractFeature):
         return feature_data, self.feature_col
 
 
-class AbstractDisciplineFeature(AbstractFeature):
+class SpecFeature(AbstractFeature):
+    '''
+    Feature defined by a featurespec.FeatureSpec. Subclasses set spec (and the feature id, type
+    and description); the spec features of a run are computed together by the few queries
+    featurespec.compile_specs() batches them into.
+    '''
+
+    fusion_family = 'spec'
+
+    spec = None
 
     @property
     def feature_col(self):
         return self.__class__.__name__
 
+    def feature_code(self):
+        return self.fused_feature_code([self])[self.feature_col], self.feature_col
+
+    @classmethod
+    def fused_feature_code(cls, features):
+        rf_type, timeframe = features[0].extract_timeframe_from_table_name()
+        by_name = dict((feature.spec.name, feature) for feature in features)
+        frames = {}
+        for sql, params, specs in featurespec.compile_specs([feature.spec for feature in features], rf_type, timeframe):
+            data = pd.read_sql_query(sql, features[0].conn, params=params)
+            for spec in specs:
+                frames[by_name[spec.name].feature_col] = data[['person_id', spec.name]]
+        return frames
+
+
+class AbstractDisciplineFeature(SpecFeature):
+
+    fusion_family = 'discipline'
+
+    sources = (studentpanel.PANEL_TABLE,)
+
     @property
     def feature_type(self):
         return 'numerical'
 
-    def feature_code(self):
-        _, year = self.extract_timeframe_from_table_name()
-
-        if self.mode == 'forever':
-            feature = pd.read_sql_query("""
-                    SELECT person_id, COALESCE(foo1, %(default_value)s) AS {feature_col} FROM (
-                    SELECT person_id, a.student_key, {aggregate_function}(discipline_days) AS foo1
-                    FROM edu_schema.{table} a
-                    RIGHT JOIN training.mapping b ON a.student_key = b.student_key
-                    AND a.discipline_year <= %(discipline_year)s
-                    AND discipline_fed_offense_group IN %(offense_group)s
-                    GROUP BY 1,2) AS foo2
-                    """.format(feature_col = self.feature_col, aggregate_function = self.aggregate_function, table = self.table), self.conn, params =
-                    {'discipline_year': year,
-                     'offense_group': self.offense_group,
-                     'default_value': self.default_value})
-
-        elif self.mode == 'last_n_years':
-            feature = pd.read_sql_query("""
-                    SELECT person_id, COALESCE(foo1, %(default_value)s) AS {feature_col} FROM (
-                    SELECT person_id, a.student_key, {aggregate_function}(discipline_days) AS foo1
-                    FROM edu_schema.{table} a
-                    RIGHT JOIN training.mapping b ON a.student_key = b.student_key
-                    AND a.discipline_year <= %(discipline_year)s
-                    AND a.discipline_year > %(discipline_year)s - %(n_years)s
-                    AND discipline_fed_offense_group IN %(offense_group)s
-                    GROUP BY 1,2) AS foo2
-                    """.format(feature_col = self.feature_col, aggregate_function = self.aggregate_function, table = self.table), self.conn, params =
-                    {'discipline_year': year,
-                     'n_years': self.n_years,
-                     'offense_group': self.offense_group,
-                     'default_value': self.default_value})
-
-        return feature, self.feature_col
+    def panel_aggregate(self):
+        """
+        aggregate of discipline_days over the incidents of offense_group, rebuilt from the yearly
+        counts, sums, sums of squares and extremes of the groups in training.student_year_panel
+
+        return: (expression, totals): expression of the feature over the {name} of its totals, and
+                the totals as (name, expression over the columns of a panel row, aggregate over
+                the rows) triples
+        """
+        prefixes = studentpanel.offense_group_columns(self.offense_group)
+        if not prefixes:
+            raise ValueError("{} has no offense group of the student year panel".format(self.feature_col))
+
+        def total(name, suffix):
+            return name, ' + '.join('{}_{}'.format(prefix, suffix) for prefix in prefixes), 'SUM'
+
+        count, days, days_sq = total('n', 'incidents'), total('s', 'days'), total('ss', 'days_sq')
+        aggregate_function = self.aggregate_function.upper()
+        if aggregate_function == 'COUNT':
+            return '{n}', [count]
+        elif aggregate_function == 'SUM':
+            return 'CASE WHEN {n} > 0 THEN CAST({s} AS float) END', [count, days]
+        elif aggregate_function == 'AVG':
+            return 'CAST({s} AS float) / NULLIF({n}, 0)', [count, days]
+        elif aggregate_function == 'STDDEV':
+            return ('sqrt(GREATEST((CAST({ss} AS float) - CAST({s} AS float) * {s} / NULLIF({n}, 0)) '
+                    '/ NULLIF({n} - 1, 0), 0))'), [count, days, days_sq]
+        elif aggregate_function in ('MAX', 'MIN'):
+            extremes = ', '.join('{}_days_{}'.format(prefix, aggregate_function.lower()) for prefix in prefixes)
+            return 'CAST({x} AS float)', [('x', '{}({})'.format('GREATEST' if aggregate_function == 'MAX' else 'LEAST',
+                                                                extremes), aggregate_function)]
+        raise ValueError("No student year panel aggregate for {}".format(self.aggregate_function))
+
+    @property
+    def n_years_of_mode(self):
+        """the n_years the feature aggregates over, None for every year up to the timeframe"""
+        if self.mode == 'last_n_years':
+            return self.n_years
+        elif self.mode == 'forever':
+            return None
+        raise ValueError("Discipline feature mode must be 'forever' or 'last_n_years'.")
+
+    @property
+    def spec(self):
+        """panel_aggregate() over the panel rows of the student up to the timeframe"""
+        expression, totals = self.panel_aggregate()
+        aggregate = expression.format(**dict((name, '{}({}){{filter}}'.format(aggregate, row))
+                                             for name, row, aggregate in totals))
+        return featurespec.FeatureSpec(self.feature_col, studentpanel.PANEL_TABLE, aggregate, 'year',
+                                       n_years=self.n_years_of_mode, default=self.default_value, key='person_id')
+
+    @classmethod
+    def panel_feature_code(cls, features):
+        """
+        the discipline features of several year tables in one pass over training.student_year_panel:
+        the totals of panel_aggregate() accumulated up to each as-of year (or over its last n_years)
+        with window aggregates, then the same expression of them as the spec
+        """
+        params = {}
+        partials = []
+        finals = []
+        for i, feature in enumerate(distinct_features(features)):
+            expression, totals = feature.panel_aggregate()
+            names = {}
+            for name, row, aggregate in totals:
+                names[name] = '{}_{}'.format(name, i)
+                partials.append((names[name], '{}({})'.format(aggregate, row), aggregate, feature.n_years_of_mode))
+            params['default_value_{}'.format(i)] = feature.default_value
+            finals.append((feature, 'COALESCE({}, %(default_value_{})s)'.format(expression.format(**names), i)))
+        events = '{} AS panel'.format(studentpanel.PANEL_TABLE)
+        return panel_feature_frames(features, events, partials, finals, params, key='person_id')
@@ -0,0 +1,277 @@
+import datetime
+import json
+
+import click
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+import bulkwriter
+import indexes
+
+'''
+Synthetic Milwaukee-shaped data for benchmarking the feature generation without the production
+data: the edu_schema and cj_schema tables the features read and training.mapping, with the
+columns and values the feature code expects. Students are school-aged for a span of the years,
+and every event table draws its per-student rate from a skewed distribution (most students have
+no discipline incident or juvenile case, a few have many), so per-student row counts look like
+the real ones. 1x is BASE_STUDENTS students; every table scales linearly with the scale factor.
+
+Writes into the database of the credentials, replacing the tables: use a scratch database.
+'''
+
+BASE_STUDENTS = 10000
+CHUNK_STUDENTS = 50000
+
+RACES = ['African-American', 'Hispanic', 'White', 'Asian', 'Native American', 'Other']
+RACE_SHARES = [0.55, 0.25, 0.12, 0.05, 0.01, 0.02]
+CITIES = ['Milwaukee', 'West Allis', 'Wauwatosa', 'Glendale', 'Shorewood', 'Greenfield']
+CITY_SHARES = [0.88, 0.04, 0.03, 0.02, 0.02, 0.01]
+N_SCHOOLS = 160
+
+OFFENSES = {'Learning Environment': ['Disruptive Behavior', 'Insubordination', 'Truancy'],
+            'Personal/Physical Safety': ['Fighting', 'Assault', 'Threat'],
+            'Weapons': ['Weapon Possession', 'Look-alike Weapon']}
+OFFENSE_SHARES = [0.62, 0.31, 0.07]
+
+# program -> share of the students enrolled in it at some point
+PROGRAMS = {'At Risk': 0.20, 'Bilingual Program': 0.06, 'Citywide Transportation': 0.15,
+            'ESL Program': 0.09, 'Head Start': 0.07, 'Homeless': 0.04, 'Intra District': 0.05,
+            'McKinney Vento': 0.03, 'SPED Referral': 0.12, 'School Age Parent': 0.01, 'TABS': 0.02,
+            'Teacher Instruction with Support': 0.05}
+
+# (test_subject, test_type, highest result code) of the yearly screeners and state tests
+YEARLY_TESTS = [('Reading', 'MAP SCREENER', 6), ('Mathematics', 'MAP SCREENER', 6),
+                ('Reading', 'WKCE', 4), ('Mathematics', 'WKCE', 4)]
+THIRD_GRADE_TESTS = [('Mathematics', 'MAP SCREENER', 6), ('Reading', 'MAP SCREENER', 6),
+                     ('Mathematics', 'WKCE', 4), ('Reading', 'WKCE', 4),
+                     ('ELA', 'Achievement', 4), ('Math', 'Achievement', 4)]
+
+# postgres types of the date columns, which the frames hold as datetime64
+DATE_COLUMNS = ['student_birthdate', 'collection_date', 'adm_cd', 'end_cd', 'discipline_start_date',
+                'begin_date', 'end_date', 'calendar_date', 'incident_date']
+
+
+def _expand(counts):
+    """
+    for groups of the given sizes: the group of every row and its position within the group
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    group = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return group, np.arange(len(group)) - starts[group]
+
+
+def _dates(years, months, days):
+    return pd.to_datetime(pd.DataFrame({'year': years, 'month': months, 'day': days}))
+
+
+def _school_year_dates(rng, years, size=None):
+    """random dates within the school years starting in the given years (September to June)"""
+    offsets = rng.randint(0, 290, size=len(years) if size is None else size)
+    return pd.to_datetime(pd.Series(years).astype(str) + '-09-01') + pd.to_timedelta(offsets, unit='D')
+
+
+def _school_years(years):
+    years = pd.Series(years)
+    return years.astype(str) + '-' + ((years + 1) % 100).map('{:02d}'.format)
+
+
+def generate_students(rng, person_ids, first_year, last_year):
+    """one row per student: keys, birthdate, school-aged span and the per-student rates"""
+    n = len(person_ids)
+    birth_year = rng.randint(first_year - 17, last_year - 4, size=n)
+    entry_year = np.maximum(birth_year + 5 + rng.binomial(3, 0.1, size=n), first_year)
+    # a share of the students leave the district before they turn 18
+    exit_year = np.minimum(birth_year + 18 - rng.binomial(8, 0.08, size=n), last_year)
+    return pd.DataFrame({
+        'person_id': person_ids,
+        'student_key': person_ids * 7 + 1000000,
+        'student_id': person_ids * 3 + 5000000,
+        'birth_year': birth_year,
+        'student_birthdate': _dates(birth_year, rng.randint(1, 13, size=n), rng.randint(1, 29, size=n)),
+        'entry_year': entry_year,
+        'exit_year': exit_year,
+        'years_enrolled': np.maximum(exit_year - entry_year + 1, 0),
+        'student_race': rng.choice(RACES, size=n, p=RACE_SHARES),
+        'student_gender': rng.choice(['M', 'F'], size=n),
+        'student_city': rng.choice(CITIES, size=n, p=CITY_SHARES),
+        'absence_rate': rng.lognormal(-3.0, 0.9, size=n).clip(0, 0.8),
+        'discipline_rate': rng.gamma(0.35, 1.2, size=n),
+        'ability': rng.normal(0, 1, size=n),
+        'juvenile_cases': np.where(rng.rand(n) < 0.08, 1 + rng.geometric(0.45, size=n), 0),
+    })
+
+
+def generate_tables(rng, students, first_year, last_year):
+    """dict of schema qualified table -> frame for a chunk of students"""
+    tables = {}
+    group, position = _expand(students['years_enrolled'])
+    student_years = students.iloc[group].reset_index(drop=True)
+    student_years['year'] = student_years['entry_year'] + position
+    n_years = len(student_years)
+
+    tables['training.mapping'] = students[['person_id', 'student_key']]
+
+    # old demographic: one row per enrolled year, a second one for some years
+    rows = student_years.iloc[np.repeat(np.arange(n_years), 1 + rng.binomial(1, 0.08, size=n_years))]
+    demographic = rows[['student_key', 'year', 'student_birthdate', 'birth_year', 'student_race']].reset_index(drop=True)
+    demographic['school_year'] = _school_years(demographic['year'])
+    for column, share in [('student_504_indicator', 0.05), ('student_indian_ed_indicator', 0.01),
+                          ('student_migrant_ed_indicator', 0.005)]:
+        flagged = pd.Series(rng.rand(len(students)) < share, index=students['student_key'])
+        demographic[column] = np.where(flagged.reindex(demographic['student_key']).values, 'Yes', 'No')
+    tables['edu_schema.demographic'] = demographic
+
+    # new demographic: one or two collections a year, at a school that changes now and then
+    school_weights = 1.0 / np.arange(1, N_SCHOOLS + 1) ** 0.8
+    draws = rng.choice(N_SCHOOLS, size=n_years, p=school_weights / school_weights.sum())
+    changes = (position == 0) | (rng.rand(n_years) < 0.12)
+    school = draws[np.maximum.accumulate(np.where(changes, np.arange(n_years), 0))] + 100
+    collections = 1 + rng.binomial(1, 0.5, size=n_years)
+    group, position_in_year = _expand(collections)
+    rows = student_years.iloc[group].reset_index(drop=True)
+    new_demographic = rows[['student_key', 'student_id', 'year', 'student_birthdate', 'student_gender', 'student_city']].copy()
+    new_demographic['collection_date'] = np.where(position_in_year == 0,
+                                                  pd.to_datetime(rows['year'].astype(str) + '-09-20'),
+                                                  pd.to_datetime((rows['year'] + 1).astype(str) + '-01-20'))
+    new_demographic['countable_school_code'] = school[group]
+    new_demographic['countable_school_name'] = 'School ' + new_demographic['countable_school_code'].astype(str)
+    tables['edu_schema.new_demographic'] = new_demographic
+
+    # attendance: one row per enrolled year
+    membership = (180 - rng.poisson(4, size=n_years)).clip(60, 180)
+    absences = rng.binomial(membership, student_years['absence_rate'].values)
+    tables['edu_schema.attendance'] = pd.DataFrame({'student_key': student_years['student_key'],
+                                                    'year': student_years['year'],
+                                                    'total_membership_days': membership,
+                                                    'att_days': membership - absences})
+
+    # enrollment: a row per enrollment spell, most years have one
+    group, spell = _expand(1 + rng.poisson(0.15, size=n_years))
+    rows = student_years.iloc[group].reset_index(drop=True)
+    late = rng.binomial(1, 0.1, size=len(rows)) * rng.randint(1, 120, size=len(rows)) + spell * 90
+    adm_cd = pd.to_datetime(rows['year'].astype(str) + '-09-02') + pd.to_timedelta(late, unit='D')
+    end_cd = pd.to_datetime((rows['year'] + 1).astype(str) + '-06-12') - pd.to_timedelta(
+        rng.binomial(1, 0.1, size=len(rows)) * rng.randint(1, 100, size=len(rows)), unit='D')
+    end_cd = end_cd.where(end_cd > adm_cd, adm_cd + pd.to_timedelta(30, unit='D'))
+    tables['edu_schema.enrollment'] = pd.DataFrame({'student_key': rows['student_key'], 'year': rows['year'],
+                                                    'school_year': _school_years(rows['year']),
+                                                    'adm_cd': adm_cd, 'end_cd': end_cd,
+                                                    'enrollment_days': (end_cd - adm_cd).dt.days})
+
+    # discipline: a heavy tailed number of incidents per student and year
+    group, _ = _expand(rng.poisson(student_years['discipline_rate'].values))
+    rows = student_years.iloc[group].reset_index(drop=True)
+    offense_group = rng.choice(list(OFFENSES), size=len(rows), p=OFFENSE_SHARES)
+    discipline = pd.DataFrame({'student_key': rows['student_key'],
+                               'discipline_start_date': _school_year_dates(rng, rows['year'].values),
+                               'discipline_days': (rng.poisson(1.2, size=len(rows)) + rng.binomial(1, 0.6, size=len(rows))).astype(float),
+                               'discipline_fed_offense_group': offense_group,
+                               'discipline_offense_type': [OFFENSES[group][i % len(OFFENSES[group])]
+                                                           for group, i in zip(offense_group, rng.randint(0, 6, size=len(rows)))],
+                               'year': rows['year']})
+    tables['edu_schema.discipline'] = discipline
+    tables['edu_schema.discipline_with_year'] = discipline.rename(columns={'year': 'discipline_year'})
+
+    # programs: every program with its own share of the students, from a year they're enrolled
+    frames = []
+    enrolled = students[students['years_enrolled'] > 0]
+    for program_name, share in PROGRAMS.items():
+        members = enrolled[rng.rand(len(enrolled)) < share]
+        begin_year = members['entry_year'].values + (rng.rand(len(members)) * members['years_enrolled'].values).astype(int)
+        begin_date = _school_year_dates(rng, begin_year)
+        frames.append(pd.DataFrame({'student_id': members['student_id'].values, 'program_name': program_name,
+                                    'begin_date': begin_date.values,
+                                    'end_date': (begin_date + pd.to_timedelta(rng.randint(60, 700, size=len(members)), unit='D')).values}))
+    tables['edu_schema.programs'] = pd.concat(frames, ignore_index=True)
+
+    # yearly tests up to 8th grade: screeners two or three times a year, state tests once
+    tested = student_years[student_years['year'] - student_years['birth_year'] <= 14]
+    frames = []
+    for test_subject, test_type, worst in YEARLY_TESTS:
+        sittings = 2 + rng.binomial(1, 0.5, size=len(tested)) if test_type == 'MAP SCREENER' else np.ones(len(tested), dtype=int)
+        group, _ = _expand(sittings)
+        rows = tested.iloc[group].reset_index(drop=True)
+        frames.append(pd.DataFrame({'student_key': rows['student_key'], 'test_subject': test_subject,
+                                    'test_type': test_type, 'test_year': rows['year'],
+                                    'test_primary_result_code': _result_codes(rng, rows['ability'].values, worst),
+                                    'calendar_date': _school_year_dates(rng, rows['year'].values)}))
+    tables['edu_schema.new_assessment_with_date'] = pd.concat(frames, ignore_index=True)
+    tables['edu_schema.new_assessment'] = tables['edu_schema.new_assessment_with_date']
+
+    # third grade tests, one of each for most students
+    frames = []
+    for test_subject, test_type, worst in THIRD_GRADE_TESTS:
+        takers = enrolled[rng.rand(len(enrolled)) < 0.7]
+        frames.append(pd.DataFrame({'student_key': takers['student_key'].values, 'test_subject': test_subject,
+                                    'test_type': test_type,
+                                    'test_primary_result_code': _result_codes(rng, takers['ability'].values, worst)}))
+    tables['edu_schema.assessment'] = pd.concat(frames, ignore_index=True)
+
+    # juvenile cases: few students, several cases each, siblings sharing a family
+    involved = students[students['juvenile_cases'] > 0]
+    group, _ = _expand(involved['juvenile_cases'])
+    rows = involved.iloc[group].reset_index(drop=True)
+    age = rng.randint(10, 18, size=len(rows))
+    incident_date = _dates(np.minimum(rows['birth_year'].values + age, last_year), rng.randint(1, 13, size=len(rows)),
+                           rng.randint(1, 29, size=len(rows)))
+    family = pd.Series(involved['person_id'].values // 3, index=involved['person_id'].values)
+    tables['cj_schema.juv_case_person_id'] = pd.DataFrame({
+        'person_id': rows['person_id'],
+        'da_case_#': ['{}-{}'.format(person_id, i) for person_id, i in zip(rows['person_id'], range(len(rows)))],
+        'incident_date': incident_date,
+        'inc_year': incident_date.dt.year,
+        'chips': np.where(rng.rand(len(rows)) < 0.3, 'CHIPS', None),
+        'family_id': family.reindex(rows['person_id']).values})
+    return tables
+
+
+def _result_codes(rng, ability, worst):
+    """result codes '1' (best) to worst, lower for the abler students"""
+    codes = np.round((worst + 1) / 2.0 - ability * (worst / 4.0) + rng.normal(0, 0.8, size=len(ability)))
+    return codes.clip(1, worst).astype(int).astype(str)
+
+
+def load(engine, scale, seed=0, first_year=2006, last_year=2016, base_students=BASE_STUDENTS):
+    """generates scale x base_students students in chunks and writes their tables"""
+    n_students = int(round(base_students * scale))
+    for schema in ('edu_schema', 'cj_schema', 'training'):
+        engine.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(schema))
+    written = {}
+    for chunk, start in enumerate(range(0, n_students, CHUNK_STUDENTS)):
+        rng = np.random.RandomState(seed + chunk)
+        students = generate_students(rng, np.arange(start + 1, min(start + CHUNK_STUDENTS, n_students) + 1),
+                                     first_year, last_year)
+        for table, frame in generate_tables(rng, students, first_year, last_year).items():
+            schema, name = table.split('.')
+            bulkwriter.write_frame(frame, name, engine, schema=schema,
+                                   if_exists='replace' if table not in written else 'append',
+                                   dtypes=dict((column, 'date') for column in DATE_COLUMNS if column in frame.columns))
+            written[table] = written.get(table, 0) + len(frame)
+        print("generated students {} to {}".format(start + 1, start + len(students)))
+
+    engine.execute("""DROP TABLE IF EXISTS training.feature_dictionary;
+                      CREATE TABLE training.feature_dictionary (feature_id integer, feature_name text,
+                                                                feature_type text, feature_description text);""")
+    indexes.create_indexes(engine, list(written), concurrently=False)
+    return {'scale': scale, 'seed': seed, 'students': n_students, 'first_year': first_year,
+            'last_year': last_year, 'generated_at': datetime.datetime.now().isoformat(), 'rows': written}
+
+
+@click.command()
+@click.argument('credentials_file')
+@click.option('--scale', '-s', type=float, default=1, help="Scale factor: 1, 10, 100 times {} students.".format(BASE_STUDENTS))
+@click.option('--seed', type=int, default=0)
+@click.option('--first-year', type=int, default=2006)
+@click.option('--last-year', type=int, default=2016)
+def generate_command(credentials_file, scale, seed, first_year, last_year):
+    """Load synthetic source tables into the (scratch) database of CREDENTIALS_FILE (json)."""
+    with open(credentials_file) as f:
+        creds = json.load(f)
+    engine = create_engine('postgresql://', connect_args=creds)
+    print(json.dumps(load(engine, scale, seed, first_year, last_year), indent=2))
+
+
+if __name__ == '__main__':
+    generate_command()
@@ -0,0 +1,145 @@
+import datetime
+import json
+import os
+import subprocess
+import threading
+import time
+from collections import defaultdict
+
+import click
+import yaml
+from sqlalchemy import create_engine
+
+import cohort
+import fingerprint
+import labels
+import narrowstore
+import phasehooks
+import studentpanel
+from dataloader import DataLoader, flatten
+
+'''
+Times DataLoader.load_data on the synthetic data of generate_data.py, from scratch: the features
+tables of the config, the student-year panel and their fingerprints are dropped before every
+repetition, so every feature is computed and written again. The phases of every feature (its SQL,
+preprocessing, write-back) are timed through a phase hook; a fused group or batch is one phase of
+several features, whose time is split evenly between them in the per-feature totals and counted
+once in the per-family ones. Writes the timings as json, to compare branches or scale factors.
+'''
+
+
+class PhaseTimer(phasehooks.PhaseHook):
+    '''Collects the elapsed time of every phase, per feature and per fusion family.'''
+
+    def __init__(self):
+        self.features = defaultdict(lambda: defaultdict(float))
+        self.families = defaultdict(lambda: defaultdict(float))
+        self.phases = defaultdict(float)
+        self._families = {}
+        self.max_rss_bytes = None
+        self._lock = threading.Lock()
+
+    def after(self, features, phase, stats):
+        seconds = stats['elapsed_seconds']
+        family = features[0].fusion_family or features[0].feature_col
+        with self._lock:
+            for feature in features:
+                self.features[(feature.table_name, feature.feature_col)][phase] += seconds / len(features)
+                self._families[feature.feature_col] = family
+            self.families[family][phase] += seconds
+            self.phases[phase] += seconds
+            self.max_rss_bytes = stats['max_rss_bytes']
+
+    def results(self):
+        features = [{'table_name': table, 'feature': feature,
+                     'family': self._families[feature],
+                     'phases': dict(phases), 'seconds': sum(phases.values())}
+                    for (table, feature), phases in self.features.items()]
+        families = dict((family, {'phases': dict(phases), 'seconds': sum(phases.values())})
+                        for family, phases in self.families.items())
+        return {'phases': dict(self.phases),
+                'max_rss_bytes': self.max_rss_bytes,
+                'features': sorted(features, key=lambda feature: -feature['seconds']),
+                'families': families}
+
+
+def drop_outputs(conn, tables, features):
+    """
+    drops the features tables, their cohorts and the panel, and deletes their fingerprints and the
+    dictionary rows of the features, so load_data builds everything. The other features tables of
+    the database, and the dictionary rows of their other features, are left alone
+    """
+    for table in tables:
+        narrowstore.drop_all(table, conn)
+        cohort.drop(table, conn)
+    conn.execute('DROP TABLE IF EXISTS {}'.format(studentpanel.PANEL_TABLE))
+    fingerprints = fingerprint.FingerprintStore(conn)
+    for table in tables + ['student_year_panel']:
+        fingerprints.forget(table)
+    conn.execute('DELETE FROM training.feature_dictionary WHERE feature_name IN %(features)s',
+                 {'features': tuple(features)})
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(conn, config, repeat=1):
+    """
+    runs load_data repeat times from scratch
+    return: dict of the run and the timings of every repetition
+    """
+    if not conn.execute("SELECT to_regclass('training.labels') IS NOT NULL").scalar():
+        labels.gen_label(conn)
+    students = conn.execute('SELECT count(*) FROM training.mapping').scalar()
+    tables = [config['train_table'], config['test_table']]
+    repetitions = []
+    for i in range(repeat):
+        drop_outputs(conn, tables, list(flatten(config['features'])))
+        timer = PhaseTimer()
+        data = DataLoader(list(config['features']), config['train_table'], config['test_table'],
+                          config['train_label'], config['test_label'], conn,
+                          batch_size=config.get('batch_size'), n_jobs=config.get('n_jobs', 1),
+                          panel=config.get('panel', False), refresh=True,
+                          chunksize=config.get('chunksize'), sparse=config.get('sparse', False),
+                          storage=config.get('storage', 'wide'), phase_hooks=[timer])
+        start = time.time()
+        feature_set_train, feature_set_test = data.load_data()
+        repetition = dict(timer.results(), load_data_seconds=time.time() - start,
+                          train_shape=list(feature_set_train.shape), test_shape=list(feature_set_test.shape))
+        print("repetition {}: load_data took {:.1f}s".format(i + 1, repetition['load_data_seconds']))
+        repetitions.append(repetition)
+    return {'started_at': datetime.datetime.now().isoformat(),
+            'git_commit': _git_commit(),
+            'students': students,
+            'features': list(flatten(config['features'])),
+            'options': dict((key, config.get(key)) for key in ('batch_size', 'n_jobs', 'panel', 'chunksize', 'sparse', 'storage')),
+            'repetitions': repetitions}
+
+
+@click.command()
+@click.argument('credentials_file')
+@click.argument('config_file')
+@click.option('--output', '-o', default='benchmark.json', help="Json file of the timings.")
+@click.option('--repeat', '-r', type=int, default=1, help="Number of cold runs of load_data.")
+@click.option('--label', '-l', default=None, help="Name of the run in the json, e.g. the scale factor.")
+def benchmark_command(credentials_file, config_file, output, repeat, label):
+    """Time the feature generation of CONFIG_FILE (yml) on the synthetic data in the database of
+    CREDENTIALS_FILE (json). Drops and rebuilds the features tables of the config."""
+    with open(credentials_file) as f:
+        creds = json.load(f)
+    with open(config_file) as c:
+        config = yaml.load(c)
+    conn = create_engine('postgresql://', connect_args=creds)
+    results = dict(run(conn, config, repeat), label=label)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("wrote {}".format(output))
+
+
+if __name__ == '__main__':
+    benchmark_command()
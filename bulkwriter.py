@@ -0,0 +1,222 @@
+import io
+import struct
+import numpy as np
+import pandas as pd
+
+'''
+Bulk writes of DataFrames and NumPy arrays to Postgres with binary COPY. The rows are encoded
+in the PGCOPY format into an in-memory buffer and streamed with a single COPY ... FROM STDIN
+over a connection of the engine's pool, instead of going through a CSV temp file (text COPY)
+or to_sql's INSERTs. Appending to an existing table whose columns have other types (numeric,
+timestamp with time zone, json...) falls back to text COPY from memory, which postgres parses
+into any type like to_sql's INSERTs.
+'''
+
+_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+_TRAILER = struct.pack('>h', -1)
+_NULL = struct.pack('>i', -1)
+
+# big-endian binary representation of the fixed width postgres types
+_FIXED_WIDTH = {'smallint': '>i2',
+                'integer': '>i4',
+                'bigint': '>i8',
+                'real': '>f4',
+                'double precision': '>f8',
+                'boolean': '?',
+                'date': '>i4',
+                'timestamp without time zone': '>i8'}
+_TEXT = ('text', 'character varying', 'character')
+_POSTGRES_EPOCH = np.datetime64('2000-01-01')
+
+
+def sql_type(series):
+    """
+    postgres type a column is written as: the integer, float and boolean dtypes keep their
+    width, datetimes become timestamps, object columns are typed from their values and
+    everything else is text
+    """
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(dtype):
+        if dtype.itemsize <= 1 or (dtype.itemsize == 2 and dtype.kind == 'i'):
+            return 'smallint'
+        if dtype.itemsize <= 2 or (dtype.itemsize == 4 and dtype.kind == 'i'):
+            return 'integer'
+        return 'bigint'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'real' if dtype.itemsize == 4 else 'double precision'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'timestamp without time zone'
+    if dtype == object:
+        inferred = pd.api.types.infer_dtype(series, skipna=True)
+        if inferred == 'date':
+            return 'date'
+        if inferred in ('datetime', 'datetime64'):
+            return 'timestamp without time zone'
+        if inferred == 'boolean':
+            return 'boolean'
+        if inferred == 'integer':
+            return 'bigint'
+        if inferred in ('floating', 'mixed-integer-float', 'decimal'):
+            return 'double precision'
+    return 'text'
+
+
+def write_frame(df, table_name, conn, schema=None, if_exists='fail', index=False, dtypes=None):
+    """
+    writes df to a postgres table with binary COPY
+
+    param table_name: name of the table, optionally schema qualified
+    param conn: engine (a pooled connection is checked out, committed and returned) or connection
+                (used as is, its owner commits)
+    param schema: schema of the table, if not part of table_name
+    param if_exists: 'fail' creates the table, 'replace' drops it first, 'append' creates it only
+                     if it is missing and otherwise writes with the types of the existing columns
+    param index: also write the index, as its name or 'index'
+    param dtypes: dict of column -> postgres type, overriding the types from sql_type()
+    """
+    if index:
+        df = df.reset_index()
+    qualified_name = '{}.{}'.format(schema, table_name) if schema else table_name
+    types = dict((column, sql_type(df[column])) for column in df.columns)
+    types.update(dtypes or {})
+
+    raw_connection, owned = _raw_connection(conn)
+    try:
+        with raw_connection.cursor() as cursor:
+            if if_exists == 'replace':
+                cursor.execute('DROP TABLE IF EXISTS {}'.format(qualified_name))
+            existing = _column_types(cursor, qualified_name) if if_exists == 'append' else {}
+            if existing:
+                types.update((column, existing[column]) for column in df.columns if column in existing)
+            else:
+                cursor.execute('CREATE TABLE {} ({})'.format(qualified_name, ', '.join(
+                    '{} {}'.format(_quote(column), types[column]) for column in df.columns)))
+            column_types = [types[column] for column in df.columns]
+            if all(pg_type in _FIXED_WIDTH or pg_type in _TEXT for pg_type in column_types):
+                buf, copy_format = encode(df, column_types), 'binary'
+            else:
+                buf, copy_format = encode_text(df), 'text'
+            cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT {})'.format(
+                qualified_name, ', '.join(_quote(column) for column in df.columns), copy_format), buf)
+        if owned:
+            raw_connection.commit()
+    finally:
+        if owned:
+            raw_connection.close()
+
+
+def write_array(array, columns, table_name, conn, **kwargs):
+    """writes a 2d NumPy array, or a structured one, as the named columns. See write_frame"""
+    if array.dtype.names:
+        frame = pd.DataFrame(dict((name, array[name]) for name in array.dtype.names), columns=list(array.dtype.names))
+        frame.columns = columns
+    else:
+        frame = pd.DataFrame(array, columns=columns, copy=False)
+    write_frame(frame, table_name, conn, **kwargs)
+
+
+def encode(df, types):
+    """
+    returns a buffer of the rows of df in the PGCOPY binary format, every column encoded as the
+    postgres type in types. Frames of fixed width columns without NULLs are packed as one
+    NumPy structured array; the others are assembled field by field
+    """
+    buf = io.BytesIO()
+    buf.write(_HEADER)
+    nulls = [pd.isnull(df[column]).values for column in df.columns]
+    if all(pg_type in _FIXED_WIDTH for pg_type in types) and not any(mask.any() for mask in nulls):
+        _encode_fixed_width(buf, df, types)
+    else:
+        _encode_rows(buf, df, types, nulls)
+    buf.write(_TRAILER)
+    buf.seek(0)
+    return buf
+
+
+def encode_text(df):
+    """
+    returns a buffer of the rows of df in the text format of COPY: tab separated values as str()
+    writes them, \\N for NULLs (and NaNs) and backslash escapes
+    """
+    nulls = [pd.isnull(df[column]).values for column in df.columns]
+    columns = [[r'\N' if null else _escape_text(str(value)) for value, null in zip(df[column].tolist(), mask)]
+               for column, mask in zip(df.columns, nulls)]
+    text = ''.join('\t'.join(row) + '\n' for row in zip(*columns))
+    return io.BytesIO(text.encode('utf-8'))
+
+
+def _escape_text(value):
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _encode_fixed_width(buf, df, types):
+    fields = [('count', '>i2')]
+    for position, pg_type in enumerate(types):
+        fields.extend([('length_{}'.format(position), '>i4'), ('value_{}'.format(position), _FIXED_WIDTH[pg_type])])
+    rows = np.empty(len(df), dtype=fields)
+    rows['count'] = len(types)
+    for position, (column, pg_type) in enumerate(zip(df.columns, types)):
+        rows['length_{}'.format(position)] = np.dtype(_FIXED_WIDTH[pg_type]).itemsize
+        rows['value_{}'.format(position)] = _fixed_width_values(df[column], pg_type)
+    buf.write(rows.tobytes())
+
+
+def _encode_rows(buf, df, types, nulls):
+    encoded = []
+    for column, pg_type, mask in zip(df.columns, types, nulls):
+        if pg_type in _FIXED_WIDTH:
+            fmt = _FIXED_WIDTH[pg_type]
+            width = 4 + np.dtype(fmt).itemsize
+            fields = np.empty(len(df), dtype=[('length', '>i4'), ('value', fmt)])
+            fields['length'] = np.dtype(fmt).itemsize
+            series = df[column]
+            if mask.any() and pg_type not in _DATETIME:
+                # dates read their NULLs as NaT; the other types get a placeholder the mask hides
+                series = series.where(~mask, 0)
+            fields['value'] = _fixed_width_values(series, pg_type)
+            packed = fields.tobytes()
+            values = [_NULL if null else packed[i * width:(i + 1) * width] for i, null in enumerate(mask)]
+        elif pg_type in _TEXT:
+            values = []
+            for value, null in zip(df[column].values, mask):
+                if null:
+                    values.append(_NULL)
+                else:
+                    data = str(value).encode('utf-8')
+                    values.append(struct.pack('>i', len(data)) + data)
+        else:
+            raise ValueError("Can't COPY column {} as {}".format(column, pg_type))
+        encoded.append(values)
+    count = struct.pack('>h', len(types))
+    buf.write(b''.join(count + b''.join(fields) for fields in zip(*encoded)))
+
+
+_DATETIME = ('date', 'timestamp without time zone')
+
+
+def _fixed_width_values(series, pg_type):
+    if pg_type == 'date':
+        return (pd.to_datetime(series).values.astype('datetime64[D]') - _POSTGRES_EPOCH).astype(np.int64)
+    if pg_type == 'timestamp without time zone':
+        return (pd.to_datetime(series).values.astype('datetime64[us]') - _POSTGRES_EPOCH).astype(np.int64)
+    return np.asarray(series).astype(_FIXED_WIDTH[pg_type])
+
+
+def _column_types(cursor, qualified_name):
+    cursor.execute("""SELECT attname, format_type(atttypid, NULL)
+                      FROM pg_attribute
+                      WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped""", (qualified_name,))
+    return dict(cursor.fetchall())
+
+
+def _raw_connection(conn):
+    if hasattr(conn, 'raw_connection'):
+        return conn.raw_connection(), True
+    return conn.connection, False
+
+
+def _quote(identifier):
+    return '"{}"'.format(str(identifier).replace('"', '""'))
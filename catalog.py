@@ -0,0 +1,88 @@
+import pandas as pd
+import cohort
+
+
+class FeatureCatalog(object):
+    '''
+    In-memory inventory of the training schema: the columns of every table and the type of every
+    feature in training.feature_dictionary, read with a single query instead of one
+    information_schema probe per feature and table. The DataLoader keeps it in sync as it creates
+    tables and writes or drops features, so it never has to be re-read during a run.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.refresh()
+
+    def refresh(self):
+        """re-reads the whole inventory from the database"""
+        inventory = pd.read_sql_query("""
+                SELECT 'column' AS kind, table_name, column_name AS name, data_type AS type
+                FROM information_schema.columns
+                WHERE table_schema = 'training'
+                UNION ALL
+                SELECT 'dictionary' AS kind, NULL AS table_name, feature_name AS name, feature_type AS type
+                FROM training.feature_dictionary
+                """, self.conn)
+        self._columns = {}
+        self._feature_types = {}
+        for kind, table, name, type_ in inventory[['kind', 'table_name', 'name', 'type']].itertuples(index=False):
+            if kind == 'column':
+                self._columns.setdefault(table, {})[name] = type_
+            else:
+                self._feature_types[name] = type_
+
+    def has_table(self, table):
+        return table in self._columns
+
+    def has_feature(self, feature, table):
+        if feature == cohort.FEATURE:
+            return self.has_table(cohort.table_name(table))
+        return feature in self._columns.get(table, {})
+
+    def tables(self):
+        """return: the names of the tables (and views) of the training schema"""
+        return list(self._columns)
+
+    def column_types(self, table):
+        """return: dict of column -> type of training.<table>"""
+        return dict(self._columns.get(table, {}))
+
+    def columns(self, table):
+        """return: list of the column names of training.<table>"""
+        return list(self._columns.get(table, {}))
+
+    def missing_features(self, features, table):
+        """return: the features, in order, that are not yet a column of training.<table>"""
+        return [feature for feature in features if not self.has_feature(feature, table)]
+
+    def feature_type(self, feature):
+        """return: 'boolean', 'numerical' or 'categorical' as recorded in feature_dictionary, None if it isn't"""
+        return self._feature_types.get(feature)
+
+    def categorical_features(self, features=None):
+        """return: the categorical features of the dictionary, restricted to features when given"""
+        categorical = [feature for feature, feature_type in self._feature_types.items() if feature_type == 'categorical']
+        if features is None:
+            return categorical
+        features = set(features)
+        return [feature for feature in categorical if feature in features]
+
+    def add_table(self, table, columns=(('person_id', 'integer'),)):
+        self._columns[table] = dict(columns)
+
+    def drop_table(self, table):
+        self._columns.pop(table, None)
+
+    def add_feature(self, feature, table, sql_type, feature_type):
+        """records a feature written to training.<table> (or its cohort) and to the dictionary"""
+        if feature == cohort.FEATURE:
+            self.add_table(cohort.table_name(table))
+        else:
+            self._columns.setdefault(table, {})[feature] = sql_type
+        self._feature_types[feature] = feature_type
+
+    def drop_feature(self, feature, table):
+        if feature == cohort.FEATURE:
+            self.drop_table(cohort.table_name(table))
+        self._columns.get(table, {}).pop(feature, None)
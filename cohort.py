@@ -0,0 +1,52 @@
+import bulkwriter
+
+'''
+The cohort of a features table: the students is_student_relevant keeps for its year. It is stored
+as the narrow table training.cohort_<table> (person_id, its primary key) instead of filtering the
+rows of the features table, so (re)computing relevance never rewrites the wide table. The
+features table keeps a row per student of training.mapping, and every read of it goes through
+select(), which joins it to its cohort.
+'''
+
+FEATURE = 'is_student_relevant'
+
+
+def table_name(table):
+    """name (in the training schema) of the cohort table of the features table"""
+    return 'cohort_{}'.format(table)
+
+
+def write(frame, table, conn):
+    """
+    replaces the cohort of the features table with the students of frame, the output of
+    is_student_relevant
+    """
+    cohort = table_name(table)
+    bulkwriter.write_frame(frame[['person_id']].drop_duplicates(), cohort, conn, schema='training',
+                           if_exists='replace')
+    conn.execute("""
+            ALTER TABLE training.{cohort} ADD PRIMARY KEY (person_id);
+            ANALYZE training.{cohort};
+            """.format(cohort=cohort))
+
+
+def drop(table, conn):
+    conn.execute('DROP TABLE IF EXISTS training.{};'.format(table_name(table)))
+
+
+def select(table, columns, where=None, order=False):
+    """
+    SQL reading person_id and columns of the students of the cohort from training.<table>.
+    FEATURE reads as a constant 1, the value it had as a column of the features table
+
+    param columns: column names, or SQL expressions of the columns of the table
+    param where: condition on the columns of the table
+    """
+    selected = ['1 AS {}'.format(FEATURE) if column == FEATURE else column for column in columns]
+    return """SELECT f.person_id{columns}
+              FROM training.{table} f
+              JOIN training.{cohort} c ON c.person_id = f.person_id{where}{order}""".format(
+        columns=''.join(', ' + column for column in selected),
+        table=table, cohort=table_name(table),
+        where=' WHERE {}'.format(where) if where else '',
+        order=' ORDER BY f.person_id' if order else '')
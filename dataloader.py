@@ -1,8 +1,21 @@
+import contextlib
 import feature_generator
+import numpy as np
+import abstractfeature
 import pandas as pd
 import preprocessing as pp
-import itertools
+import sourcecache
+import fingerprint
+import catalog
+import cohort
+import featurecache
+import featureruns
+import indexes
+import narrowstore
+import studentpanel
 import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def flatten(iterable):
     '''this function flattens a list when the elements are either lists or primitives.
@@ -25,7 +38,57 @@ def flatten(iterable):
 class DataLoader(object):
 
     def __init__(self, feature_list, train_table, test_table,
-                 train_label, test_label, conn, normalize=True):
+                 train_label, test_label, conn, normalize=True, batch_size=None, n_jobs=1,
+                 source_cache_bytes=2 * 1024 ** 3, panel=False, refresh=False,
+                 local_cache_dir=None, chunksize=None, sparse=False, profile=False, explain=False,
+                 phase_hooks=None, backend=None, storage='wide', table_lock=None):
+        """
+        param batch_size: if set, missing features are computed in groups of this many and
+                          written to the features table in one bulk copy and one table swap per
+                          group, instead of one ALTER/UPDATE per feature
+        param n_jobs: number of worker threads computing feature_code() and preprocessing at
+                      the same time, each on its own connection from the engine's pool. Writes
+                      to the features table always happen one at a time from the main thread
+        param source_cache_bytes: memory budget of the source table cache shared by the features
+                                  of one load_data run. 0 turns the cache off
+        param panel: build the features of families that support it for all the year tables of
+                     the run (train and test) in one pass, instead of once per table
+        param refresh: rebuild the features whose fingerprint (class code, timeframe, source
+                       tables) changed since they were written, instead of only the missing ones.
+                       Features written without a fingerprint, e.g. before refresh was turned on,
+                       are kept and their current fingerprint recorded, except the ones listed
+                       in fingerprint.CHANGED_UNRECORDED
+        param local_cache_dir: directory of a local columnar copy of the features tables, keyed by
+                               the feature fingerprints. load_data reads the requested columns from
+                               it and only goes to Postgres for the ones it misses. Needs refresh
+        param chunksize: if set, load_data streams the features tables this many rows at a time
+                         and normalizes and dummy-codes every chunk straight into preallocated
+                         train and test matrices, with min/max and categories from a first pass
+                         of SQL aggregates, instead of holding both full tables and their copies
+        param sparse: leave the categorical features un-encoded in the frames load_data returns
+                      and fill self.vocabulary, shared by train and test, for
+                      preprocessing.sparse_design_matrix. Takes precedence over chunksize
+        param profile: record the wall time, DB time, rows and bytes of every feature (or fused
+                       group) build_tables computes in training.feature_runs
+        param explain: with profile, also record the EXPLAIN (ANALYZE, BUFFERS) plan of their queries
+        param phase_hooks: phasehooks.PhaseHook objects called around every phase (SQL,
+                           preprocessing, write-back) of the features build_tables builds, and
+                           closed at its end
+        param backend: connection the feature SQL runs on instead of conn, e.g. a
+                       duckdbbackend.open_snapshot() of the source tables. The features are
+                       still written to (and fingerprinted against) conn, so build_tables
+                       doesn't use a snapshot whose sources changed in conn since its export
+        param storage: 'wide' keeps every feature as a column of the features table. 'narrow'
+                       writes each one to its own table and makes the features table a view
+                       joining them (see narrowstore), so no write rewrites the other features
+        param table_lock: function of a features table name returning a context manager, held
+                          while the table is created, its stale features dropped or features
+                          written to it, for several processes building the same tables (see
+                          featurejobs.table_lock). The catalog is re-read under the lock, and
+                          features another process wrote in the meantime aren't written again
+        """
+        if storage not in ('wide', 'narrow'):
+            raise ValueError("storage must be 'wide' or 'narrow'")
         self.feature_list = feature_list
         self.train_label = train_label
         self.test_label = test_label
@@ -33,6 +96,32 @@ class DataLoader(object):
         self.test_table = test_table
         self.conn = conn
         self.normalize = normalize
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+        self.source_cache_bytes = source_cache_bytes
+        self.source_cache = None
+        self.panel = panel
+        self.refresh = refresh
+        self.fingerprints = None
+        self._current_fingerprints = {}
+        self.catalog = None
+        self.local_cache = None
+        self.chunksize = chunksize
+        self.scaler = None
+        self.sparse = sparse
+        self.vocabulary = None
+        self.profile = profile
+        self.explain = explain
+        self.profiler = None
+        self.phase_hooks = list(phase_hooks or [])
+        self.backend = backend
+        self.storage = storage
+        self.table_lock = table_lock
+        if local_cache_dir:
+            if refresh:
+                self.local_cache = featurecache.LocalFeatureCache(local_cache_dir)
+            else:
+                print("WARNING: the local feature cache is keyed by fingerprints and needs refresh. Not using it")
 
     def load_data(self):
         """
@@ -40,71 +129,501 @@ class DataLoader(object):
         return dataframe of the features
         """
         
-        table_list = [self.train_table, self.test_table]
-        
-        if 'is_student_relevant' not in self.feature_list:
-            self.feature_list.append('is_student_relevant')
-
-        for table in table_list:
-            if not self._does_table_exist_in_db(table):
-                print("creating feature table named", table)
-                sql_query = '''create table training.{} as (select person_id from training.mapping)'''.format(table)
-                self.conn.execute(sql_query)
-
-            for feature in flatten(self.feature_list):             
-                if not self._does_feature_exist_in_db(feature, table):
-                    fn = getattr(feature_generator, feature)
-                    fn1 = fn(table, self.conn)
-                    fn1.run()
-                else: 
-                     print('feature {col_name} already exists in table {table_name}'.format(col_name = feature, table_name = table))
+        self.build_tables([self.train_table, self.test_table])
 
         print("loading data now!")
 
-        sql_query_test = "select person_id, {feature_list} from training.{table};".format(
-            feature_list=','.join(flatten(self.feature_list)), table=self.test_table)
-        sql_query_train = "select person_id, {feature_list} from training.{table};".format(
-            feature_list=','.join(flatten(self.feature_list)), table=self.train_table)
-        
-        features_df_test = pd.read_sql(sql_query_test, self.conn)
-        features_df_train = pd.read_sql(sql_query_train, self.conn)
-        
-        sql_query = '''SELECT feature_name FROM training.feature_dictionary 
-                       where feature_type = 'categorical' ''' 
-        
-        categorial_list = pd.read_sql(sql_query, self.conn)
-        features_categorial_list = categorial_list.values.tolist()
-        features_categorial_list = list(itertools.chain.from_iterable(features_categorial_list))
+        features_categorial_list = self.catalog.categorical_features()
         print ('feature list provided,' , flatten(self.feature_list))
         print ('feature list in dictionary', features_categorial_list)
-        final_list = list(set(features_categorial_list).intersection(flatten(self.feature_list)))
+        final_list = self.catalog.categorical_features(flatten(self.feature_list))
 
         print (final_list)
-        features_df_test['is_train'] = 0
-        features_df_train['is_train'] = 1
+        if self.chunksize and not self.sparse:
+            return self._load_streaming(final_list)
+
+        features_df_test = self._read_table(self.test_table)
+        features_df_train = self._read_table(self.train_table)
+        pp.align_categories([features_df_test, features_df_train],
+                            [feature for feature in final_list if features_df_test[feature].dtype.name == 'category'])
+        features_df_test['is_train'] = np.uint8(0)
+        features_df_train['is_train'] = np.uint8(1)
         all_features = pd.concat([features_df_test, features_df_train])
 
         if self.normalize:
             print("Normalizing features to [0, 1]...")
-            for feature in all_features.columns:
-                if not (feature in ('person_id', 'is_train') or feature in final_list):
-                    max_val = all_features[feature].max()
-                    min_val = all_features[feature].min()
-                    the_range = max_val - min_val + 1e-4
-                    all_features[feature] = (all_features[feature] - min_val) / (the_range)
-
-        all_features = pp.get_dummies(all_features, columns=final_list)
+            numeric = [feature for feature in all_features.columns
+                       if not (feature in ('person_id', 'is_train') or feature in final_list)]
+            self.scaler = pp.MinMaxScaler().fit(all_features, numeric)
+            self.scaler.transform(all_features)
+            self.scaler.save(self.conn, self.dataset_name)
+
+        if self.sparse:
+            self.vocabulary = pp.categorical_vocabulary([all_features], final_list)
+        else:
+            all_features = pp.get_dummies(all_features, columns=final_list)
         features_big_table_test = all_features[all_features['is_train'] == 0]
         features_big_table_train = all_features[all_features['is_train'] == 1]
 
         return features_big_table_train, features_big_table_test 
     
+    @property
+    def dataset_name(self):
+        """name the scaling parameters of this train/test pair are saved under"""
+        return '{}_{}'.format(self.train_table, self.test_table)
+
+    def _load_streaming(self, categorical):
+        """load_data for chunked reads: returns the same train and test frames (person_id, the
+        normalized numeric features, is_train, then the dummies of every categorical feature), each
+        built in a single float32 matrix filled chunk by chunk
+        params categorical: the categorical features of the feature list
+        """
+        columns = list(flatten(self.feature_list))
+        numeric = [column for column in columns if column not in categorical]
+        row_counts, minimums, maximums, vocabularies = self._column_stats(numeric, categorical)
+        if self.normalize:
+            self.scaler = pp.MinMaxScaler.from_bounds(numeric, [minimums[feature] for feature in numeric],
+                                                      [maximums[feature] for feature in numeric])
+            self.scaler.save(self.conn, self.dataset_name)
+
+        output_columns = numeric + ['is_train']
+        dummy_offsets = {}
+        for feature in categorical:
+            dummy_offsets[feature] = len(output_columns)
+            output_columns.extend('{}_{}'.format(feature, value) for value in vocabularies[feature])
+
+        frames = []
+        for table, is_train in ((self.train_table, 1), (self.test_table, 0)):
+            matrix = np.zeros((row_counts[table], len(output_columns)), dtype=np.float32)
+            person_id = np.empty(row_counts[table], dtype=np.int64)
+            matrix[:, len(numeric)] = is_train
+            start = 0
+            for chunk in self._read_chunks(table, columns):
+                stop = start + len(chunk)
+                person_id[start:stop] = chunk['person_id'].values
+                values = chunk[numeric].to_numpy(dtype=np.float32)
+                if self.normalize:
+                    self.scaler.transform_array(values)
+                matrix[start:stop, :len(numeric)] = values
+                for feature in categorical:
+                    codes = pd.Categorical(np.asarray(chunk[feature], dtype=object),
+                                           categories=vocabularies[feature]).codes
+                    rows = np.flatnonzero(codes >= 0)
+                    matrix[start + rows, dummy_offsets[feature] + codes[rows]] = 1
+                start = stop
+            if start != row_counts[table]:
+                raise ValueError("{} changed while loading it: expected {} rows, read {}".format(
+                    table, row_counts[table], start))
+            frame = pd.DataFrame(matrix, columns=output_columns, copy=False)
+            frame.insert(0, 'person_id', person_id)
+            frames.append(frame)
+            print("streamed {} rows of {}".format(start, table))
+        return frames[0], frames[1]
+
+    def _column_stats(self, numeric, categorical):
+        """first pass of load_data for chunked reads: row count of both tables, min and max of the
+        numeric features over both tables together, and the sorted values of the categorical ones
+        """
+        row_counts = {}
+        minimums = {}
+        maximums = {}
+        values = dict((feature, set()) for feature in categorical)
+        for table in (self.train_table, self.test_table):
+            aggregates = ['count(*)'] + ['min({0}), max({0})'.format(feature) for feature in numeric]
+            stats = pd.read_sql("select {aggregates} from ({rows}) t;".format(
+                aggregates=', '.join(aggregates), rows=cohort.select(table, numeric)), self.conn).iloc[0].tolist()
+            row_counts[table] = int(stats[0])
+            for position, feature in enumerate(numeric):
+                low, high = stats[1 + 2 * position], stats[2 + 2 * position]
+                minimums[feature] = low if feature not in minimums else min(minimums[feature], low)
+                maximums[feature] = high if feature not in maximums else max(maximums[feature], high)
+            if categorical:
+                distinct = pd.read_sql(' union '.join(
+                    "select distinct '{0}' as feature, cast(value as text) as value from ({1}) t".format(
+                        feature, cohort.select(table, ['f.{} AS value'.format(feature)], where='f.{} is not null'.format(feature)))
+                    for feature in categorical), self.conn)
+                for feature, value in distinct[['feature', 'value']].itertuples(index=False):
+                    values[feature].add(value)
+        vocabularies = dict((feature, sorted(values[feature])) for feature in categorical)
+        return row_counts, minimums, maximums, vocabularies
+
+    def _read_chunks(self, table, columns):
+        """yields person_id and the columns of the table, self.chunksize rows at a time: slices of
+        the memory-mapped local cache when there is one, else through a server-side cursor
+        """
+        if self.local_cache is not None:
+            frame = self._read_table(table)
+            for start in range(0, len(frame), self.chunksize):
+                yield frame.iloc[start:start + self.chunksize]
+            return
+        connection = self.conn.connect().execution_options(stream_results=True)
+        try:
+            for chunk in pd.read_sql(cohort.select(table, columns), connection, chunksize=self.chunksize):
+                yield chunk
+        finally:
+            connection.close()
+
+    def _read_table(self, table):
+        """returns person_id and the requested features of the table, through the local cache
+        when there is one, with the compact dtypes of their feature types
+        params table: name of the features table
+        """
+        columns = list(flatten(self.feature_list))
+        frame = self._read_columns(table, columns)
+        feature_types = dict((column, self.catalog.feature_type(column)) for column in columns)
+        return pp.apply_dtypes(frame, pp.plan_dtypes(frame, feature_types))
+
+    def _read_columns(self, table, columns):
+        if self.local_cache is None:
+            return pd.read_sql(cohort.select(table, columns), self.conn)
+
+        keys = OrderedDict((column, self._current_fingerprints[table][column]) for column in columns)
+        rows_key = keys['is_student_relevant']
+        cached = self.local_cache.cached_columns(table, rows_key, keys)
+        misses = [column for column in columns if column not in cached]
+        if misses:
+            print("reading {} of {} columns of {} from the database".format(len(misses), len(columns), table))
+            self.local_cache.write(table, rows_key, OrderedDict((column, keys[column]) for column in misses),
+                                   pd.read_sql(cohort.select(table, misses, order=True), self.conn))
+        return self.local_cache.read(table, rows_key, keys)
+
+    def build_tables(self, table_list):
+        """
+        creates the features tables that don't exist yet and builds the features missing from them
+        params table_list: names of the features tables
+        """
+        # is_student_relevant is always built: its cohort table decides the rows every read of
+        # the features tables returns
+        if 'is_student_relevant' not in self.feature_list:
+            self.feature_list.insert(0, 'is_student_relevant')
+
+        if self.profile:
+            self.profiler = featureruns.FeatureRunRecorder(self.conn, explain=self.explain)
+        try:
+            if self.refresh:
+                self.fingerprints = fingerprint.FingerprintStore(self.conn)
+            if self.backend is not None:
+                self._check_backend()
+
+            if self.source_cache_bytes:
+                self.source_cache = sourcecache.SourceCache(self.backend or self.conn, max_bytes=self.source_cache_bytes)
+            # one snapshot of the training schema, kept up to date by the writes below
+            self.catalog = catalog.FeatureCatalog(self.conn)
+            with self._locked('student_year_panel'):
+                self._build_student_panel()
+
+            missing = OrderedDict()
+            for table in table_list:
+                with self._locked(table):
+                    if not self.catalog.has_table(table):
+                        self._create_table(table)
+                    if self.fingerprints is not None:
+                        self._drop_stale_features(table)
+
+                missing_features = self.catalog.missing_features(flatten(self.feature_list), table)
+                for feature in flatten(self.feature_list):
+                    if feature not in missing_features:
+                         print('feature {col_name} already exists in table {table_name}'.format(col_name = feature, table_name = table))
+                missing[table] = missing_features
+
+            if self.panel:
+                for table, missing_features in missing.items():
+                    if 'is_student_relevant' in missing_features:
+                        self._run_alone('is_student_relevant', table)
+                        missing_features.remove('is_student_relevant')
+                self._build_panel(missing)
+
+            for table, missing_features in missing.items():
+                self._build_features(missing_features, table)
+        finally:
+            # the profiler listens to the engine's events and the hooks hold files: let go of them
+            # even if the build raised
+            if self.profiler is not None:
+                self.profiler.close()
+                self.profiler = None
+            for hook in self.phase_hooks:
+                hook.close()
+            if self.source_cache is not None:
+                self.source_cache.clear()
+                self.source_cache = None
+
+    def _check_backend(self):
+        """
+        falls back to computing on conn when the backend's snapshot of a source table the
+        features read doesn't match the table in conn: its features would be computed from the
+        old rows and fingerprinted with the new ones, and never rebuilt
+        """
+        sources = set()
+        for feature in flatten(self.feature_list):
+            sources.update(fingerprint.source_tables(getattr(feature_generator, feature)))
+        if studentpanel.PANEL_TABLE in sources:
+            # built by the backend from its snapshot of the panel's sources
+            sources.remove(studentpanel.PANEL_TABLE)
+            sources.update(studentpanel.source_tables())
+        if self.fingerprints is not None:
+            source_stats = self.fingerprints.source_stats
+        else:
+            source_stats = lambda table: fingerprint.source_table_stats(table, self.conn)
+        stale = self.backend.stale_tables(sorted(sources), source_stats)
+        if stale:
+            print("WARNING: the snapshot of {} is older than the tables in the database: computing on the "
+                  "database instead. Export the snapshot again to use it".format(', '.join(stale)))
+            self.backend = None
+
+    @contextlib.contextmanager
+    def _locked(self, table):
+        """holds the table_lock of a table, if any, with the catalog re-read under it"""
+        if self.table_lock is None:
+            yield
+            return
+        with self.table_lock(table):
+            self.catalog.refresh()
+            yield
+
+    def _build_student_panel(self):
+        """builds training.student_year_panel when a requested feature reads it and it is missing or,
+        with refresh, its source tables changed since it was built. Goes before the feature
+        fingerprints, which take the state of the panel
+        """
+        readers = [feature for feature in flatten(self.feature_list)
+                   if studentpanel.PANEL_TABLE in fingerprint.source_tables(getattr(feature_generator, feature))]
+        if not readers:
+            return
+        if self.backend is not None:
+            self.backend.build_panel()
+        exists = self.catalog.has_table('student_year_panel')
+        if self.fingerprints is None:
+            if not exists:
+                studentpanel.build(self.conn)
+                self.catalog.add_table('student_year_panel')
+            return
+        current = studentpanel.fingerprint(self.fingerprints)
+        if not exists or self.fingerprints.load('student_year_panel').get('student_year_panel') != current:
+            studentpanel.build(self.conn)
+            self.catalog.add_table('student_year_panel')
+            self.fingerprints.save('student_year_panel', 'student_year_panel', current)
+
+    def _drop_stale_features(self, table):
+        """drops the columns of the features whose fingerprint changed since they were written to
+        the table, so they are rebuilt with the missing ones. A stale is_student_relevant only
+        drops the cohort of the table: the other features are computed for every student. Features
+        of the table without a recorded fingerprint are adopted, unless
+        fingerprint.CHANGED_UNRECORDED says their values changed since
+        params table: name of the features table
+        """
+        recorded = self.fingerprints.load(table)
+        current = OrderedDict((feature, self.fingerprints.compute(getattr(feature_generator, feature), table))
+                              for feature in flatten(self.feature_list))
+        self._current_fingerprints[table] = current
+        existing = [feature for feature in current if self.catalog.has_feature(feature, table)]
+        for feature in existing:
+            if feature not in recorded and not fingerprint.changed_unrecorded(feature, table):
+                print('recording the fingerprint of feature {col_name} in table {table_name}'.format(col_name=feature, table_name=table))
+                self.fingerprints.save(table, feature, current[feature])
+        stale = [feature for feature in existing
+                 if recorded.get(feature, current[feature]) != current[feature]
+                 or feature not in recorded and fingerprint.changed_unrecorded(feature, table)]
+        for feature in stale:
+            print('feature {col_name} is stale in table {table_name}, rebuilding it'.format(col_name=feature, table_name=table))
+            if feature == cohort.FEATURE:
+                cohort.drop(table, self.conn)
+            elif self.storage == 'narrow':
+                narrowstore.drop(table, feature, self.conn)
+                self.catalog.drop_table(narrowstore.table_name(table, feature))
+            else:
+                self.conn.execute('ALTER TABLE training.{table} DROP COLUMN {feature};'.format(table=table, feature=feature))
+            self.catalog.drop_feature(feature, table)
+        if stale and self.storage == 'narrow':
+            self._create_view(table)
+
+    def _create_table(self, table):
+        if self.storage == 'narrow':
+            print("creating feature view named", table)
+            self._create_view(table)
+            return
+        print("creating feature table named", table)
+        sql_query = '''create table training.{} as (select person_id from training.mapping)'''.format(table)
+        self.conn.execute(sql_query)
+        indexes.create_indexes(self.conn, ['training.{}'.format(table)], concurrently=False)
+        self.catalog.add_table(table)
+
+    def _record_written(self, features, table):
+        """records features just written to the table in the catalog, and saves the fingerprints
+        taken before computing them. Writes that swap the table in drop its person_id index, so
+        it is built again
+        """
+        if self.storage == 'narrow':
+            for feature in features:
+                if feature.feature_col != cohort.FEATURE:
+                    self.catalog.add_table(narrowstore.table_name(table, feature.feature_col),
+                                           (('person_id', 'integer'), (feature.feature_col, feature.feature_sql_type)))
+            self._create_view(table)
+        else:
+            indexes.create_indexes(self.conn, ['training.{}'.format(table)], concurrently=False)
+        for feature in features:
+            self.catalog.add_feature(feature.feature_col, table, feature.feature_sql_type, feature.feature_type)
+        if self.fingerprints is None:
+            return
+        for feature in features:
+            name = feature.__class__.__name__
+            self.fingerprints.save(table, name, self._current_fingerprints[table][name])
+
+    def _create_view(self, table):
+        """(re)creates the view of a narrow features table over the narrow tables of its features"""
+        prefix = narrowstore.table_name(table, '')
+        columns = [('person_id', 'integer')]
+        for narrow in sorted(self.catalog.tables()):
+            if narrow.startswith(prefix):
+                columns.extend((column, sql_type) for column, sql_type in self.catalog.column_types(narrow).items()
+                               if column != 'person_id')
+        narrowstore.create_view(table, [column for column, _ in columns[1:]], self.conn)
+        self.catalog.add_table(table, columns)
+
+    def _build_panel(self, missing):
+        """builds the features whose family supports it for every year table at once, one panel
+        query per family, and removes them from the missing lists. Age tables are left to the
+        per-table path
+        params missing: dict of table name -> names of the features missing from it
+        """
+        groups = OrderedDict()
+        for table, missing_features in missing.items():
+            if abstractfeature.timeframe_of_table(table)[0] != 'year':
+                continue
+            for feature in missing_features:
+                fn = getattr(feature_generator, feature)
+                if hasattr(fn, 'panel_feature_code'):
+                    groups.setdefault((fn.fusion_family, getattr(fn, 'table', None)), []).append((feature, table))
+
+        for group in groups.values():
+            features = [self._make_feature(feature, table, self.backend or self.conn) for feature, table in group]
+            computed = self._measured(features, lambda: abstractfeature.compute_panel(features))
+            for feature in features:
+                feature.conn = self.conn
+            for table in missing:
+                written = [(feature, frame) for feature, frame in computed if feature.table_name == table]
+                for start in range(0, len(written), self.batch_size or 1):
+                    self._write_features(written[start:start + (self.batch_size or 1)], table)
+            for feature, table in group:
+                missing[table].remove(feature)
+
+    def _build_features(self, features, table):
+        """computes the given features and writes them to the table, self.batch_size at a time
+        when batching. is_student_relevant is written to the cohort table of the table instead
+        of a column, so it is built on its own, outside of any batch
+        params features: names of the features missing from the table
+        params table: name of the features table
+        """
+        if 'is_student_relevant' in features:
+            self._run_alone('is_student_relevant', table)
+
+        pending = []
+        for feature, frame in self._compute_features(
+                [feature for feature in features if feature != 'is_student_relevant'], table):
+            pending.append((feature, frame))
+            if len(pending) >= (self.batch_size or 1):
+                self._write_features(pending, table)
+                pending = []
+        if pending:
+            self._write_features(pending, table)
+
+    def _run_alone(self, feature, table):
+        """computes and writes one feature on its own, outside of any batch"""
+        fn1 = self._make_feature(feature, table, self.backend or self.conn)
+        _, feature_data = self._compute_group([fn1])[0]
+        fn1.conn = self.conn
+        with self._locked(table):
+            if self.catalog.has_feature(feature, table):
+                return
+            fn1.write(feature_data)
+            self._record_written([fn1], table)
+
+    def _compute_features(self, features, table):
+        """yields (feature object, preprocessed frame) pairs, in completion order when running
+        on more than one worker. Features of the same fusion family come out of one fused query
+        """
+        groups = self._group_features(features)
+        if self.n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                futures = [pool.submit(self._compute_on_own_connection, group, table)
+                           for group in groups]
+                for future in as_completed(futures):
+                    for computed in future.result():
+                        yield computed
+        else:
+            for group in groups:
+                for feature, frame in self._compute_group([self._make_feature(feature, table, self.backend or self.conn)
+                                                           for feature in group]):
+                    feature.conn = self.conn
+                    yield feature, frame
+
+    def _group_features(self, features):
+        """splits feature names into the lists that are computed together: one per fusion family
+        and source table, and a list of one for every other feature
+        """
+        groups = OrderedDict()
+        for feature in features:
+            fn = getattr(feature_generator, feature)
+            key = (fn.fusion_family, getattr(fn, 'table', None)) if fn.fusion_family else feature
+            groups.setdefault(key, []).append(feature)
+        return list(groups.values())
+
+    def _compute_group(self, group):
+        """returns (feature object, preprocessed frame) pairs for a list of feature objects"""
+        if len(group) == 1:
+            return self._measured(group, lambda: [(group[0], group[0].compute())])
+        return self._measured(group, lambda: abstractfeature.compute_fused(group))
+
+    def _measured(self, features, compute):
+        """calls compute(), recording its run when profiling"""
+        if self.profiler is None:
+            return compute()
+        return self.profiler.measure(features, compute)
+
+    def _compute_on_own_connection(self, group, table):
+        """runs in a worker thread: computes a group of features on a connection checked out for
+        it alone, then hands the features back bound to the shared engine for the write
+        """
+        connection = (self.backend or self.conn).connect()
+        try:
+            computed = self._compute_group([self._make_feature(feature, table, connection)
+                                            for feature in group])
+        finally:
+            connection.close()
+        for feature, _ in computed:
+            feature.conn = self.conn
+        return computed
+
+    def _make_feature(self, feature, table, conn):
+        """instantiates the feature_generator class named feature, wired to this run's source cache"""
+        fn1 = getattr(feature_generator, feature)(table, conn)
+        fn1.source_cache = self.source_cache
+        fn1.phase_hooks = self.phase_hooks
+        fn1.narrow_storage = self.storage == 'narrow'
+        return fn1
+
+    def _write_features(self, computed, table):
+        """writes (feature object, frame) pairs to the table, as one batch when batching wide
+        tables. Narrow features are one COPY to a table of their own each anyway
+        """
+        with self._locked(table):
+            computed = [(feature, frame) for feature, frame in computed
+                        if not self.catalog.has_feature(feature.feature_col, table)]
+            if not computed:
+                return
+            if self.batch_size and self.storage == 'wide':
+                abstractfeature.update_batch_in_db([feature for feature, _ in computed],
+                                                   [frame for _, frame in computed], table, self.conn)
+            else:
+                for feature, frame in computed:
+                    feature.write(frame)
+            self._record_written([feature for feature, _ in computed], table)
+
     def load_label(self):
         """
         This query returns the label as a dataframe of person_id and label
         """
-        timeframe_train = int(re.sub("\D", "", self.train_table))
-        timeframe_test = int(re.sub("\D", "", self.test_table))
+        timeframe_train = int(re.sub(r"\D", "", self.train_table))
+        timeframe_test = int(re.sub(r"\D", "", self.test_table))
         sql_query_train = "select person_id, {label} from training.labels where first_year_interaction >= {t_train}   ; ".format(label = self.train_label, t_train = timeframe_train)
         sql_query_test = "select person_id, {label} from training.labels where first_year_interaction >= {t_test} ; ".format(label = self.test_label, t_test= timeframe_test)
         
@@ -112,33 +631,3 @@ class DataLoader(object):
         label_df_test = pd.read_sql(sql_query_test, self.conn)
         
         return label_df_train, label_df_test
-                         
-    def _does_feature_exist_in_db(self, feature, table):
-        """check if feature already exists in the features table
-        params feature: name of feature
-        params table: name of the table we want for this model
-        return: True or False
-        """
-        sql_query = """SELECT EXISTS
-                        (SELECT 1
-                           FROM information_schema.columns
-                          WHERE table_schema='training'
-                            AND table_name=%(table_name)s
-                            AND column_name=%(col_name)s);"""
-        is_there = pd.read_sql_query(sql_query, self.conn,
-                            params={"table_name": table,
-                                             "col_name": feature})
-        return is_there.exists.all()
-
-    def _does_table_exist_in_db(self, table): 
-        """check if tables for the required year already exists, and if not, create it""" 
-        sql_query = '''SELECT EXISTS (
-                        SELECT 1
-                        FROM   information_schema.tables 
-                        WHERE  table_schema = 'training'
-                        AND    table_name = '{}')'''.format(table)
-        is_there = pd.read_sql(sql_query, self.conn)
-        return is_there.exists.all()
-
-
-
@@ -0,0 +1,327 @@
+'''
+An embedded DuckDB backend for the feature SQL. export_snapshot() copies the source tables from
+Postgres to one Parquet file each; open_snapshot() returns a connection serving them as views
+under the same schema qualified names, which the feature classes (and DataLoader's backend
+option) can use in place of the Postgres engine to run feature_code() in process.
+
+Only the read side is served: the features tables, the dictionary and the fingerprints stay in
+Postgres. The snapshot keeps a manifest of the fingerprint.source_table_stats() of every table it
+exported, which DataLoader compares to the live tables before computing on it: a source reloaded
+since the export would otherwise be computed stale and fingerprinted fresh. The student-year panel
+is built in DuckDB from the snapshot's sources, and rebuilt when they are exported again.
+
+DuckDB already parses the Postgres constructs the feature SQL uses (extract(year from ...),
+row_number() OVER, DISTINCT ON, FILTER, generate_series in FROM); what differs is the parameter
+binding, which psycopg2 does client side and is inlined here the same way, and integer division,
+which is switched to Postgres' truncating one.
+'''
+import datetime
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import abstractfeature
+import feature_generator
+import fingerprint
+import indexes
+import studentpanel
+
+try:
+    import duckdb
+except ImportError:  # optional: only the embedded backend needs it
+    duckdb = None
+
+SNAPSHOT_SUFFIX = '.parquet'
+
+MANIFEST = 'manifest.json'
+
+# the duckdb table recording the snapshot the panel was built from
+_PANEL_DIGEST = 'main.snapshot_panel_digest'
+
+# postgres data types -> duckdb ones, for the snapshot files. Anything else is stored as text
+_TYPES = {'smallint': 'SMALLINT', 'integer': 'INTEGER', 'bigint': 'BIGINT', 'real': 'REAL',
+          'double precision': 'DOUBLE', 'numeric': 'DOUBLE', 'boolean': 'BOOLEAN', 'date': 'DATE',
+          'timestamp without time zone': 'TIMESTAMP', 'timestamp with time zone': 'TIMESTAMPTZ',
+          'text': 'VARCHAR', 'character varying': 'VARCHAR', 'character': 'VARCHAR'}
+
+_PARAMETER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def _require_duckdb():
+    if duckdb is None:
+        raise ImportError("the embedded backend needs the duckdb package (pip install duckdb)")
+
+
+def literal(value):
+    """a SQL literal of value, adapted the way psycopg2 adapts query parameters"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, np.bool_)):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, np.integer)):
+        return str(int(value))
+    if isinstance(value, (float, np.floating)):
+        if math.isnan(value) or math.isinf(value):
+            return "CAST('{}' AS DOUBLE)".format(value)
+        return repr(float(value))
+    if isinstance(value, datetime.datetime):
+        return "TIMESTAMP '{}'".format(value.isoformat(' '))
+    if isinstance(value, datetime.date):
+        return "DATE '{}'".format(value.isoformat())
+    if isinstance(value, tuple):
+        # IN %(values)s
+        return '({})'.format(', '.join(literal(item) for item in value))
+    if isinstance(value, list):
+        # psycopg2's ARRAY[...]
+        return '[{}]'.format(', '.join(literal(item) for item in value))
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "''"))
+    raise TypeError("can't adapt parameter of type {}".format(type(value).__name__))
+
+
+def translate(sql, params=None):
+    """
+    inlines the psycopg2 style parameters (%(name)s with a dict, %s with a sequence) of sql as
+    literals, and unescapes %%. Without parameters psycopg2 leaves sql untouched, and so does this
+    """
+    if params is None:
+        return sql
+    positional = iter(params) if isinstance(params, (list, tuple)) else None
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is not None:
+            return literal(params[match.group(1)])
+        return literal(next(positional))
+    return _PARAMETER.sub(replace, sql)
+
+
+def _snapshot_path(directory, table):
+    return os.path.join(directory, table + SNAPSHOT_SUFFIX)
+
+
+def read_manifest(directory):
+    """return: dict of table -> source_table_stats() at its export, empty for a snapshot without manifest"""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def export_snapshot(conn, directory, tables=None, chunksize=500000):
+    """
+    copies tables from Postgres to directory, one <schema>.<table>.parquet file each, typed after
+    their Postgres columns, and records their source_table_stats() in the manifest. Export again
+    after reloading a source: DataLoader doesn't compute on a snapshot older than its sources
+
+    param conn: engine of the Postgres database
+    param tables: schema qualified tables, by default the source and training tables of
+                  indexes.INDEXES, those that exist. The panel is built from them in DuckDB
+    return: the tables exported
+    """
+    _require_duckdb()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = read_manifest(directory)
+    exported = []
+    local = duckdb.connect()
+    for table in (tables or list(indexes.INDEXES)):
+        columns = pd.read_sql_query("""
+                SELECT column_name, data_type FROM information_schema.columns
+                WHERE table_schema || '.' || table_name = %(table)s
+                ORDER BY ordinal_position
+                """, conn, params={'table': table})
+        if columns.empty:
+            continue
+        local.execute('CREATE OR REPLACE TABLE snapshot ({})'.format(', '.join(
+            '"{}" {}'.format(column, _TYPES.get(data_type, 'VARCHAR'))
+            for column, data_type in zip(columns['column_name'], columns['data_type']))))
+        # the stats before the copy: a write during it makes the snapshot look stale, not fresh
+        stats = fingerprint.source_table_stats(table, conn)
+        for chunk in pd.read_sql_query('SELECT * FROM {}'.format(table), conn, chunksize=chunksize):
+            local.register('chunk', chunk)
+            local.execute('INSERT INTO snapshot SELECT * FROM chunk')
+            local.unregister('chunk')
+        local.execute("COPY snapshot TO {} (FORMAT PARQUET)".format(literal(_snapshot_path(directory, table))))
+        manifest[table] = stats
+        print("exported {} to {}".format(table, directory))
+        exported.append(table)
+    local.close()
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return exported
+
+
+class DuckDBConnection(object):
+    '''
+    A DuckDB connection that takes psycopg2 style SQL and parameters. pandas reads through it as
+    through any DB-API connection, and execute()/connect() mirror the parts of the sqlalchemy
+    engine the feature code uses.
+    '''
+
+    def __init__(self, connection, manifest=None):
+        self.connection = connection
+        # read_manifest() of the snapshot served
+        self.manifest = manifest or {}
+
+    def cursor(self):
+        return _Cursor(self.connection.cursor())
+
+    def execute(self, sql, params=None):
+        """runs sql on a cursor of its own and returns it, to fetch from"""
+        cursor = self.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def connect(self):
+        """another connection to the same database, for a worker thread"""
+        return DuckDBConnection(self.connection.cursor(), self.manifest)
+
+    def has_table(self, table):
+        schema, name = table.split('.')
+        return self.execute("""SELECT count(*) FROM information_schema.tables
+                               WHERE table_schema = %s AND table_name = %s""", (schema, name)).scalar() > 0
+
+    def stale_tables(self, tables, source_stats):
+        """
+        return: the tables of the snapshot whose export doesn't match their live state, or that
+                the manifest doesn't know. Tables missing from the snapshot aren't checked
+
+        param source_stats: function of a table -> its current source_table_stats() in Postgres
+        """
+        return [table for table in tables
+                if self.has_table(table) and self.manifest.get(table) != source_stats(table)]
+
+    def _panel_digest(self):
+        """the panel query and the manifest entries of its sources, which the panel was built from"""
+        content = json.dumps({'query': studentpanel.panel_query(),
+                              'sources': dict((source, self.manifest.get(source)) for source in studentpanel.source_tables())},
+                             sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def build_panel(self):
+        """
+        builds training.student_year_panel from the snapshot's sources, unless the database
+        already has one built from the same export of them
+        """
+        digest = self._panel_digest()
+        if self.has_table(studentpanel.PANEL_TABLE) and self.has_table(_PANEL_DIGEST):
+            if self.execute('SELECT digest FROM {}'.format(_PANEL_DIGEST)).scalar() == digest:
+                return
+        print("building {} in duckdb".format(studentpanel.PANEL_TABLE))
+        schema, name = studentpanel.PANEL_TABLE.split('.')
+        # the view of an exported panel, or the table of an older build: duckdb drops either by its kind only
+        kind = self.execute("""SELECT table_type FROM information_schema.tables
+                               WHERE table_schema = %s AND table_name = %s""", (schema, name)).scalar()
+        if kind is not None:
+            self.execute('DROP {} {}'.format('VIEW' if kind == 'VIEW' else 'TABLE', studentpanel.PANEL_TABLE))
+        self.execute('CREATE TABLE {} AS {}'.format(studentpanel.PANEL_TABLE, studentpanel.panel_query()))
+        self.execute('CREATE OR REPLACE TABLE {} AS SELECT %s AS digest'.format(_PANEL_DIGEST), (digest,))
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+
+class _Cursor(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return -1
+
+    def execute(self, sql, params=None):
+        self.cursor.execute(translate(sql, params))
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def scalar(self):
+        row = self.fetchone()
+        return None if row is None else row[0]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+def open_snapshot(directory, database=':memory:', threads=None):
+    """
+    return: a DuckDBConnection serving every <schema>.<table>.parquet file of directory as the
+            view schema.table
+
+    param database: duckdb database file, where a built panel is kept between runs (and rebuilt
+                    once the snapshot is exported again)
+    param threads: duckdb worker threads, all the cores by default
+    """
+    _require_duckdb()
+    connection = duckdb.connect(database)
+    # postgres truncates the division of integers
+    connection.execute('SET GLOBAL integer_division = true')
+    if threads:
+        connection.execute('SET GLOBAL threads = {:d}'.format(threads))
+    for path in sorted(glob.glob(os.path.join(directory, '*' + SNAPSHOT_SUFFIX))):
+        table = os.path.basename(path)[:-len(SNAPSHOT_SUFFIX)]
+        schema, name = table.split('.')
+        connection.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(schema))
+        connection.execute('CREATE OR REPLACE VIEW {} AS SELECT * FROM read_parquet({})'.format(
+            table, literal(os.path.abspath(path))))
+    return DuckDBConnection(connection, read_manifest(directory))
+
+
+def compute_features(features, table_name, conn):
+    """
+    computes features for a features table on conn without writing anything, fusion families in
+    one fused query each like DataLoader does
+
+    param features: names of feature_generator classes
+    param table_name: features table they're built for, e.g. features2012
+    param conn: a DuckDBConnection (or the Postgres engine, to compare)
+    return: dataframe of person_id and a column per feature
+    """
+    if isinstance(conn, DuckDBConnection) and any(
+            studentpanel.PANEL_TABLE in fingerprint.source_tables(getattr(feature_generator, feature))
+            for feature in features):
+        conn.build_panel()
+    groups = OrderedDict()
+    for feature in features:
+        fn = getattr(feature_generator, feature)(table_name, conn)
+        key = (fn.fusion_family, getattr(fn, 'table', None)) if fn.fusion_family else feature
+        groups.setdefault(key, []).append(fn)
+    data = None
+    for group in groups.values():
+        if len(group) == 1:
+            computed = [(group[0], group[0].compute())]
+        else:
+            computed = abstractfeature.compute_fused(group)
+        for feature, frame in computed:
+            frame = frame[['person_id', feature.feature_col]]
+            data = frame if data is None else data.merge(frame, on='person_id', how='outer')
+    return data
@@ -11,6 +11,8 @@ import pandas as pd
 import sqlalchemy
 import yaml
 
+import indexes
+
 CJ_SCHEMA = 'cj_schema'
 EDU_SCHEMA = 'edu_schema'
 ASSESSMENT_TABLE_NAME = 'new_assessment'
@@ -616,6 +618,10 @@ def etl_command(credentials_file, inventory_file):
     load_cj_data(engine, credentials, inventory, click)
     load_edu_data(engine, credentials, inventory, click)
 
+    click.echo("Creating indexes")
+    indexes.create_indexes(engine, [table for table in indexes.INDEXES
+                                    if table.split('.')[0] in (CJ_SCHEMA, EDU_SCHEMA)])
+
 
 if __name__ == '__main__':
     etl_command()
@@ -1,11 +1,13 @@
 import pandas as pd 
 import re 
 import preprocessing as pp
+import abstractfeature
 from abstractfeature import AbstractFeature
 import abc
 from abstractfeature import (AbstractAssessmentFeature, AbstractAssessmentSlope,
                              AbstractDisciplineFeature, AbstractAssessmentAggregates,
-                             AbstractFeature)
+                             AbstractFeature, SpecFeature)
+from featurespec import FeatureSpec
 
 
 class is_student_relevant(AbstractFeature):
@@ -67,14 +69,14 @@ class first_dis_age(AbstractFeature):
         #getting timeframe and time type (age/year )
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
  
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline;", self.conn)
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
+        disc = disc[['student_key','discipline_start_date','discipline_year']]
 
         if rf_type == 'year':
             disc = disc[disc['discipline_year'] <= timeframe]
 
-        demo = pd.read_sql_query("SELECT student_key, student_birthdate, year FROM edu_schema.demographic;", self.conn)
-        demo['birthyear'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+        demo = self.read_source('edu_schema.demographic')
+        demo = demo[['student_key','student_birthdate','year','birth_year']].rename(columns={'birth_year': 'birthyear'})
 
         first_dis_age = pd.merge(demo, disc, how = 'left', on ='student_key')
         first_dis_age['first_dis_age'] = first_dis_age['discipline_year'] - first_dis_age['birthyear']
@@ -82,7 +84,7 @@ class first_dis_age(AbstractFeature):
         first_dis_age = first_dis_age.groupby(['student_key'])['first_dis_age'].min()
         age_df = pd.DataFrame({'student_key':first_dis_age.index, 'first_dis_age':first_dis_age.values})
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping;", self.conn)
+        person_id = self.read_source('training.mapping')
         first_dis_age_id = pd.merge(person_id, age_df , how = 'left', on = 'student_key')
         #dropping all the other columns except the new feature and person_id 
         first_dis_age_id = first_dis_age_id[['person_id','first_dis_age']]
@@ -176,18 +178,16 @@ class num_demo_records(AbstractFeature):
         return data, "num_demo_records"
 
 
-class demo_records_per_year(AbstractFeature):
-    def __init__(self, table_name, conn):
-        super(demo_records_per_year, self).__init__(table_name, conn)    
-        
+class demo_records_per_year(SpecFeature):
+
+    spec = FeatureSpec('demo_records_per_year', 'training.student_year_panel',
+                       'cast(sum(demo_records) as float) / NULLIF(sum(demo_school_years), 0)', 'year',
+                       key='person_id')
+
     @property
     def feature_id(self):
         return 13
 
-    @property
-    def feature_col(self):
-        return 'demo_records_per_year' 
-
     @property
     def feature_type(self):  
         return 'numerical'
@@ -195,27 +195,6 @@ class demo_records_per_year(AbstractFeature):
     @property
     def feature_description(self):
         return '''students' average number of demogaphics records per year'''
-        
-    def feature_code(self):
-        ''' function should get the features table name, the current feature name and 
-        calculate the feature and insert it to the table 
-        '''
-        rf_type, timeframe = self.extract_timeframe_from_table_name() 
-        if rf_type == 'year': 
-            sql = '''  SELECT person_id, 
-                        CASE WHEN num_years > 0 then cast(num_records as float) / num_years ELSE 0 end as demo_records_per_year 
-                             from (SELECT 
-                                   a.student_key,
-                                      b.person_id, 
-                                         count(*) as num_records, 
-                                           count(distinct school_year) as num_years
-                             FROM edu_schema.demographic a
-                             right JOIN training.mapping b ON a.student_key = b.student_key
-                             AND year <= {}
-                             group by 1,2) as t'''.format(timeframe)
-            
-        data = pd.read_sql_query(sql, self.conn)
-        return data, "demo_records_per_year"
 
 
 class max_demo_records_per_year(AbstractFeature):
@@ -610,13 +589,12 @@ class num_of_incidents_learning_environment(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline where discipline_fed_offense_group = 'Learning Environment'", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
+        disc = disc[disc['discipline_fed_offense_group'] == 'Learning Environment']
         disc = disc[['student_key','discipline_year']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
         
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -630,9 +608,7 @@ class num_of_incidents_learning_environment(AbstractFeature):
             
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -676,13 +652,12 @@ class num_of_incidents_physical_safety(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline where discipline_fed_offense_group = 'Personal/Physical Safety'", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
+        disc = disc[disc['discipline_fed_offense_group'] == 'Personal/Physical Safety']
         disc = disc[['student_key','discipline_year']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
         
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -696,9 +671,7 @@ class num_of_incidents_physical_safety(AbstractFeature):
             
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -743,13 +716,12 @@ class num_of_incidents_weapons_related(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline where discipline_fed_offense_group = 'Weapons'", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
+        disc = disc[disc['discipline_fed_offense_group'] == 'Weapons']
         disc = disc[['student_key','discipline_year']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
         
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -763,9 +735,7 @@ class num_of_incidents_weapons_related(AbstractFeature):
             
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -810,13 +780,12 @@ class has_drug_related_discipline(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline where discipline_offense_type = 'Possession/Ownership/Use of Drugs'", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
+        disc = disc[disc['discipline_offense_type'] == 'Possession/Ownership/Use of Drugs']
         disc = disc[['student_key','discipline_year']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
         
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -830,9 +799,7 @@ class has_drug_related_discipline(AbstractFeature):
             
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -879,13 +846,11 @@ class num_discipline_days(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date, discipline_days FROM edu_schema.discipline", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
         disc = disc[['student_key','discipline_year','discipline_days']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
 
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -899,9 +864,7 @@ class num_discipline_days(AbstractFeature):
 
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -947,13 +910,11 @@ class discipline_days_zero_low_medium_high(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date, discipline_days FROM edu_schema.discipline", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
         disc = disc[['student_key','discipline_year','discipline_days']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
 
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -967,9 +928,7 @@ class discipline_days_zero_low_medium_high(AbstractFeature):
 
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -1033,7 +992,7 @@ class math_3rd_grade_wkce_categorical(AbstractFeature):
         # 5: @ERR (dropped)
 
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1081,7 +1040,7 @@ class math_3rd_grade_wkce_numerical(AbstractFeature):
         # 5: @ERR (dropped)
         
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1137,7 +1096,7 @@ class math_3rd_grade_map_categorical(AbstractFeature):
         # 6: Untested (dropped)
         
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1193,7 +1152,7 @@ class math_3rd_grade_map_numerical(AbstractFeature):
         assess['math_3rd_grade_map_numerical'] = assess['math_3rd_grade_map_numerical'].apply(int)
 
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1237,7 +1196,7 @@ class math_3rd_grade_ach_categorical(AbstractFeature):
         # 4: Advanced
         # --: Not specified (dropped)
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1284,7 +1243,7 @@ class math_3rd_grade_ach_numerical(AbstractFeature):
 
         #calculate worst score for students with multiple test scores
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1329,7 +1288,7 @@ class reading_3rd_grade_wkce_categorical(AbstractFeature):
         # 4: Advanced
         # 5: @ERR (dropped)
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1375,7 +1334,7 @@ class reading_3rd_grade_wkce_numerical(AbstractFeature):
         # 5: @ERR (dropped)
 
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1424,7 +1383,7 @@ class reading_3rd_grade_map_categorical(AbstractFeature):
         # 6: Untested (dropped)
 
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1474,7 +1433,7 @@ class reading_3rd_grade_map_numerical(AbstractFeature):
         # 6: Untested (dropped)
 
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1520,7 +1479,7 @@ class ela_3rd_grade_ach_categorical(AbstractFeature):
         # 4: Advanced
         # --: Not specified (dropped)
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1566,7 +1525,7 @@ class ela_3rd_grade_ach_numerical(AbstractFeature):
         # --: Not specified (dropped)
 
         #get person_id 
-        person_id = pd.read_sql_query("SELECT person_id, student_key FROM training.mapping", self.conn)
+        person_id = self.read_source('training.mapping')
 
         #merge on student key
         merged = pd.merge(person_id, assess, on='student_key', how='left')
@@ -1602,13 +1561,11 @@ class total_num_of_incidents(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
         disc = disc[['student_key','discipline_year']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
         
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -1622,9 +1579,7 @@ class total_num_of_incidents(AbstractFeature):
             
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -1669,13 +1624,12 @@ class num_of_incidents_learning_environment(AbstractFeature):
     def feature_code(self):
         
         #get discipline
-        disc = pd.read_sql_query("SELECT student_key, discipline_start_date FROM edu_schema.discipline where discipline_fed_offense_group = 'Learning Environment'", self.conn)
-        #extract discipline year 
-        disc['discipline_year'] = disc['discipline_start_date'].astype('datetime64[ns]').dt.year
+        disc = self.read_source('edu_schema.discipline')
+        disc = disc[disc['discipline_fed_offense_group'] == 'Learning Environment']
         disc = disc[['student_key','discipline_year']]
 
         #get person_id 
-        ids = pd.read_sql_query("SELECT person_id ,student_key FROM training.mapping", self.conn)
+        ids = self.read_source('training.mapping')
         
         #get mode and threshold 
         rf_type, timeframe = self.extract_timeframe_from_table_name() 
@@ -1689,9 +1643,7 @@ class num_of_incidents_learning_environment(AbstractFeature):
             
         elif rf_type == 'age':
             #get demo 
-            demo = pd.read_sql_query("SELECT student_key, student_birthdate FROM edu_schema.demographic", self.conn)
-            #get birth_year
-            demo['birth_year'] = demo['student_birthdate'].astype('datetime64[ns]').dt.year
+            demo = self.read_source('edu_schema.demographic')
             demo = demo[['student_key','birth_year']]
             #merge with discipline on student_key
             df = pd.merge(demo, disc, on = 'student_key')
@@ -1839,6 +1791,8 @@ class student_migrant_ed_indicator(AbstractFeature):
 
 
 class AbstractProgramFeature(AbstractFeature):
+
+    fusion_family = 'program'
     
     @property
     def feature_col(self):
@@ -1853,34 +1807,60 @@ class AbstractProgramFeature(AbstractFeature):
         pass
     
     def feature_code(self):
-        rf_type, timeframe = self.extract_timeframe_from_table_name() 
+        return self.fused_feature_code([self])[self.feature_col], self.feature_col
+
+    @classmethod
+    def fused_feature_code(cls, features):
+        ''' program membership matrix: one pass over edu_schema.programs, linked to
+        training.mapping through the distinct new_demographic ids, with one 0/1 column
+        per requested program
+        '''
+        rf_type, timeframe = features[0].extract_timeframe_from_table_name() 
         if rf_type == 'year':
-            sql = '''SELECT distinct(person_id) as pid 
-            from edu_schema.programs a 
+            in_timeframe = 'extract(year from begin_date) <= %(timeframe)s'
+        else:
+            in_timeframe = '''extract(year from begin_date) - 
+            extract(year from student_birthdate) <= %(timeframe)s'''
+        params = {'timeframe': timeframe,
+                  'program_names': tuple(feature.program_name for feature in features)}
+        columns = []
+        for i, feature in enumerate(features):
+            params['program_name_{}'.format(i)] = feature.program_name
+            columns.append('max(case when a.program_name = %(program_name_{i})s then 1 else 0 end) as {feature_col}'.format(
+                i=i, feature_col=feature.feature_col))
+        sql = '''SELECT c.person_id, {columns}
+            from training.mapping c 
             left join
             (select distinct(student_id), student_key 
-            from edu_schema.new_demographic) b on a.student_id = b.student_id 
-            right join training.mapping c 
-            on b.student_key = c.student_key  where 
-            program_name = %(program_name)s
-            and extract(year from begin_date) <= %(timeframe)s'''
-            
-        else:
-            sql = ''' select distinct(person_id) as pid 
-            from edu_schema.programs a left join 
-            (select distinct(student_id), student_key from edu_schema.new_demographic) b 
-            on a.student_id = b.student_id right join training.mapping c  
-            on b.student_key = c.student_key  where program_name = %(program_name)s
-            and extract(year from begin_date) - 
-            extract(year from student_birthdate) <= %(timeframe)s'''          
-        data = pd.read_sql_query(sql, self.conn, params={'timeframe': timeframe, 'program_name': self.program_name })
-        allid = pd.read_sql_query("select person_id from training.mapping", self.conn)
-        allid[self.feature_col] = 0
-        allid = pd.merge(allid, data, left_on = 'person_id', right_on = 'pid', how = 'left')
-        allid.ix[allid['pid'].notnull(), self.feature_col] = 1
-        feature_data = allid[['person_id', self.feature_col]]
-        
-        return feature_data, self.feature_col
+            from edu_schema.new_demographic) b on b.student_key = c.student_key 
+            left join edu_schema.programs a 
+            on a.student_id = b.student_id 
+            and a.program_name in %(program_names)s
+            and {in_timeframe}
+            group by 1'''.format(columns=',\n            '.join(columns), in_timeframe=in_timeframe)
+        data = pd.read_sql_query(sql, features[0].conn, params=params)
+        return dict((feature.feature_col, data[['person_id', feature.feature_col]]) for feature in features)
+
+    @classmethod
+    def panel_feature_code(cls, features):
+        ''' program membership for several year tables: a student is flagged from the
+        first year one of its programs begins on
+        '''
+        params = {'program_names': tuple(sorted(set(feature.program_name for feature in features)))}
+        partials = []
+        finals = []
+        for i, feature in enumerate(abstractfeature.distinct_features(features)):
+            params['program_name_{}'.format(i)] = feature.program_name
+            partials.append(('p_{}'.format(i),
+                             'max(case when program_name = %(program_name_{})s then 1 else 0 end)'.format(i),
+                             'max', None))
+            finals.append((feature, 'coalesce(p_{}, 0)'.format(i)))
+        events = '''(select b.student_key, cast(extract(year from a.begin_date) as integer) as year, a.program_name
+            from edu_schema.programs a
+            join (select distinct(student_id), student_key
+            from edu_schema.new_demographic) b on a.student_id = b.student_id
+            where a.program_name in %(program_names)s) as enrollments'''
+        return abstractfeature.panel_feature_frames(features, events, partials, finals, params)
 
     
 class is_student_in_tabs(AbstractProgramFeature):
@@ -2169,18 +2149,16 @@ class student_gender(AbstractFeature):
     
 ########################### Enrollment
 
-class enroll_records_per_year(AbstractFeature):
-    def __init__(self, table_name, conn):
-        super(enroll_records_per_year, self).__init__(table_name, conn)    
-        
+class enroll_records_per_year(SpecFeature):
+
+    spec = FeatureSpec('enroll_records_per_year', 'training.student_year_panel',
+                       'cast(sum(enroll_records) as float) / NULLIF(sum(enroll_school_years), 0)', 'year',
+                       key='person_id')
+
     @property
     def feature_id(self):
         return 400
 
-    @property
-    def feature_col(self):
-        return 'enroll_records_per_year' 
-
     @property
     def feature_type(self):  
         return 'numerical'
@@ -2188,25 +2166,6 @@ class enroll_records_per_year(AbstractFeature):
     @property
     def feature_description(self):
         return '''students' average number of enrollment records per year'''
-        
-    def feature_code(self):
-
-        rf_type, timeframe = self.extract_timeframe_from_table_name() 
-        if rf_type == 'year': 
-            sql = '''  SELECT person_id, 
-                        CASE WHEN num_years > 0 then cast(num_records as float) / num_years ELSE 0 end as enroll_records_per_year 
-                             from (SELECT 
-                                   a.student_key,
-                                      b.person_id, 
-                                         count(*) as num_records, 
-                                           count(distinct school_year) as num_years
-                             FROM edu_schema.enrollment a
-                             right JOIN training.mapping b ON a.student_key = b.student_key
-                             AND year <= {}
-                             group by 1,2) as t'''.format(timeframe)
-            
-        data = pd.read_sql_query(sql, self.conn)
-        return data, "enroll_records_per_year"
 
 
 
@@ -2431,17 +2390,16 @@ class school(AbstractFeature):
         return feature_data, 'school'
 
 
-class schools_per_student(AbstractFeature):
-    
-    def __init__(self, table_name, conn):
-        super(schools_per_student, self).__init__(table_name, conn)    
-        
+class schools_per_student(SpecFeature):
+
+    spec = FeatureSpec('schools_per_student', 'edu_schema.new_demographic',
+                       'count(distinct countable_school_name)', 'extract(year from collection_date)',
+                       birthdate_column='student_birthdate')
+
     @property
     def feature_id(self):
         return 3002
-    @property
-    def feature_col(self):
-        return 'schools_per_student' 
+
     @property
     def feature_type(self):  
         return 'numerical'
@@ -2449,21 +2407,6 @@ class schools_per_student(AbstractFeature):
     @property
     def feature_description(self):
         return '''return a dataframe of person_id and schools_per_student'''
-        
-    def feature_code(self):
-        rf_type, timeframe = self.extract_timeframe_from_table_name() 
-        
-        sql = '''SELECT person_id, schools_per_student   from (
-                      select student_key, count(distinct countable_school_name) as schools_per_student  
-                            from edu_schema.new_demographic 
-                               where extract(year from collection_date) <= {}
-                               group by 1) as t
-                                right join training.mapping b on t.student_key = b.student_key'''.format(timeframe) 
-        
-        feature_data = pd.read_sql_query(sql, self.conn)
-        feature_data = pp.fill_null_with_zero(feature_data, 'schools_per_student')
-        
-        return feature_data, 'schools_per_student'
 
 class student_city(AbstractFeature):
     
@@ -2673,7 +2616,6 @@ class math_map_slope(AbstractAssessmentSlope):
 
 class avg_discipline_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'AVG'
     default_value = 0
@@ -2691,7 +2633,6 @@ class avg_discipline_per_year(AbstractDisciplineFeature):
     
 class avg_discipline_weapons_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'AVG'
     default_value = 0
@@ -2708,7 +2649,6 @@ class avg_discipline_weapons_per_year(AbstractDisciplineFeature):
 
 class avg_discipline_physical_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'AVG'
     default_value = 0
@@ -2725,7 +2665,6 @@ class avg_discipline_physical_per_year(AbstractDisciplineFeature):
     
 class avg_discipline_learning_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'AVG'
     default_value = 0
@@ -2742,7 +2681,6 @@ class avg_discipline_learning_per_year(AbstractDisciplineFeature):
     
 class max_discipline_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'MAX'
     default_value = 0
@@ -2759,7 +2697,6 @@ class max_discipline_per_year(AbstractDisciplineFeature):
 
 class max_discipline_weapons_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'MAX'
     default_value = 0
@@ -2776,7 +2713,6 @@ class max_discipline_weapons_per_year(AbstractDisciplineFeature):
 
 class max_discipline_physical_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'MAX'
     default_value = 0
@@ -2793,7 +2729,6 @@ class max_discipline_physical_per_year(AbstractDisciplineFeature):
     
 class max_discipline_learning_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'MAX'
     default_value = 0
@@ -2810,7 +2745,6 @@ class max_discipline_learning_per_year(AbstractDisciplineFeature):
 
 class std_discipline_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'STDDEV'
     default_value = 0
@@ -2828,7 +2762,6 @@ class std_discipline_per_year(AbstractDisciplineFeature):
     
 class std_discipline_weapons_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'STDDEV'
     default_value = 0
@@ -2845,7 +2778,6 @@ class std_discipline_weapons_per_year(AbstractDisciplineFeature):
 
 class std_discipline_physical_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'STDDEV'
     default_value = 0
@@ -2862,7 +2794,6 @@ class std_discipline_physical_per_year(AbstractDisciplineFeature):
     
 class std_discipline_learning_per_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'STDDEV'
     default_value = 0
@@ -2879,7 +2810,6 @@ class std_discipline_learning_per_year(AbstractDisciplineFeature):
 
 class sum_discipline_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'SUM'
     default_value = 0
@@ -2897,7 +2827,6 @@ class sum_discipline_last_year(AbstractDisciplineFeature):
     
 class sum_discipline_weapons_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'SUM'
     default_value = 0
@@ -2915,7 +2844,6 @@ class sum_discipline_weapons_last_year(AbstractDisciplineFeature):
 
 class sum_discipline_physical_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'SUM'
     default_value = 0
@@ -2933,7 +2861,6 @@ class sum_discipline_physical_last_year(AbstractDisciplineFeature):
     
 class sum_discipline_learning_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'SUM'
     default_value = 0
@@ -2951,7 +2878,6 @@ class sum_discipline_learning_last_year(AbstractDisciplineFeature):
 
 class sum_discipline_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'SUM'
     default_value = 0
@@ -2969,7 +2895,6 @@ class sum_discipline_last_2_years(AbstractDisciplineFeature):
     
 class sum_discipline_weapons_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'SUM'
     default_value = 0
@@ -2987,7 +2912,6 @@ class sum_discipline_weapons_last_2_years(AbstractDisciplineFeature):
 
 class sum_discipline_physical_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'SUM'
     default_value = 0
@@ -3005,7 +2929,6 @@ class sum_discipline_physical_last_2_years(AbstractDisciplineFeature):
     
 class sum_discipline_learning_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'SUM'
     default_value = 0
@@ -3023,7 +2946,6 @@ class sum_discipline_learning_last_2_years(AbstractDisciplineFeature):
 
 class num_discipline_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3041,7 +2963,6 @@ class num_discipline_last_year(AbstractDisciplineFeature):
     
 class num_discipline_weapons_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3059,7 +2980,6 @@ class num_discipline_weapons_last_year(AbstractDisciplineFeature):
 
 class num_discipline_physical_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3077,7 +2997,6 @@ class num_discipline_physical_last_year(AbstractDisciplineFeature):
     
 class num_discipline_learning_last_year(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3095,7 +3014,6 @@ class num_discipline_learning_last_year(AbstractDisciplineFeature):
 
 class num_discipline_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'Weapons', 'Personal/Physical Safety')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3113,7 +3031,6 @@ class num_discipline_last_2_years(AbstractDisciplineFeature):
     
 class num_discipline_weapons_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Weapons', 'foo')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3131,7 +3048,6 @@ class num_discipline_weapons_last_2_years(AbstractDisciplineFeature):
 
 class num_discipline_physical_last_2_years(AbstractDisciplineFeature):   
     
-    table = 'discipline_with_year'
     offense_group = ('Personal/Physical Safety', 'foo')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3148,7 +3064,6 @@ class num_discipline_physical_last_2_years(AbstractDisciplineFeature):
     
     
 class num_discipline_learning_last_2_years(AbstractDisciplineFeature):     
-    table = 'discipline_with_year'
     offense_group = ('Learning Environment', 'foo')
     aggregate_function = 'COUNT'
     default_value = 0
@@ -3197,18 +3112,15 @@ class num_family_members(AbstractFeature):
       data = pp.fill_null_with_zero(data, self.feature_col)
       return data, "num_family_members"
 
-class num_chips_records(AbstractFeature):
-    def __init__(self, table_name, conn):
-        super(num_chips_records, self).__init__(table_name, conn)    
-        
+class num_chips_records(SpecFeature):
+
+    spec = FeatureSpec('num_chips_records', 'training.student_year_panel', 'sum(chips_records)', 'year',
+                       key='person_id')
+
     @property
     def feature_id(self):
         return 209
 
-    @property
-    def feature_col(self):
-        return 'num_chips_records' 
-
     @property
     def feature_type(self):  
         return 'numerical'
@@ -3217,18 +3129,6 @@ class num_chips_records(AbstractFeature):
     def feature_description(self):
         return '''number of chips records up to a certain year'''
 
-    def feature_code(self):
-      rf_type, timeframe = self.extract_timeframe_from_table_name()
-      if rf_type == 'year':
-            sql = '''SELECT b.person_id, sum(case when chips is not null then 1 else 0 end) as num_chips_records
-                        FROM cj_schema.juv_case_person_id a 
-                         RIGHT JOIN training.mapping b on a.person_id = b.person_id and 
-                               inc_year <= {}
-                                  group by 1'''.format(timeframe)
-      data = pd.read_sql_query(sql, self.conn)
-      data = pp.fill_null_with_zero(data, self.feature_col)
-      return data, "num_chips_records"
-
 
 class best_score_reading_map_last_year(AbstractAssessmentAggregates):
     
@@ -0,0 +1,103 @@
+import contextlib
+import glob
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+class LocalFeatureCache(object):
+    '''
+    Local columnar copy of the training.features<...> tables: one NumPy file per column, read
+    back memory-mapped. Every file is keyed by the fingerprint of its feature, under a directory
+    keyed by the fingerprint of is_student_relevant (which decides the rows of the table), so a
+    rebuilt feature or a rebuilt table simply misses and is read from Postgres again.
+
+    Rows are stored sorted by person_id. Categorical columns are stored as int32 codes (-1 for
+    NULL) next to a json list of their categories.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _rows_directory(self, table, rows_key):
+        return os.path.join(self.directory, table, rows_key)
+
+    def _path(self, table, rows_key, column, key, suffix='npy'):
+        return os.path.join(self._rows_directory(table, rows_key), '{}.{}.{}'.format(column, key, suffix))
+
+    def cached_columns(self, table, rows_key, keys):
+        """return: the columns of keys (dict of column -> fingerprint) that have an up to date file"""
+        if not os.path.exists(self._path(table, rows_key, 'person_id', rows_key)):
+            return []
+        return [column for column, key in keys.items()
+                if os.path.exists(self._path(table, rows_key, column, key))]
+
+    def read(self, table, rows_key, keys):
+        """
+        returns a dataframe of person_id and the columns of keys, built on memory-mapped arrays.
+        All the columns must be cached
+        """
+        data = {'person_id': np.load(self._path(table, rows_key, 'person_id', rows_key), mmap_mode='r')}
+        for column, key in keys.items():
+            values = np.load(self._path(table, rows_key, column, key), mmap_mode='r')
+            categories_path = self._path(table, rows_key, column, key, 'json')
+            if os.path.exists(categories_path):
+                with open(categories_path) as f:
+                    values = pd.Categorical.from_codes(values, categories=json.load(f))
+            data[column] = values
+        return pd.DataFrame(data, copy=False)
+
+    def write(self, table, rows_key, keys, frame):
+        """
+        stores the columns of keys from frame (person_id and the columns, sorted by person_id).
+        Files of older fingerprints of the same columns, and of older row sets, are removed
+        """
+        table_directory = os.path.join(self.directory, table)
+        if os.path.isdir(table_directory):
+            for old_rows_key in os.listdir(table_directory):
+                if old_rows_key != rows_key:
+                    shutil.rmtree(os.path.join(table_directory, old_rows_key))
+        rows_directory = self._rows_directory(table, rows_key)
+        # another process filling the cache may create it first
+        os.makedirs(rows_directory, exist_ok=True)
+
+        person_id_path = self._path(table, rows_key, 'person_id', rows_key)
+        if not os.path.exists(person_id_path):
+            self._save(person_id_path, frame['person_id'].values)
+        for column, key in keys.items():
+            for old_file in glob.glob(os.path.join(rows_directory, glob.escape(column) + '.*')):
+                os.remove(old_file)
+            values = frame[column]
+            if not pd.api.types.is_numeric_dtype(values.dtype):
+                values = values.astype('category')
+                self._save_categories(self._path(table, rows_key, column, key, 'json'), values.cat.categories.tolist())
+                self._save(self._path(table, rows_key, column, key), values.cat.codes.values.astype(np.int32))
+            else:
+                self._save(self._path(table, rows_key, column, key), values.values)
+
+    def _save(self, path, values):
+        with self._replacing(path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(values))
+
+    def _save_categories(self, path, categories):
+        with self._replacing(path, 'w') as f:
+            json.dump(categories, f)
+
+    @contextlib.contextmanager
+    def _replacing(self, path, mode):
+        """
+        file to write the content of path to. It is written under a temporary name of its own in
+        the same directory and moved into place when done, so a reader never maps a half written
+        file, and processes filling the same cache never write to the same file
+        """
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, mode) as f:
+                yield f
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
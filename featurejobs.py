@@ -0,0 +1,304 @@
+import contextlib
+import os
+import socket
+import threading
+import time
+import traceback
+import pandas as pd
+import feature_generator
+import fingerprint
+from dataloader import DataLoader
+
+'''
+A queue of feature builds in training.feature_jobs, for building many features tables on several
+processes or batch nodes at once. enqueue() adds a job per (features table, feature); any number
+of work() loops claim them with SELECT ... FOR UPDATE SKIP LOCKED, the available jobs of one table
+and fusion family at a time so a family is still computed by one fused query, and build them
+with a DataLoader. Writes to a features table are serialized across processes by a postgres
+advisory lock per table (table_lock), under which the DataLoader re-reads the catalog.
+
+A failed job is available again after retry_seconds times its attempts, until it has used
+max_attempts. A worker renews the lease of its jobs while it builds them; a job whose worker
+died is claimed again once its lease has expired, and the late worker can't finish or fail it
+any more.
+'''
+
+JOBS_TABLE = 'training.feature_jobs'
+
+# first key of the advisory locks of the features tables, so they don't collide with other locks
+LOCK_NAMESPACE = 7734
+
+# jobs a worker may claim: pending and due, or running on a worker whose lease expired
+_AVAILABLE = """j.attempts < j.max_attempts
+                AND (j.status = 'pending' AND j.available_at <= now()
+                     OR j.status = 'running' AND j.claimed_at < now() - %(lease)s * interval '1 minute')"""
+
+
+def create_jobs_table(conn):
+    conn.execute("""
+            CREATE TABLE IF NOT EXISTS {jobs} (
+                job_id serial PRIMARY KEY,
+                table_name text NOT NULL,
+                feature_name text NOT NULL,
+                family text NOT NULL,
+                status text NOT NULL DEFAULT 'pending',
+                attempts integer NOT NULL DEFAULT 0,
+                max_attempts integer NOT NULL DEFAULT 3,
+                available_at timestamp without time zone NOT NULL DEFAULT now(),
+                enqueued_at timestamp without time zone NOT NULL DEFAULT now(),
+                claimed_at timestamp without time zone,
+                finished_at timestamp without time zone,
+                worker text,
+                last_error text);
+            CREATE UNIQUE INDEX IF NOT EXISTS feature_jobs_open_idx ON {jobs} (table_name, feature_name)
+                WHERE status IN ('pending', 'running');
+            CREATE INDEX IF NOT EXISTS feature_jobs_status_idx ON {jobs} (status, available_at);
+            """.format(jobs=JOBS_TABLE))
+
+
+def family(feature):
+    """the key the jobs of a feature are claimed together by: its fusion family and source table"""
+    fn = getattr(feature_generator, feature)
+    if not fn.fusion_family:
+        return feature
+    return '{}:{}'.format(fn.fusion_family, getattr(fn, 'table', None) or '')
+
+
+def enqueue(conn, tables, features, max_attempts=3):
+    """
+    adds a pending job for every feature of every table that doesn't have an open (pending or
+    running) one yet. Also creates the fingerprints table, which the workers would race to create
+
+    param features: names of feature_generator classes
+    return: number of jobs added
+    """
+    create_jobs_table(conn)
+    fingerprint.FingerprintStore(conn)
+    added = 0
+    for table in tables:
+        for feature in features:
+            result = conn.execute("""
+                    INSERT INTO {jobs} (table_name, feature_name, family, max_attempts)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (table_name, feature_name) WHERE status IN ('pending', 'running') DO NOTHING
+                    """.format(jobs=JOBS_TABLE), (table, feature, family(feature), max_attempts))
+            added += result.rowcount
+    print("enqueued {} jobs".format(added))
+    return added
+
+
+def after_failure(attempts, max_attempts, retry_seconds):
+    """
+    what becomes of a job that failed on its attempts-th attempt
+    return: (status, seconds until it is available again): pending after retry_seconds times its
+            attempts, or failed for good once it used max_attempts
+    """
+    if attempts >= max_attempts:
+        return 'failed', 0
+    return 'pending', attempts * retry_seconds
+
+
+def after_lease_expired(attempts, max_attempts):
+    """
+    what becomes of a running job whose worker stopped renewing its lease: it stays running, for
+    another worker to claim, or fails for good if that was its last attempt
+    """
+    return 'failed' if attempts >= max_attempts else 'running'
+
+
+def claim(conn, worker, limit=50, lease_minutes=60):
+    """
+    claims the oldest available job and the other available jobs of its table and family, up to
+    limit, for worker. Running jobs whose lease expired on their last attempt are failed
+
+    return: (table_name, list of (job_id, feature_name)), or (None, []) if nothing is available
+    """
+    params = {'lease': lease_minutes, 'limit': limit, 'worker': worker}
+    with conn.begin() as connection:
+        expired = connection.execute("""
+                SELECT j.job_id, j.attempts, j.max_attempts FROM {jobs} j
+                WHERE j.status = 'running' AND j.claimed_at < now() - %(lease)s * interval '1 minute'
+                FOR UPDATE SKIP LOCKED
+                """.format(jobs=JOBS_TABLE), params).fetchall()
+        failed = [job_id for job_id, attempts, max_attempts in expired
+                  if after_lease_expired(attempts, max_attempts) == 'failed']
+        if failed:
+            connection.execute("""
+                    UPDATE {jobs} SET status = 'failed', finished_at = now(), last_error = 'lease expired'
+                    WHERE job_id IN %(job_ids)s
+                    """.format(jobs=JOBS_TABLE), {'job_ids': tuple(failed)})
+        rows = connection.execute("""
+                WITH first AS (
+                SELECT j.table_name, j.family FROM {jobs} j
+                WHERE {available}
+                ORDER BY j.job_id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+                ),
+                claimed AS (
+                SELECT j.job_id FROM {jobs} j
+                JOIN first f ON f.table_name = j.table_name AND f.family = j.family
+                WHERE {available}
+                ORDER BY j.job_id
+                LIMIT %(limit)s
+                FOR UPDATE OF j SKIP LOCKED
+                )
+                UPDATE {jobs} j
+                SET status = 'running', worker = %(worker)s, claimed_at = now(), attempts = j.attempts + 1
+                FROM claimed
+                WHERE j.job_id = claimed.job_id
+                RETURNING j.job_id, j.table_name, j.feature_name
+                """.format(jobs=JOBS_TABLE, available=_AVAILABLE), params).fetchall()
+    if not rows:
+        return None, []
+    return rows[0][1], sorted((job_id, feature) for job_id, _, feature in rows)
+
+
+# the jobs of a claim that are still the worker's: not reclaimed by another one after its lease expired
+_HELD = "job_id IN %(job_ids)s AND worker = %(worker)s AND status = 'running'"
+
+
+def renew(conn, job_ids, worker):
+    """
+    extends the lease of the jobs worker still holds to lease_minutes from now
+    return: number of jobs renewed
+    """
+    return conn.execute("UPDATE {jobs} SET claimed_at = now() WHERE {held}".format(jobs=JOBS_TABLE, held=_HELD),
+                        {'job_ids': tuple(job_ids), 'worker': worker}).rowcount
+
+
+@contextlib.contextmanager
+def renewing(conn, job_ids, worker, interval_seconds):
+    """renews the lease of the jobs every interval_seconds, on a thread, for as long as the context is open"""
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(interval_seconds):
+            try:
+                renew(conn, job_ids, worker)
+            except Exception:
+                # the next beat tries again; the lease only runs out if the database stays away
+                print(traceback.format_exc())
+    thread = threading.Thread(target=heartbeat, name='lease-{}'.format(worker))
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def finish(conn, job_ids, worker):
+    """
+    marks the jobs worker still holds done
+    return: number of jobs done
+    """
+    return conn.execute("""UPDATE {jobs} SET status = 'done', finished_at = now(), last_error = NULL
+                           WHERE {held}""".format(jobs=JOBS_TABLE, held=_HELD),
+                        {'job_ids': tuple(job_ids), 'worker': worker}).rowcount
+
+
+def fail(conn, job_ids, worker, error, retry_seconds=60):
+    """
+    puts the jobs worker still holds back or fails them for good, as after_failure() says
+    return: number of jobs put back or failed
+    """
+    with conn.begin() as connection:
+        held = connection.execute("SELECT job_id, attempts, max_attempts FROM {jobs} WHERE {held} FOR UPDATE".format(
+            jobs=JOBS_TABLE, held=_HELD), {'job_ids': tuple(job_ids), 'worker': worker}).fetchall()
+        for job_id, attempts, max_attempts in held:
+            status, delay = after_failure(attempts, max_attempts, retry_seconds)
+            connection.execute("""
+                    UPDATE {jobs}
+                    SET status = %(status)s, available_at = now() + %(delay)s * interval '1 second',
+                        finished_at = now(), last_error = %(error)s
+                    WHERE job_id = %(job_id)s
+                    """.format(jobs=JOBS_TABLE), {'status': status, 'delay': delay, 'error': error, 'job_id': job_id})
+    return len(held)
+
+
+def has_open_jobs(conn):
+    """whether any job is pending or running, i.e. might still become available"""
+    return conn.execute("SELECT EXISTS (SELECT 1 FROM {jobs} WHERE status IN ('pending', 'running'))".format(
+        jobs=JOBS_TABLE)).scalar()
+
+
+def table_lock(conn):
+    """
+    return: a DataLoader table_lock: holds the postgres advisory lock of a features table, on a
+            connection of its own, for as long as the context is open
+    """
+    @contextlib.contextmanager
+    def lock(table):
+        connection = conn.connect()
+        try:
+            connection.execute('SELECT pg_advisory_lock(%s, hashtext(%s))', (LOCK_NAMESPACE, table))
+            try:
+                yield
+            finally:
+                connection.execute('SELECT pg_advisory_unlock(%s, hashtext(%s))', (LOCK_NAMESPACE, table))
+        finally:
+            connection.close()
+    return lock
+
+
+def default_worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def work(conn, loader_options=None, phase_hooks=None, worker=None, limit=50, lease_minutes=60,
+         retry_seconds=60, poll_seconds=10, wait=False):
+    """
+    claims and builds jobs until none is left (or forever, polling every poll_seconds, with wait).
+    The lease of the jobs being built is renewed every quarter of lease_minutes
+
+    param loader_options: keyword arguments of the DataLoader building the jobs (batch_size,
+                          n_jobs, storage, ...), but phase_hooks
+    param phase_hooks: function returning the phase hooks of a DataLoader. Every claim gets new
+                       ones, since build_tables closes them
+    return: number of jobs done
+    """
+    worker = worker or default_worker_name()
+    loader_options = dict(loader_options or {})
+    if 'phase_hooks' in loader_options:
+        raise ValueError("pass a function returning the phase hooks as phase_hooks: build_tables closes them")
+    done = 0
+    while True:
+        table, jobs = claim(conn, worker, limit=limit, lease_minutes=lease_minutes)
+        if not jobs:
+            if not wait and not has_open_jobs(conn):
+                break
+            time.sleep(poll_seconds)
+            continue
+        job_ids = [job_id for job_id, _ in jobs]
+        features = [feature for _, feature in jobs]
+        print("worker {} building {} of {}".format(worker, ', '.join(features), table))
+        try:
+            with renewing(conn, job_ids, worker, lease_minutes * 15):
+                data = DataLoader(features, None, None, None, None, conn, table_lock=table_lock(conn),
+                                  phase_hooks=phase_hooks() if phase_hooks else None, **loader_options)
+                data.build_tables([table])
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            if fail(conn, job_ids, worker, error, retry_seconds=retry_seconds) < len(job_ids):
+                print("worker {} lost the lease of some of its jobs".format(worker))
+            continue
+        finished = finish(conn, job_ids, worker)
+        if finished < len(job_ids):
+            print("worker {} lost the lease of {} jobs, built again by another worker".format(
+                worker, len(job_ids) - finished))
+        done += finished
+    print("worker {} is done: {} jobs".format(worker, done))
+    return done
+
+
+def job_status(conn):
+    """return: dataframe of the number of jobs and attempts per table and status"""
+    return pd.read_sql_query("""
+            SELECT table_name, status, count(*) AS jobs, sum(attempts) AS attempts, max(finished_at) AS last_finished
+            FROM {jobs}
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+            """.format(jobs=JOBS_TABLE), conn)
@@ -0,0 +1,118 @@
+import datetime
+import json
+import random
+import re
+import string
+import threading
+import time
+import pandas as pd
+from sqlalchemy import event
+import bulkwriter
+
+'''
+Timing of the feature queries. While a FeatureRunRecorder is attached to the engine, every
+statement run by a feature (or fused group of features) being computed is timed and counted
+against it, on whatever connection and worker thread it runs. One row per computed group goes
+to training.feature_runs: wall time, DB time, statements, rows returned by postgres, bytes of
+the resulting frames and, optionally, the EXPLAIN (ANALYZE, BUFFERS) plan of every query.
+'''
+
+RUNS_TABLE = 'feature_runs'
+
+_COLUMN_TYPES = {'run_id': 'text', 'table_name': 'text', 'feature_name': 'text', 'features': 'integer',
+                 'started_at': 'timestamp without time zone', 'wall_seconds': 'double precision',
+                 'db_seconds': 'double precision', 'statements': 'integer', 'rows': 'bigint',
+                 'bytes': 'bigint', 'plans': 'text'}
+
+
+class FeatureRunRecorder(object):
+    '''
+    Records the feature runs of one build on an engine. measure() computes a group of features
+    and attributes the statements of the calling thread to it.
+
+    param explain: also run EXPLAIN (ANALYZE, BUFFERS) on every SELECT of a feature. This runs the
+                   query a second time, which is counted in wall time but not in DB time
+    '''
+
+    def __init__(self, engine, explain=False):
+        self.engine = engine
+        self.explain = explain
+        self.run_id = '{:%Y%m%d%H%M%S}_{}'.format(datetime.datetime.now(),
+                                                 ''.join(random.choice(string.ascii_lowercase) for _ in range(6)))
+        self.runs = []
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def measure(self, features, compute):
+        """
+        calls compute(), which computes the features, and records its run
+        return: what compute() returns, (feature, frame) pairs
+        """
+        run = {'run_id': self.run_id,
+               'table_name': ', '.join(sorted(set(feature.table_name for feature in features))),
+               'feature_name': ', '.join(sorted(set(feature.feature_col for feature in features))),
+               'features': len(features),
+               'started_at': datetime.datetime.now(),
+               'db_seconds': 0.0, 'statements': 0, 'rows': 0, 'bytes': 0, 'plans': []}
+        self._local.run = run
+        start = time.time()
+        try:
+            computed = compute()
+        finally:
+            self._local.run = None
+            run['wall_seconds'] = time.time() - start
+        run['bytes'] = int(sum(frame.memory_usage(deep=True).sum() for _, frame in computed))
+        run['plans'] = json.dumps(run['plans']) if run['plans'] else None
+        self.runs.append(run)
+        return computed
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, 'run', None) is not None:
+            conn.info.setdefault('feature_run_start', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        run = getattr(self._local, 'run', None)
+        if run is None or not conn.info.get('feature_run_start'):
+            return
+        run['db_seconds'] += time.time() - conn.info['feature_run_start'].pop()
+        run['statements'] += 1
+        if cursor.rowcount > 0:
+            run['rows'] += cursor.rowcount
+        if self.explain and re.match(r'\s*(SELECT|WITH)\b', statement, flags=re.IGNORECASE):
+            # a second cursor: the rows of this one haven't been fetched yet
+            with cursor.connection.cursor() as explain_cursor:
+                explain_cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement, parameters)
+                run['plans'].append({'statement': statement, 'plan': explain_cursor.fetchone()[0]})
+
+    def close(self):
+        """detaches from the engine and appends the recorded runs to training.feature_runs"""
+        event.remove(self.engine, 'before_cursor_execute', self._before_execute)
+        event.remove(self.engine, 'after_cursor_execute', self._after_execute)
+        if not self.runs:
+            return
+        runs = pd.DataFrame(self.runs, columns=list(_COLUMN_TYPES))
+        bulkwriter.write_frame(runs, RUNS_TABLE, self.engine, schema='training', if_exists='append',
+                               dtypes=_COLUMN_TYPES)
+        print("Recorded {} feature runs as run {}".format(len(runs), self.run_id))
+
+
+def slowest_features(conn, run_id=None, limit=20):
+    """
+    the slowest feature runs of a build, the latest one by default, next to the wall time of the
+    previous run of the same features on the same table, to spot plan regressions after a reload
+
+    return: dataframe sorted by wall time
+    """
+    return pd.read_sql_query("""
+            WITH runs AS (
+            SELECT *, lag(wall_seconds) OVER (PARTITION BY table_name, feature_name ORDER BY started_at) AS previous_wall_seconds
+            FROM training.feature_runs
+            )
+            SELECT table_name, feature_name, wall_seconds, previous_wall_seconds, db_seconds, statements, rows, bytes,
+                   plans IS NOT NULL AS has_plan
+            FROM runs
+            WHERE run_id = COALESCE(%(run_id)s, (SELECT run_id FROM training.feature_runs ORDER BY started_at DESC LIMIT 1))
+            ORDER BY wall_seconds DESC
+            LIMIT %(limit)s
+            """, conn, params={'run_id': run_id, 'limit': limit})
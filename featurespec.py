@@ -0,0 +1,107 @@
+import re
+from collections import OrderedDict
+
+
+class FeatureSpec(object):
+    '''
+    Declarative description of a per-student aggregate feature: an aggregate over the rows of a
+    source table up to the timeframe of the features table, optionally restricted to a filter and
+    to the last n_years, with a default for the students without any row.
+
+    param name: feature column
+    param source: schema qualified source table
+    param aggregate: SQL aggregate over the columns of source, e.g. 'count(distinct school_year)'.
+                     With a where or n_years, the compiler appends a FILTER clause to it, or puts
+                     one wherever an expression of several aggregate calls marks {filter}
+    param year_column: SQL expression of the year of a source row, compared to the timeframe
+    param where: SQL filter on the source rows, its parameters written %(name)s
+    param params: values of the parameters of where
+    param n_years: only aggregate the rows of the last n_years up to the timeframe
+    param default: value of the students without any row
+    param key: column joining source to training.mapping, student_key or person_id
+    param birthdate_column: SQL expression of the birthdate, for age tables. Without it the spec
+                            only builds year tables
+    '''
+
+    def __init__(self, name, source, aggregate, year_column, where=None, params=None, n_years=None,
+                 default=0, key='student_key', birthdate_column=None):
+        self.name = name
+        self.source = source
+        self.aggregate = aggregate
+        self.year_column = year_column
+        self.where = where
+        self.params = params or {}
+        self.n_years = n_years
+        self.default = default
+        self.key = key
+        self.birthdate_column = birthdate_column
+
+
+def compile_specs(specs, rf_type, timeframe):
+    """
+    compiles specs into the fewest queries: one per source table, join key and year column, where
+    every spec is a conditional aggregate (FILTER) of one scan of the source
+
+    return: list of (sql, params, specs) triples. Every query returns person_id and one column per spec
+    """
+    groups = OrderedDict()
+    for spec in specs:
+        groups.setdefault((spec.source, spec.key, spec.year_column, spec.birthdate_column), []).append(spec)
+
+    queries = []
+    for (source, key, year_column, birthdate_column), group in groups.items():
+        if rf_type == 'year':
+            as_of = year_column
+        elif birthdate_column is not None:
+            as_of = '{} - extract(year from {})'.format(year_column, birthdate_column)
+        else:
+            raise ValueError("{} can only be built for year tables".format(', '.join(spec.name for spec in group)))
+
+        params = {'timeframe': timeframe}
+        aggregates = []
+        columns = []
+        filters = []
+        for i, spec in enumerate(group):
+            conditions = []
+            if spec.where:
+                where = _namespace(spec.where, i)
+                conditions.append(where)
+                filters.append(where)
+                params.update(('s{}_{}'.format(i, name), value) for name, value in spec.params.items())
+            if spec.n_years is not None:
+                conditions.append('{} > %(timeframe)s - %(s{}_n_years)s'.format(as_of, i))
+                params['s{}_n_years'.format(i)] = spec.n_years
+            params['s{}_default'.format(i)] = spec.default
+            aggregate = spec.aggregate if '{filter}' in spec.aggregate else spec.aggregate + '{filter}'
+            clause = ' FILTER (WHERE {})'.format(' AND '.join(conditions)) if conditions else ''
+            aggregates.append('{} AS {}'.format(aggregate.replace('{filter}', clause), spec.name))
+            columns.append('COALESCE(agg.{name}, %(s{i}_default)s) AS {name}'.format(name=spec.name, i=i))
+
+        # one row per student: a person with several student keys has one aggregate by person_id
+        mapping = '(SELECT DISTINCT person_id FROM training.mapping)' if key == 'person_id' else 'training.mapping'
+
+        # rows no spec looks at are dropped before aggregating, unless one spec takes them all
+        prefilter = ''
+        if len(filters) == len(group):
+            prefilter = '\n                  AND ({})'.format(' OR '.join('({})'.format(where) for where in filters))
+        sql = """
+                WITH agg AS (
+                SELECT {key}, {aggregates}
+                FROM {source}
+                WHERE {as_of} <= %(timeframe)s{prefilter}
+                GROUP BY {key}
+                )
+                SELECT m.person_id, {columns}
+                FROM {mapping} m
+                LEFT JOIN agg ON agg.{key} = m.{key}
+                """.format(key=key, source=source, as_of=as_of, prefilter=prefilter, mapping=mapping,
+                           aggregates=',\n                       '.join(aggregates),
+                           columns=',\n                       '.join(columns))
+        queries.append((sql, params, group))
+    return queries
+
+
+def _namespace(where, i):
+    """prefixes the parameters of a spec's filter with its position in the query"""
+    return re.sub(r'%\((\w+)\)s', r'%(s{}_\1)s'.format(i), where)
+
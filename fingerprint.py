@@ -0,0 +1,138 @@
+import hashlib
+import inspect
+import json
+import re
+import pandas as pd
+import abstractfeature
+import featurespec
+import sourcecache
+from abstractfeature import AbstractFeature
+
+# tables of the training schema that are written by the features themselves, not read by them
+_OUTPUT_TABLES = ('training.feature_dictionary', 'training.is_student_relevant',
+                  'training.feature_fingerprints')
+
+# bump when a change outside the code hashed below changes the values of the features, so
+# every fingerprint changes and every feature is rebuilt
+CODE_VERSION = 1
+
+# features whose values changed since builds that recorded no fingerprint, with the types of
+# table (see abstractfeature.timeframe_of_table) they changed in. Their columns in such tables
+# are rebuilt instead of adopted: schools_per_student used to compare the collection year to the
+# age and was 0 for every student of an age table
+CHANGED_UNRECORDED = {'schools_per_student': ('age',)}
+
+# module level code the feature classes compute their values with: the fused, panel and spec
+# queries, the source reads of the pandas features and the conversion of what is written. Its
+# source is part of every fingerprint, like the code of the class
+SHARED_CODE = [abstractfeature.booleans_to_int, abstractfeature.compute_fused,
+               abstractfeature.timeframe_of_table, abstractfeature.panel_feature_frames,
+               abstractfeature.compute_panel, abstractfeature.update_batch_in_db, featurespec, sourcecache]
+
+
+def changed_unrecorded(feature, table):
+    """whether the unrecorded column of feature in table holds values its code no longer computes"""
+    return abstractfeature.timeframe_of_table(table)[0] in CHANGED_UNRECORDED.get(feature, ())
+
+
+def feature_classes(cls):
+    """the classes whose code defines feature class cls: cls and its bases below AbstractFeature"""
+    return [klass for klass in inspect.getmro(cls)
+            if issubclass(klass, AbstractFeature) and klass is not AbstractFeature]
+
+
+def source_tables(cls):
+    """
+    schema qualified names of the tables a feature class reads: its sources, or the source of
+    its spec and training.mapping, or else the tables named in its code and the code of its abstract bases, plus
+    edu_schema.<table> for the families with a table attribute
+    """
+    if cls.sources is not None:
+        return sorted(cls.sources)
+    if isinstance(getattr(cls, 'spec', None), featurespec.FeatureSpec):
+        # the compiled query joins the spec's source to training.mapping
+        return sorted(set([cls.spec.source, 'training.mapping']))
+    tables = set()
+    for klass in feature_classes(cls):
+        tables.update(re.findall(r'\b((?:edu_schema|cj_schema|training)\.[a-z_0-9]+)\b', inspect.getsource(klass)))
+    if getattr(cls, 'table', None):
+        tables.add('edu_schema.{}'.format(cls.table))
+    return sorted(table for table in tables if table not in _OUTPUT_TABLES)
+
+
+def source_table_stats(table, conn):
+    """
+    identity and write counters of a source table: its oid and relfilenode change whenever the
+    ETL drops and reloads or truncates it, the counters of pg_stat_user_tables whenever rows are
+    inserted, updated or deleted. Read from the statistics, without scanning the table. A writer's
+    counters show up a few seconds after it commits, at the latest when it disconnects; a reset of
+    the statistics changes them too, which only rebuilds features that were fresh
+    """
+    stats = pd.read_sql_query("""SELECT c.oid, c.relfilenode,
+                                        coalesce(s.n_tup_ins, 0) AS n_tup_ins,
+                                        coalesce(s.n_tup_upd, 0) AS n_tup_upd,
+                                        coalesce(s.n_tup_del, 0) AS n_tup_del
+                                 FROM pg_class c
+                                 LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                                 WHERE c.oid = to_regclass(%(table)s)""",
+                              conn, params={'table': table})
+    if stats.empty:
+        raise ValueError("source table {} does not exist".format(table))
+    return [int(value) for value in stats.iloc[0]]
+
+
+class FingerprintStore(object):
+    '''
+    Fingerprints of the features materialized in the training.features<...> tables, kept in
+    training.feature_fingerprints. A fingerprint hashes the code of the feature class, the
+    SHARED_CODE and CODE_VERSION, the timeframe of the table and the state of every source table
+    the class reads, so a feature whose fingerprint changed is stale and must be rebuilt.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self._stats = {}
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS training.feature_fingerprints (
+                                 table_name text,
+                                 feature_name text,
+                                 fingerprint text,
+                                 PRIMARY KEY (table_name, feature_name));""")
+
+    def compute(self, cls, table):
+        """
+        fingerprint of feature class cls built for the features table. Source table stats are
+        read once per store, so every feature of a run sees the same state
+        """
+        sources = {}
+        for source in source_tables(cls):
+            try:
+                sources[source] = self.source_stats(source)
+            except ValueError as error:
+                raise ValueError("can't fingerprint feature {}: {}".format(cls.__name__, error))
+        content = json.dumps({'code': [inspect.getsource(klass) for klass in feature_classes(cls)],
+                              'shared_code': [inspect.getsource(code) for code in SHARED_CODE],
+                              'code_version': CODE_VERSION,
+                              'timeframe': int(re.sub(r"\D", "", table)),
+                              'sources': sources}, sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def source_stats(self, source):
+        """source_table_stats() of a source table, read once per store"""
+        if source not in self._stats:
+            self._stats[source] = source_table_stats(source, self.conn)
+        return self._stats[source]
+
+    def load(self, table):
+        """return: dict of feature name -> recorded fingerprint for the features table"""
+        recorded = pd.read_sql_query("""SELECT feature_name, fingerprint FROM training.feature_fingerprints
+                                        WHERE table_name = %(table_name)s""",
+                                     self.conn, params={'table_name': table})
+        return dict(zip(recorded['feature_name'], recorded['fingerprint']))
+
+    def save(self, table, feature, fingerprint):
+        self.conn.execute("""DELETE FROM training.feature_fingerprints WHERE table_name = %s AND feature_name = %s;
+                             INSERT INTO training.feature_fingerprints VALUES (%s, %s, %s);""",
+                          (table, feature, table, feature, fingerprint))
+
+    def forget(self, table):
+        self.conn.execute("DELETE FROM training.feature_fingerprints WHERE table_name = %s", (table,))
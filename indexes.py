@@ -0,0 +1,205 @@
+import re
+from collections import Counter, OrderedDict
+import pandas as pd
+from sqlalchemy import event
+
+'''
+Indexes of the source and training tables. The ETL and the matching scripts bulk load every table
+without any, while every feature query joins them on student_key or person_id and filters on a
+year column. The indexes each table needs are declared here and built after the tables are
+(re)loaded; suggest_indexes() gives advice on the ones the feature SQL actually run still misses.
+'''
+
+# table -> columns of each of its indexes
+INDEXES = OrderedDict([
+    ('edu_schema.new_demographic', [('student_key',), ('year',)]),
+    ('edu_schema.demographic', [('student_key',), ('year',)]),
+    ('edu_schema.most_recent_demographics', [('student_key',)]),
+    ('edu_schema.enrollment', [('student_key',), ('year',)]),
+    ('edu_schema.attendance', [('student_key',), ('year',)]),
+    ('edu_schema.discipline', [('student_key',), ('year',)]),
+    ('edu_schema.discipline_with_year', [('student_key',), ('discipline_year',)]),
+    ('edu_schema.new_assessment', [('student_key',), ('test_year',)]),
+    ('edu_schema.new_assessment_with_date', [('student_key',), ('test_year',)]),
+    ('edu_schema.assessment', [('student_key',)]),
+    ('edu_schema.programs', [('student_id',)]),
+    ('cj_schema.juv_case_person_id', [('person_id',), ('inc_year',)]),
+    ('training.mapping', [('student_key',), ('person_id',)]),
+    ('training.labels', [('person_id',), ('first_year_interaction',)]),
+])
+
+# indexes of every training.features<...> table, which all the feature writes join on person_id
+FEATURES_TABLE_INDEXES = [('person_id',)]
+
+_SQL_KEYWORDS = set(['on', 'where', 'join', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'group',
+                     'order', 'limit', 'using', 'union', 'and', 'set', 'window', 'having'])
+
+
+def declared_indexes(table):
+    """return: the column tuples of the indexes declared for a schema qualified table"""
+    if re.match(r'training\.features', table):
+        return FEATURES_TABLE_INDEXES
+    return INDEXES.get(table, [])
+
+
+def index_name(table, columns):
+    """name of the index of columns on table, within postgres' 63 characters"""
+    return '{}_{}_idx'.format(table.split('.')[-1], '_'.join(columns))[:63]
+
+
+def create_indexes(engine, tables=None, concurrently=True):
+    """
+    builds the declared indexes missing from the tables that exist, then analyzes the tables that
+    got one. Concurrent builds don't block the readers and writers of the table, but can't run in
+    a transaction, so they go through a pooled connection in autocommit. An invalid index left by
+    a failed concurrent build is dropped and built again
+
+    param engine: sqlalchemy engine
+    param tables: schema qualified tables, all the declared ones by default
+    param concurrently: CREATE INDEX CONCURRENTLY. Plain builds are faster on tables nobody else uses yet
+    return: names of the indexes built
+    """
+    raw_connection = engine.raw_connection()
+    dbapi_connection = raw_connection.connection
+    dbapi_connection.autocommit = True
+    concurrent = ' CONCURRENTLY' if concurrently else ''
+    built = []
+    try:
+        with raw_connection.cursor() as cursor:
+            for table in (tables or list(INDEXES)):
+                cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+                if not cursor.fetchone()[0]:
+                    continue
+                schema = table.split('.')[0]
+                cursor.execute("""SELECT indexrelid::regclass::text FROM pg_index
+                                  WHERE indrelid = to_regclass(%s) AND NOT indisvalid""", (table,))
+                for (invalid,) in cursor.fetchall():
+                    cursor.execute('DROP INDEX{} IF EXISTS {}'.format(concurrent, invalid))
+                created = []
+                for columns in declared_indexes(table):
+                    name = index_name(table, columns)
+                    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", ('{}.{}'.format(schema, name),))
+                    if cursor.fetchone()[0]:
+                        continue
+                    print("creating index {} on {}".format(name, table))
+                    cursor.execute('CREATE INDEX{} IF NOT EXISTS {} ON {} ({})'.format(
+                        concurrent, name, table, ', '.join(columns)))
+                    created.append(name)
+                if created:
+                    cursor.execute('ANALYZE {}'.format(table))
+                built.extend(created)
+    finally:
+        dbapi_connection.autocommit = False
+        raw_connection.close()
+    return built
+
+
+def existing_indexes(conn, tables):
+    """return: dict of schema qualified table -> list of the column tuples of its valid indexes"""
+    indexes = pd.read_sql_query("""
+            SELECT i.indrelid::regclass::text AS table_name, i.indexrelid::regclass::text AS index_name,
+                   a.attname AS column_name, k.position
+            FROM pg_index i
+            CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, position)
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+            WHERE i.indisvalid AND i.indrelid IN (SELECT to_regclass(t) FROM unnest(%(tables)s) AS t)
+            ORDER BY 1, 2, 4
+            """, conn, params={'tables': list(tables)})
+    existing = dict((table, []) for table in tables)
+    for (table, _), columns in indexes.groupby(['table_name', 'index_name'], sort=False):
+        # regclass text drops the schema of the tables on the search_path
+        table = table if '.' in table else 'public.' + table
+        existing.setdefault(table, []).append(tuple(columns['column_name']))
+    return existing
+
+
+class StatementRecorder(object):
+    '''
+    Records the SQL statements run on an engine (and the connections checked out of it) while
+    it is active, for suggest_indexes():
+
+        with indexes.StatementRecorder(engine) as recorder:
+            data.build_tables(tables)
+        print(indexes.suggest_indexes(recorder.statements, engine))
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+
+def referenced_columns(statement):
+    """
+    (table, column) pairs a statement joins or filters on: the columns compared in its ON and
+    WHERE clauses, resolved through the aliases of the schema qualified tables it reads.
+    Unqualified columns are kept with table None
+    """
+    aliases = {}
+    for table, alias in re.findall(r'\b(?:FROM|JOIN)\s+((?:edu_schema|cj_schema|training)\.\w+)(?:\s+(?:AS\s+)?(\w+))?',
+                                   statement, flags=re.IGNORECASE):
+        aliases[table.split('.')[-1].lower()] = table.lower()
+        if alias and alias.lower() not in _SQL_KEYWORDS:
+            aliases[alias.lower()] = table.lower()
+    compared = r'(?:(\w+)\.)?(\w+)'
+    operator = r'\s*(?:=|<=|>=|<|>|\bIN\b|\bBETWEEN\b)\s*'
+    pairs = set()
+    for qualifier, column in (re.findall(compared + operator, statement, flags=re.IGNORECASE) +
+                              re.findall(operator + compared, statement, flags=re.IGNORECASE)):
+        if column.isdigit() or column.lower() in _SQL_KEYWORDS:
+            continue
+        if qualifier:
+            if qualifier.lower() in aliases:
+                pairs.add((aliases[qualifier.lower()], column.lower()))
+        else:
+            pairs.add((None, column.lower()))
+    return pairs, sorted(set(aliases.values()))
+
+
+def suggest_indexes(statements, conn):
+    """
+    indexes the statements could use that no existing index starts with: the columns of the source
+    and training tables they join or filter on, counted over the statements. Advisory only: the
+    columns are read out of the statement text with regexes, which miss the ones compared through
+    subqueries or expressions, and nothing checks the planner would use the index. Review a
+    suggestion before declaring it in INDEXES
+
+    return: dataframe of table, column, statements (number using the column) and declared
+            (whether INDEXES already has it, i.e. create_indexes() hasn't been run)
+    """
+    uses = Counter()
+    for statement in statements:
+        pairs, tables = referenced_columns(statement)
+        for table, column in pairs:
+            for candidate in ([table] if table else tables):
+                uses[(candidate, column)] += 1
+    if not uses:
+        return pd.DataFrame(columns=['table', 'column', 'statements', 'declared'])
+
+    tables = sorted(set(table for table, _ in uses))
+    columns = pd.read_sql_query("""
+            SELECT table_schema || '.' || table_name AS table_name, column_name
+            FROM information_schema.columns
+            WHERE table_schema || '.' || table_name IN %(tables)s
+            """, conn, params={'tables': tuple(tables)})
+    known = set(zip(columns['table_name'], columns['column_name']))
+    existing = existing_indexes(conn, tables)
+    suggestions = []
+    for (table, column), count in uses.items():
+        if (table, column) not in known:
+            continue
+        if any(index[0] == column for index in existing.get(table, [])):
+            continue
+        declared = any(index[0] == column for index in declared_indexes(table))
+        suggestions.append((table, column, count, declared))
+    suggestions = pd.DataFrame(suggestions, columns=['table', 'column', 'statements', 'declared'])
+    return suggestions.sort_values(['statements', 'table', 'column'], ascending=[False, True, True]).reset_index(drop=True)
@@ -3,6 +3,8 @@ import numpy as np
 import psycopg2
 import pandas.io.sql as pdsql
 from sqlalchemy import create_engine
+import bulkwriter
+import indexes
     
 def gen_label(conn):
     """
@@ -53,7 +55,7 @@ def gen_label(conn):
     print('Writing to database')
 
     # Write to database 
-    labels.to_sql('labels', con=conn, schema='training', if_exists = 'replace')
+    bulkwriter.write_frame(labels, 'labels', conn, schema='training', if_exists='replace', index=True)
     
     print('Finished writing labels')
     
@@ -116,6 +118,7 @@ def gen_label(conn):
     alter table training.labels_widerwindow rename to labels;'''
     
     conn.execute(sql_wide_window)
+    indexes.create_indexes(conn, ['training.labels'], concurrently=False)
 
 
 
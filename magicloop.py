@@ -20,6 +20,11 @@ import time
 import yaml
 import json
 import sys
+import scipy.sparse as sp
+import bulkwriter
+
+# estimators of define_clfs_params() that can't fit a scipy.sparse design matrix
+DENSE_ONLY = ('NB',)
 
 
 def define_clfs_params():
@@ -64,15 +69,18 @@ def clf_loop(config, clfs, grid, X_train, y_train,  X_test, y_test, feature_list
         for index,clf_factory in enumerate([clfs[x] for x in models_to_run]):
             print(models_to_run[index])
             parameter_values = grid[models_to_run[index]]
+            X_train_model, X_test_model = X_train, X_test
+            if models_to_run[index] in DENSE_ONLY and sp.issparse(X_train):
+                X_train_model, X_test_model = X_train.toarray(), X_test.toarray()
             for p in ParameterGrid(parameter_values):
                 try:
                     clf = clf_factory()
                     clf.set_params(**p)
                     print(clf)
                     if hasattr(clf, 'predict_proba'):
-                        y_pred_probs = clf.fit(X_train, y_train).predict_proba(X_test)[:,1]
+                        y_pred_probs = clf.fit(X_train_model, y_train).predict_proba(X_test_model)[:,1]
                     else:
-                        y_pred_probs = clf.fit(X_train, y_train).decision_function(X_test)
+                        y_pred_probs = clf.fit(X_train_model, y_train).decision_function(X_test_model)
                     #threshold = np.sort(y_pred_probs)[::-1][int(.05*len(y_pred_probs))]
                     #print threshold
                     recall = recall_at_k(y_test, y_pred_probs, k)
@@ -81,7 +89,7 @@ def clf_loop(config, clfs, grid, X_train, y_train,  X_test, y_test, feature_list
                     conf_mat = calc_confusion_matrix(y_test, y_pred_probs, k)
 
                     result = {"clf": clf, "recall": recall, "precision": precision, "auc": auc, "confusion_matrix": conf_mat}
-                    write_result_to_db(clf, config, result, X_train, X_test,y_train, y_test, feature_list, conn)
+                    write_result_to_db(clf, config, result, X_train_model, X_test_model,y_train, y_test, feature_list, conn)
 
                     plot_precision_recall_n(y_test, y_pred_probs, clf, config['output_plot'])
                 except IndexError as e:
@@ -115,7 +123,7 @@ def write_result_to_db(clf, config, result, X_train, X_test, y_train, y_test, fe
         the_id = id_df['id'][0]
         feature_importance_df['model_id'] = the_id
 
-    feature_importance_df.to_sql('feature_importance', conn, schema='training', if_exists = 'append', index = False )
+    bulkwriter.write_frame(feature_importance_df, 'feature_importance', conn, schema='training', if_exists='append')
 
 
 def plot_precision_recall_n(y_true, y_prob, model_name, config):
@@ -1,9 +1,10 @@
 from __future__ import print_function
 import json
 import sys
+import tracemalloc
 import psycopg2
 from sqlalchemy import create_engine
-from dataloader import DataLoader
+from dataloader import DataLoader, flatten
 import magicloop as ml
 import numpy as np
 import pandas as pd
@@ -13,6 +14,12 @@ import yaml
 import output
 import click
 import labels
+import indexes
+import featureruns
+import phasehooks
+import duckdbbackend
+import featurejobs
+import preprocessing as pp
 
 
 @click.group()
@@ -37,7 +44,7 @@ def model_command(credentials_file, config_file):
     conn = create_engine('postgresql://', connect_args=creds)
     clfs, grid = ml.define_clfs_params()
     X_train, y_train, X_test, y_test, train_set, test_set, keep_features = get_data(conn, config)
-    results = ml.clf_loop(config, clfs, grid, X_train, y_train, X_test, y_test, train_set[keep_features].columns, conn)
+    results = ml.clf_loop(config, clfs, grid, X_train, y_train, X_test, y_test, np.asarray(keep_features), conn)
 
 @cli.command('risk_scores')
 @click.argument('credentials_file')
@@ -60,6 +67,164 @@ def make_risk_scores(credentials_file, config_file, num_runs):
     for i in range(num_runs):
         output.gen_risk_score(X_train, y_train, X_test, test_set, i, config, conn)
         
+@cli.command('features')
+@click.argument('credentials_file')
+@click.argument('config_file')
+@click.option('--start-year', type=int, required=True, help="First as-of year to build a features table for.")
+@click.option('--end-year', type=int, required=True, help="Last as-of year to build a features table for.")
+@click.option('--suggest-indexes', is_flag=True, help="Print advice on the indexes the feature queries of the run could use.")
+def build_features(credentials_file, config_file, start_year, end_year, suggest_indexes):
+    """Build the features<year> tables of a range of years in one pass.
+
+    CREDENTIALS_FILE points to db credentials as json. CONFIG_FILE points to model configurations as yml.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    with open(config_file) as c:
+        config = yaml.load(c)
+
+    conn = create_engine('postgresql://', connect_args=creds)
+    data = DataLoader(config['features'], None, None, None, None, conn,
+                      batch_size=config.get('batch_size'), n_jobs=config.get('n_jobs', 1), panel=True,
+                      refresh=config.get('refresh', False), profile=config.get('profile', False),
+                      explain=config.get('explain', False), phase_hooks=_phase_hooks(config),
+                      backend=_backend(config), storage=config.get('storage', 'wide'))
+    tables = ['features{}'.format(year) for year in range(start_year, end_year + 1)]
+    if suggest_indexes:
+        # the recorder keeps every statement of the run in memory: only when it is asked for
+        with indexes.StatementRecorder(conn) as recorder:
+            data.build_tables(tables)
+        print(indexes.suggest_indexes(recorder.statements, conn).to_string(index=False))
+    else:
+        data.build_tables(tables)
+
+@cli.command('indexes')
+@click.argument('credentials_file')
+@click.option('--table', '-t', multiple=True, help="Schema qualified table to index. Every declared table by default.")
+def create_indexes(credentials_file, table):
+    """Build the indexes declared in indexes.py that are missing.
+
+    CREDENTIALS_FILE points to db credentials as json.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    conn = create_engine('postgresql://', connect_args=creds)
+    indexes.create_indexes(conn, list(table) or None)
+
+@cli.command('snapshot')
+@click.argument('credentials_file')
+@click.argument('directory')
+@click.option('--table', '-t', multiple=True, help="Schema qualified table to export. Every source table by default.")
+def export_snapshot(credentials_file, directory, table):
+    """Export the source tables to Parquet files in DIRECTORY, for duckdb_snapshot_dir.
+
+    CREDENTIALS_FILE points to db credentials as json.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    conn = create_engine('postgresql://', connect_args=creds)
+    duckdbbackend.export_snapshot(conn, directory, list(table) or None)
+
+@cli.command('enqueue')
+@click.argument('credentials_file')
+@click.argument('config_file')
+@click.option('--start-year', type=int, default=None, help="First as-of year to build a features table for.")
+@click.option('--end-year', type=int, default=None, help="Last as-of year to build a features table for.")
+@click.option('--table', '-t', multiple=True, help="Other features table to build, e.g. an age table.")
+@click.option('--max-attempts', type=int, default=3, help="Attempts of a job before it fails for good.")
+def enqueue_jobs(credentials_file, config_file, start_year, end_year, table, max_attempts):
+    """Queue a job per feature of CONFIG_FILE (yml) and features table, for the workers.
+
+    CREDENTIALS_FILE points to db credentials as json.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    with open(config_file) as c:
+        config = yaml.load(c)
+
+    tables = list(table)
+    if start_year is not None:
+        tables.extend('features{}'.format(year) for year in range(start_year, (end_year or start_year) + 1))
+    conn = create_engine('postgresql://', connect_args=creds)
+    featurejobs.enqueue(conn, tables, list(flatten(config['features'])), max_attempts=max_attempts)
+
+@cli.command('worker')
+@click.argument('credentials_file')
+@click.argument('config_file')
+@click.option('--name', default=None, help="Name of the worker in the jobs table. host:pid by default.")
+@click.option('--wait', is_flag=True, help="Keep polling for jobs instead of exiting once none is left.")
+@click.option('--lease-minutes', type=int, default=60, help="Minutes after which a running job is taken to be lost.")
+def run_worker(credentials_file, config_file, name, wait, lease_minutes):
+    """Claim and build queued feature jobs. Start as many as the database takes, on any node.
+
+    CREDENTIALS_FILE points to db credentials as json. CONFIG_FILE points to model configurations as yml.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    with open(config_file) as c:
+        config = yaml.load(c)
+
+    conn = create_engine('postgresql://', connect_args=creds)
+    featurejobs.work(conn, dict(batch_size=config.get('batch_size'), n_jobs=config.get('n_jobs', 1),
+                                refresh=config.get('refresh', False), profile=config.get('profile', False),
+                                explain=config.get('explain', False),
+                                backend=_backend(config), storage=config.get('storage', 'wide')),
+                     phase_hooks=lambda: _phase_hooks(config), worker=name, lease_minutes=lease_minutes,
+                     wait=wait)
+
+@cli.command('jobs')
+@click.argument('credentials_file')
+def report_jobs(credentials_file):
+    """Count the queued feature jobs per table and status.
+
+    CREDENTIALS_FILE points to db credentials as json.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    conn = create_engine('postgresql://', connect_args=creds)
+    print(featurejobs.job_status(conn).to_string(index=False))
+
+@cli.command('feature_runs')
+@click.argument('credentials_file')
+@click.option('--run-id', default=None, help="Run to report on. The latest one by default.")
+@click.option('--limit', '-n', type=int, default=20, help="Number of features to list.")
+def report_feature_runs(credentials_file, run_id, limit):
+    """List the slowest features of a profiled build.
+
+    CREDENTIALS_FILE points to db credentials as json.
+    """
+    with open(credentials_file) as f:
+        creds = json.load(f)
+
+    conn = create_engine('postgresql://', connect_args=creds)
+    print(featureruns.slowest_features(conn, run_id=run_id, limit=limit).to_string(index=False))
+
+def _phase_hooks(config):
+    """
+    the phase hooks the config asks for: a json lines log at phase_log, a printed summary with
+    phase_summary. phase_trace_memory traces the allocations, for the peak memory of every phase
+    """
+    hooks = []
+    if config.get('phase_trace_memory') and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if config.get('phase_log'):
+        hooks.append(phasehooks.JsonLinesSink(config['phase_log']))
+    if config.get('phase_summary'):
+        hooks.append(phasehooks.SummarySink())
+    return hooks
+
+def _backend(config):
+    """the embedded backend over the snapshot at duckdb_snapshot_dir, if the config has one"""
+    if config.get('duckdb_snapshot_dir'):
+        return duckdbbackend.open_snapshot(config['duckdb_snapshot_dir'], threads=config.get('duckdb_threads'))
+    return None
+
 def _does_label_exist_in_db(conn): 
     """check if labels table already exists, and if not, create it""" 
     sql_query = '''SELECT EXISTS (
@@ -83,7 +248,13 @@ def get_data(conn, config):
     if not _does_label_exist_in_db(conn):
         labels.gen_label(conn)
         
-    data = DataLoader(config['features'], config['train_table'], config['test_table'], config['train_label'], config['test_label'], conn)
+    data = DataLoader(config['features'], config['train_table'], config['test_table'], config['train_label'], config['test_label'], conn,
+                      batch_size=config.get('batch_size'), n_jobs=config.get('n_jobs', 1),
+                      panel=config.get('panel', False), refresh=config.get('refresh', False),
+                      local_cache_dir=config.get('local_cache_dir'), chunksize=config.get('chunksize'),
+                      sparse=config.get('sparse', False), profile=config.get('profile', False),
+                      explain=config.get('explain', False), phase_hooks=_phase_hooks(config),
+                      backend=_backend(config), storage=config.get('storage', 'wide'))
     label_set_train, label_set_test = data.load_label()
     feature_set_train, feature_set_test = data.load_data()
     train_set = pd.merge(feature_set_train, label_set_train, on = 'person_id')
@@ -96,12 +267,19 @@ def get_data(conn, config):
                                          config['test_label']]]
     sorted_columns = sorted(train_set.columns)
     train_set.sort(sorted_columns, inplace=True)
-    X_train = train_set[keep_features].values
-    y_train = train_set[config['train_label']]
-
     sorted_columns = sorted(test_set.columns)
     test_set.sort(sorted_columns, inplace=True)
-    X_test = test_set[keep_features].values
+
+    if data.sparse:
+        # categorical features are still raw columns: encode them straight into CSR matrices
+        numeric = [col_name for col_name in keep_features if col_name not in data.vocabulary]
+        X_train = pp.sparse_design_matrix(train_set, numeric, data.vocabulary)
+        X_test = pp.sparse_design_matrix(test_set, numeric, data.vocabulary)
+        keep_features = numeric + pp.dummy_names(data.vocabulary)
+    else:
+        X_train = pp.design_matrix(train_set, keep_features)
+        X_test = pp.design_matrix(test_set, keep_features)
+    y_train = train_set[config['train_label']]
     y_test = test_set[config['test_label']]
 
     print("Completed Data Loading")
@@ -2,3 +2,7 @@ CREATE TABLE cj_schema.juv_case_person_id as
   (SELECT a.*, b.pid from cj_schema.juv_case_complete_id a
     JOIN training.mapping b on a.person_id = b.person_id)
 with data;
+
+CREATE INDEX juv_case_person_id_person_id_idx ON cj_schema.juv_case_person_id (person_id);
+CREATE INDEX juv_case_person_id_inc_year_idx ON cj_schema.juv_case_person_id (inc_year);
+ANALYZE cj_schema.juv_case_person_id;
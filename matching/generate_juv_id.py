@@ -8,6 +8,8 @@ from sqlalchemy import create_engine
 import sys
 import json
 
+import bulkwriter
+
 with open(sys.argv[1]) as f:
 	creds = json.load(f)
 
@@ -51,7 +53,7 @@ match3df = match3df.rename(columns = {'firstname_cleaned_x':'firstname_cleaned'}
 juvenile_ids = pd.concat([juvenile_case_exact_id, juvenile_case_diff1d_id, match2df, match3df])
 
 # Write to DB
-juvenile_ids.to_sql('juv_case_complete_id', con=engine, schema='cj_schema')
+bulkwriter.write_frame(juvenile_ids, 'juv_case_complete_id', engine, schema='cj_schema', index=True)
 
 
 
@@ -7,6 +7,9 @@ import jellyfish
 from sqlalchemy import create_engine
 import sys
 
+import bulkwriter
+import indexes
+
 with open(sys.argv[1]) as f:
     creds = json.load(f)
 
@@ -57,4 +60,5 @@ match3df = match3df.rename(columns = {'firstname_clean_x':'firstname_clean'})
 
 mapping = pd.concat([unique_students, exact_match_juv_id_student_key, match2df, match3df, matched_df_diff1d]).drop_duplicates()
 
-mapping.to_sql('mapping', con=engine, schema='training')
+bulkwriter.write_frame(mapping, 'mapping', engine, schema='training', index=True)
+indexes.create_indexes(engine, ['training.mapping'], concurrently=False)
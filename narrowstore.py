@@ -0,0 +1,78 @@
+import hashlib
+import bulkwriter
+
+'''
+Narrow storage of the features tables. Every feature of features<...> gets its own table,
+training.<table>__<feature> (person_id, its primary key, and the feature column), written once
+with a COPY, and training.<table> becomes a view joining them to the students of training.mapping.
+Writing a feature never rewrites the others (no ALTER TABLE + UPDATE, so no bloat), and since every
+join is on a unique key, postgres leaves out of a read the tables of the features it doesn't select.
+'''
+
+# postgres truncates longer identifiers
+_MAX_NAME = 63
+
+
+def table_name(table, feature):
+    """name (in the training schema) of the narrow table of a feature of the features table"""
+    name = '{}__{}'.format(table, feature)
+    if len(name) <= _MAX_NAME:
+        return name
+    return '{}_{}'.format(name[:_MAX_NAME - 9], hashlib.md5(name.encode('utf-8')).hexdigest()[:8])
+
+
+def write(frame, table, feature, sql_type, conn):
+    """replaces the narrow table of a feature with its preprocessed frame (person_id, feature)"""
+    narrow = table_name(table, feature)
+    conn.execute("""
+            DROP TABLE IF EXISTS training.{narrow};
+            CREATE TABLE training.{narrow} (person_id integer PRIMARY KEY, {feature} {sql_type});
+            """.format(narrow=narrow, feature=feature, sql_type=sql_type))
+    bulkwriter.write_frame(frame[['person_id', feature]].dropna(subset=['person_id']), narrow, conn,
+                           schema='training', if_exists='append')
+    conn.execute('ANALYZE training.{};'.format(narrow))
+
+
+def drop(table, feature, conn):
+    """drops the narrow table of a feature, and with it the view of the features table"""
+    conn.execute('DROP TABLE IF EXISTS training.{} CASCADE;'.format(table_name(table, feature)))
+
+
+def _relkind(table, conn):
+    return conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+                        ('training.{}'.format(table),)).scalar()
+
+
+def create_view(table, features, conn):
+    """
+    (re)creates training.<table> as the view of person_id and the given features, from their
+    narrow tables
+
+    param features: the features stored narrow for the table
+    """
+    if _relkind(table, conn) not in (None, 'v'):
+        raise ValueError("training.{} is a wide features table: drop it to store its features narrow".format(table))
+    joins = ''.join("""
+              LEFT JOIN training.{narrow} f{i} ON f{i}.person_id = m.person_id""".format(
+        i=i, narrow=table_name(table, feature)) for i, feature in enumerate(features))
+    conn.execute("""
+            DROP VIEW IF EXISTS training.{table};
+            CREATE VIEW training.{table} AS
+              SELECT m.person_id{columns}
+              FROM training.mapping m{joins};
+            """.format(table=table, joins=joins,
+                       columns=''.join(', f{}.{}'.format(i, feature) for i, feature in enumerate(features))))
+
+
+def drop_all(table, conn):
+    """drops training.<table>, as a wide table or as the view and narrow tables of its features"""
+    relkind = _relkind(table, conn)
+    if relkind == 'r':
+        conn.execute('DROP TABLE training.{};'.format(table))
+        return
+    narrow = conn.execute("""SELECT tablename FROM pg_tables
+                             WHERE schemaname = 'training' AND tablename LIKE %s""",
+                          (table.replace('_', r'\_') + r'\_\_%',)).fetchall()
+    for (name,) in narrow:
+        conn.execute('DROP TABLE IF EXISTS training.{} CASCADE;'.format(name))
+    conn.execute('DROP VIEW IF EXISTS training.{};'.format(table))
@@ -3,7 +3,7 @@ from sklearn.linear_model import LogisticRegression
 import numpy as np
 import pandas as pd
 import random
-import abstractfeature
+import bulkwriter
 import sys, csv
 
 def gen_risk_score(X_train, y_train, X_test, test_set, i, config, conn):
@@ -23,7 +23,7 @@ def gen_risk_score(X_train, y_train, X_test, test_set, i, config, conn):
     table_name = 'temp_' + ''.join(random_string);
     #generate a csv file name that incidates the feature and label sets
     csv_file_name = 'riskscore_' + ''.join(random_string) + 'fea08-10labely0910y1112.csv';
-    abstractfeature.copy_to_sql(probas, table_name, conn)
+    bulkwriter.write_frame(probas, table_name, conn)
     print('copy table success')
     sql = """
         SELECT a.*, c.student_first_name, c.student_last_name, c.student_birthdate
@@ -0,0 +1,172 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+'''
+Hooks around the phases of building a feature: running its SQL (feature_code, or the fused and
+panel codes of a group), preprocessing, and writing it back (update_data_in_db,
+update_dictionary_in_db, or update_batch_in_db for a batch). Every phase calls before() and
+after() on the hooks of its features with the phase name, and after() gets its elapsed time, its
+memory use and the rows and bytes of the frames it produced or wrote.
+
+The memory of a phase is the change of the resident memory of the process over it, and, while
+tracemalloc is tracing (phase_trace_memory in the config), the peak of the memory allocated during
+it. Both are process wide: phases running at the same time on a worker pool (n_jobs > 1) count
+each other's allocations.
+'''
+
+
+class PhaseHook(object):
+    '''
+    Base of the phase hooks. features is the list of feature objects of the phase: one, unless
+    the phase computes or writes a fused group or a batch.
+    '''
+
+    def before(self, features, phase):
+        pass
+
+    def after(self, features, phase, stats):
+        """
+        param stats: dict of elapsed_seconds, rss_delta_bytes (the change of resident memory over
+                     the phase, None where /proc is missing), peak_bytes (peak memory allocated during
+                     the phase above its start, None unless tracemalloc is tracing), max_rss_bytes
+                     (the high-water mark of the process so far, None where resource is missing),
+                     rows and bytes of the phase's frames (0 for phases without any)
+        """
+        pass
+
+    def close(self):
+        """called at the end of the build"""
+        pass
+
+
+class JsonLinesSink(PhaseHook):
+    '''Appends one json object per finished phase to a file.'''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def after(self, features, phase, stats):
+        record = dict(stats, phase=phase,
+                      table_name=features[0].table_name,
+                      features=[feature.feature_col for feature in features],
+                      finished_at=time.time())
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class SummarySink(PhaseHook):
+    '''Collects the finished phases and prints their totals per phase at the end of the build.'''
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def after(self, features, phase, stats):
+        with self._lock:
+            self.records.append(dict(stats, phase=phase, features=len(features)))
+
+    def summary(self):
+        """return: dataframe of count, total, mean and max seconds, largest memory use, rows and bytes per phase"""
+        records = pd.DataFrame(self.records, columns=['phase', 'features', 'elapsed_seconds', 'rss_delta_bytes',
+                                                      'peak_bytes', 'rows', 'bytes'])
+        summary = records.groupby('phase').agg(calls=('elapsed_seconds', 'size'),
+                                               features=('features', 'sum'),
+                                               total_seconds=('elapsed_seconds', 'sum'),
+                                               mean_seconds=('elapsed_seconds', 'mean'),
+                                               max_seconds=('elapsed_seconds', 'max'),
+                                               max_rss_delta_bytes=('rss_delta_bytes', 'max'),
+                                               max_peak_bytes=('peak_bytes', 'max'),
+                                               rows=('rows', 'sum'),
+                                               bytes=('bytes', 'sum'))
+        return summary.sort_values('total_seconds', ascending=False)
+
+    def close(self):
+        if self.records:
+            print(self.summary().to_string())
+
+
+class PhaseResult(object):
+    '''What a phase hands to the after() hooks: set frames to the frame(s) it produced or wrote.'''
+
+    def __init__(self):
+        self.frames = None
+
+
+def max_rss_bytes():
+    """high-water mark of the resident memory of the process, None where the resource module is missing"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def rss_bytes():
+    """current resident memory of the process, None where /proc is missing"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _frames(frames):
+    if frames is None:
+        return []
+    if isinstance(frames, pd.DataFrame):
+        return [frames]
+    if isinstance(frames, dict):
+        return list(frames.values())
+    return list(frames)
+
+
+@contextlib.contextmanager
+def phase(features, name):
+    """
+    runs the body as the phase name of features, between the before() and after() calls of their
+    hooks. Without hooks it only yields the PhaseResult
+    """
+    result = PhaseResult()
+    hooks = features[0].phase_hooks
+    if not hooks:
+        yield result
+        return
+    for hook in hooks:
+        hook.before(features, name)
+    start = time.time()
+    start_rss = rss_bytes()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        start_traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    try:
+        yield result
+    finally:
+        # a phase that raises is still reported, with the frames it got to
+        end_rss = rss_bytes()
+        frames = _frames(result.frames)
+        stats = {'elapsed_seconds': time.time() - start,
+                 'rss_delta_bytes': None if start_rss is None or end_rss is None else end_rss - start_rss,
+                 'peak_bytes': tracemalloc.get_traced_memory()[1] - start_traced if tracing else None,
+                 'max_rss_bytes': max_rss_bytes(),
+                 'rows': int(sum(len(frame) for frame in frames)),
+                 'bytes': int(sum(frame.memory_usage(deep=True).sum() for frame in frames))}
+        for hook in hooks:
+            hook.after(features, name, stats)
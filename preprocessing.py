@@ -1,53 +1,231 @@
-import pandas as pd
-
-'''
-TODO: bunch of functions
-	  each works on a feature's column does some preprocessing in pandas
-	  returns entire dataframe with updated column
-	  the features get to decide which of the functions here they would like to invoke
-'''
-
-# def exampleprocessor(data,**kwargs):
-# 	'''
-# 	@param data: huge dataframe with all the data
-# 	@param kwargs: all kinds of more fun parameters you might need!
-# 	@return: modified version of data
-# 	'''
-# 	pass
-
-def get_dummies(data, columns = [], **kwargs):
-    #data.loc[data[columns].str.contains(' '), columns] = data[columns].str.replace(' ', '_')
-    #return pd.get_dummies(df['itemID'],prefix = 'itemID_').astype(np.int8)
-    return pd.get_dummies(data, columns = columns,**kwargs)
-
-
-def fill_null_with_mean(data, columns):
-    data = data.fillna(data.mean()[columns])
-    return data
-
-
-def fill_null_with_median(data, columns):
-    data = data.fillna(data.median()[columns])
-    return data
-
-def fill_null_with_default_value(data, columns, value):
-    data.loc[:, columns] = data[columns].fillna(value)
-    return data
-
-def dummy_code_null(data, columns):
-
-    for c in columns:
-        if data[c].isnull().sum() > 0:
-            data[c + '_isnull'] = (data[c].isnull()).astype(int)
-    
-    data.loc[:, columns] = data[columns].fillna(0)
-    return data
-
-
-def fill_null_with_zero(data, columns):
-    data.loc[:, columns] = data[columns].fillna(0)
-    return data
-
-
-if __name__=='__main__':
-    pass
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from collections import OrderedDict
+import bulkwriter
+
+'''
+TODO: bunch of functions
+	  each works on a feature's column does some preprocessing in pandas
+	  returns entire dataframe with updated column
+	  the features get to decide which of the functions here they would like to invoke
+'''
+
+# def exampleprocessor(data,**kwargs):
+# 	'''
+# 	@param data: huge dataframe with all the data
+# 	@param kwargs: all kinds of more fun parameters you might need!
+# 	@return: modified version of data
+# 	'''
+# 	pass
+
+def get_dummies(data, columns = [], **kwargs):
+    #data.loc[data[columns].str.contains(' '), columns] = data[columns].str.replace(' ', '_')
+    #return pd.get_dummies(df['itemID'],prefix = 'itemID_').astype(np.int8)
+    return pd.get_dummies(data, columns = columns,**kwargs)
+
+
+def plan_dtypes(data, feature_types):
+    """
+    compact dtype of every feature of data, from its feature_type in training.feature_dictionary:
+    booleans as uint8, categoricals as pandas categoricals, numerical features with whole values
+    as int16 or int32 when they fit and every other numerical feature as float32. Booleans with
+    NULLs are float32 too, since integer dtypes have no NULL
+    param feature_types: dict of column -> 'boolean', 'numerical' or 'categorical'
+    return: dict of column -> dtype
+    """
+    plan = {}
+    for column, feature_type in feature_types.items():
+        if column not in data:
+            continue
+        if feature_type == 'boolean':
+            plan[column] = np.float32 if data[column].isnull().any() else np.uint8
+        elif feature_type == 'categorical':
+            plan[column] = 'category'
+        elif feature_type == 'numerical':
+            values = data[column].values
+            plan[column] = np.float32
+            if len(values) and not pd.isnull(values).any() and (values == np.round(values)).all():
+                for dtype in (np.int16, np.int32):
+                    if values.min() >= np.iinfo(dtype).min and values.max() <= np.iinfo(dtype).max:
+                        plan[column] = dtype
+                        break
+    return plan
+
+
+def apply_dtypes(data, plan):
+    """casts the columns of data to the dtypes of a plan_dtypes() plan"""
+    for column, dtype in plan.items():
+        data[column] = data[column].astype(dtype)
+    return data
+
+
+def align_categories(frames, columns):
+    """gives the categorical columns of every frame the same categories, the union over all the
+    frames, so they stay categorical when the frames are concatenated
+    """
+    for column in columns:
+        categories = sorted(set(value for frame in frames for value in frame[column].cat.categories))
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return frames
+
+
+def common_dtype(data, columns):
+    """
+    narrowest dtype holding the values of every column of data: uint8 for booleans and dummies
+    only, int16 with int16 features, float32 once a float32 feature is in, and so on, as numpy
+    promotes them (int32 with float32 needs float64)
+    """
+    dtypes = [np.dtype(np.uint8) if data[column].dtype == bool else data[column].dtype for column in columns]
+    return np.result_type(*dtypes) if dtypes else np.dtype(np.float32)
+
+
+def design_matrix(data, columns, dtype=None):
+    """dense matrix of the columns of data, filled column by column into one array of dtype
+    instead of going through the common (often float64) dtype of .values. By default dtype is
+    common_dtype(), so the compact dtypes of plan_dtypes() carry through to the matrix
+    """
+    if dtype is None:
+        dtype = common_dtype(data, columns)
+    matrix = np.empty((len(data), len(columns)), dtype=dtype)
+    for position, column in enumerate(columns):
+        matrix[:, position] = data[column].values
+    return matrix
+
+
+def categorical_vocabulary(frames, columns):
+    """
+    the sorted values of every categorical column over all the frames (e.g. train and test), so
+    both are encoded with the same dummy columns
+    return: OrderedDict of column -> list of values
+    """
+    vocabulary = OrderedDict()
+    for column in columns:
+        values = set()
+        for frame in frames:
+            values.update(frame[column].dropna().unique())
+        vocabulary[column] = sorted(values)
+    return vocabulary
+
+
+def dummy_names(vocabulary):
+    """names of the dummy columns of a vocabulary, as get_dummies names them"""
+    return ['{}_{}'.format(column, value) for column, values in vocabulary.items() for value in values]
+
+
+def sparse_design_matrix(data, numeric, vocabulary):
+    """
+    CSR matrix of the numeric columns of data followed by the dummies of its categorical columns,
+    in the order of dummy_names(vocabulary). Values outside the vocabulary and NULLs get no dummy
+    """
+    blocks = [sp.csr_matrix(data[numeric].to_numpy(dtype=np.float32))]
+    rows = np.arange(len(data))
+    for column, values in vocabulary.items():
+        codes = pd.Categorical(np.asarray(data[column], dtype=object), categories=values).codes
+        present = codes >= 0
+        blocks.append(sp.csr_matrix((np.ones(present.sum(), dtype=np.float32), (rows[present], codes[present])),
+                                    shape=(len(data), len(values))))
+    return sp.hstack(blocks, format='csr')
+
+
+def fill_null_with_mean(data, columns):
+    data = data.fillna(data.mean()[columns])
+    return data
+
+
+def fill_null_with_median(data, columns):
+    data = data.fillna(data.median()[columns])
+    return data
+
+def fill_null_with_default_value(data, columns, value):
+    data.loc[:, columns] = data[columns].fillna(value)
+    return data
+
+def dummy_code_null(data, columns):
+
+    for c in columns:
+        if data[c].isnull().sum() > 0:
+            data[c + '_isnull'] = (data[c].isnull()).astype(int)
+    
+    data.loc[:, columns] = data[columns].fillna(0)
+    return data
+
+
+def fill_null_with_zero(data, columns):
+    data.loc[:, columns] = data[columns].fillna(0)
+    return data
+
+
+class MinMaxScaler(object):
+    '''
+    Scales numeric columns to [0, 1] as (x - min) / (max - min + 1e-4), in float32. The minimums
+    and ranges are fitted one column at a time, skipping NaNs like the min/max of pandas and SQL do,
+    and can be saved to training.feature_scaling under a dataset name and loaded back.
+    '''
+
+    def __init__(self, columns=None, minimums=None, ranges=None):
+        self.columns = list(columns) if columns is not None else None
+        self.minimums = np.asarray(minimums, dtype=np.float32) if minimums is not None else None
+        self.ranges = np.asarray(ranges, dtype=np.float32) if ranges is not None else None
+
+    @classmethod
+    def from_bounds(cls, columns, minimums, maximums):
+        """scaler of columns with known minimums and maximums, e.g. aggregated in SQL"""
+        minimums = np.asarray(minimums, dtype=np.float64)
+        return cls(columns, minimums, np.asarray(maximums, dtype=np.float64) - minimums + 1e-4)
+
+    def fit(self, data, columns):
+        """fits the columns of data one at a time, so that no float copy of all of them is made"""
+        bounds = [(np.nanmin(values), np.nanmax(values)) for values in
+                  (data[column].to_numpy(dtype=np.float64, na_value=np.nan) for column in columns)]
+        minimums = np.array([minimum for minimum, _ in bounds], dtype=np.float64)
+        self.columns = list(columns)
+        self.minimums = minimums.astype(np.float32)
+        self.ranges = (np.array([maximum for _, maximum in bounds], dtype=np.float64) - minimums + 1e-4).astype(np.float32)
+        return self
+
+    def transform_array(self, values, positions=None):
+        """
+        scales a float32 array whose columns are self.columns, in place
+        param positions: positions in self.columns of the columns of values, when it has only some
+        """
+        minimums, ranges = self.minimums, self.ranges
+        if positions is not None:
+            minimums, ranges = minimums[positions], ranges[positions]
+        values -= minimums
+        values /= ranges
+        return values
+
+    def transform(self, data):
+        """
+        scales the columns of data to float32 and assigns them back to data, one column at a time,
+        so that at most one column is copied at once instead of the whole block
+        """
+        for position, column in enumerate(self.columns):
+            values = data[column].to_numpy(dtype=np.float32, na_value=np.nan, copy=True).reshape(-1, 1)
+            data[column] = self.transform_array(values, [position])[:, 0]
+        return data
+
+    def save(self, conn, dataset):
+        conn.execute("""CREATE TABLE IF NOT EXISTS training.feature_scaling (
+                            dataset text, feature text, minimum double precision, range double precision);
+                        DELETE FROM training.feature_scaling WHERE dataset = %s""", (dataset,))
+        bulkwriter.write_frame(pd.DataFrame({'dataset': dataset,
+                                             'feature': self.columns,
+                                             'minimum': self.minimums.astype(np.float64),
+                                             'range': self.ranges.astype(np.float64)},
+                                            columns=['dataset', 'feature', 'minimum', 'range']),
+                               'feature_scaling', conn, schema='training', if_exists='append')
+
+    @classmethod
+    def load(cls, conn, dataset):
+        params = pd.read_sql_query("""SELECT feature, minimum, range FROM training.feature_scaling
+                                      WHERE dataset = %(dataset)s""", conn, params={'dataset': dataset})
+        if params.empty:
+            raise ValueError("No scaling parameters saved for {}".format(dataset))
+        return cls(params['feature'], params['minimum'], params['range'])
+
+
+if __name__=='__main__':
+    pass
@@ -0,0 +1,15 @@
+from setuptools import setup
+
+# the modules are imported flat, as main.py does. Installing them (pip install -e .) lets the
+# scripts of etl/, matching/, baseline/ and benchmark/ import them from their own directories
+setup(
+    name='milwaukee-datashare',
+    version='0.1',
+    description='Risk scores of juvenile justice involvement for Milwaukee Public Schools students',
+    py_modules=['abstractfeature', 'bulkwriter', 'catalog', 'cohort', 'dataloader', 'duckdbbackend',
+                'feature_generator', 'featurecache', 'featurejobs', 'featureruns', 'featurespec',
+                'fingerprint', 'indexes', 'labels', 'magicloop', 'narrowstore', 'output', 'phasehooks',
+                'preprocessing', 'sourcecache', 'studentpanel'],
+    install_requires=['numpy', 'scipy', 'pandas', 'scikit-learn', 'psycopg2', 'sqlalchemy<2.0', 'jellyfish',
+                      'click', 'pyyaml', 'matplotlib', 'csvkit', 'xlrd'],
+)
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+# Base tables read in full by the pandas-based features. Each one is loaded once per run with
+# only these columns, with dates parsed and the derived columns the features need computed up front.
+SOURCE_TABLES = {
+    'edu_schema.discipline': {
+        'columns': ['student_key', 'discipline_start_date', 'discipline_days',
+                    'discipline_fed_offense_group', 'discipline_offense_type'],
+        'parse_dates': ['discipline_start_date'],
+        'dtypes': {'discipline_days': 'float64',
+                   'discipline_fed_offense_group': 'category',
+                   'discipline_offense_type': 'category'},
+        'derived': {'discipline_year': lambda df: df['discipline_start_date'].dt.year},
+    },
+    'edu_schema.demographic': {
+        'columns': ['student_key', 'student_birthdate', 'year'],
+        'parse_dates': ['student_birthdate'],
+        'dtypes': {},
+        'derived': {'birth_year': lambda df: df['student_birthdate'].dt.year},
+    },
+    'training.mapping': {
+        'columns': ['person_id', 'student_key'],
+        'parse_dates': [],
+        'dtypes': {},
+        'derived': {},
+    },
+}
+
+
+def read_table(table, conn):
+    """
+    reads one of the SOURCE_TABLES from the database with its typed columns
+
+    param table: schema qualified table name, a key of SOURCE_TABLES
+    param conn: connection
+    """
+    spec = SOURCE_TABLES[table]
+    frame = pd.read_sql_query("SELECT {columns} FROM {table}".format(
+        columns=', '.join(spec['columns']), table=table), conn, parse_dates=spec['parse_dates'])
+    for column, dtype in spec['dtypes'].items():
+        frame[column] = frame[column].astype(dtype)
+    for column, derive in spec['derived'].items():
+        frame[column] = derive(frame)
+    return frame
+
+
+class SourceCache(object):
+    '''
+    Run-scoped cache of the SOURCE_TABLES, shared by every feature built in one DataLoader run.
+    Tables are loaded on first use and evicted least recently used first once the cached frames
+    take more than max_bytes.
+    '''
+
+    def __init__(self, conn, max_bytes=2 * 1024 ** 3):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._table_locks = dict((table, threading.Lock()) for table in SOURCE_TABLES)
+
+    @property
+    def nbytes(self):
+        return sum(self._sizes.values())
+
+    def get(self, table):
+        """
+        returns the cached frame of table. The frame is a shallow copy: callers may add, drop or
+        replace columns, but must not modify the values in place, since they are shared with
+        every other feature of the run.
+        """
+        with self._table_locks[table]:
+            with self._lock:
+                frame = self._frames.get(table)
+                if frame is not None:
+                    self._frames.move_to_end(table)
+            if frame is None:
+                frame = read_table(table, self.conn)
+                self._store(table, frame)
+        return frame.copy(deep=False)
+
+    def _store(self, table, frame):
+        size = int(frame.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            print("WARNING: {} takes {} bytes, more than the whole cache. Not caching it".format(table, size))
+            return
+        with self._lock:
+            while self._frames and self.nbytes + size > self.max_bytes:
+                evicted, _ = self._frames.popitem(last=False)
+                del self._sizes[evicted]
+                print("Evicted {} from the source cache".format(evicted))
+            self._frames[table] = frame
+            self._sizes[table] = size
+        print("Cached {} ({} bytes, {} bytes in cache)".format(table, size, self.nbytes))
+
+    def evict(self, table):
+        with self._lock:
+            self._frames.pop(table, None)
+            self._sizes.pop(table, None)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._sizes.clear()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+from collections import OrderedDict
+
+'''
+training.student_year_panel: one row per (person_id, year) with the yearly roll-ups of the source
+tables the as-of features aggregate. A feature built for features<year> then sums or extremes the
+rows of a student up to that year (or over its last n years) instead of scanning and re-joining
+the raw event tables to training.mapping. The panel has students x active years rows.
+'''
+
+PANEL_TABLE = 'training.student_year_panel'
+
+# discipline offense groups rolled up by the panel -> prefix of their columns
+OFFENSE_GROUPS = OrderedDict([('Learning Environment', 'learning_environment'),
+                              ('Weapons', 'weapons'),
+                              ('Personal/Physical Safety', 'physical_safety')])
+
+
+def _discipline_columns():
+    columns = []
+    for group, prefix in OFFENSE_GROUPS.items():
+        condition = " FILTER (WHERE a.discipline_fed_offense_group = '{}')".format(group)
+        columns.extend([('{}_incidents'.format(prefix), 'count(a.discipline_days)' + condition, 0),
+                        ('{}_days'.format(prefix), 'sum(a.discipline_days)' + condition, 0),
+                        ('{}_days_sq'.format(prefix), 'sum(a.discipline_days * a.discipline_days)' + condition, 0),
+                        ('{}_days_max'.format(prefix), 'max(a.discipline_days)' + condition, None),
+                        ('{}_days_min'.format(prefix), 'min(a.discipline_days)' + condition, None)])
+    return columns
+
+
+# (source table, column joining it to training.mapping, year of a row, [(column, yearly aggregate,
+# value of the years without rows, None keeps NULL)])
+ROLLUPS = [('edu_schema.enrollment', 'student_key', 'a.year',
+            [('enroll_records', 'count(*)', 0),
+             ('enroll_school_years', 'count(distinct a.school_year)', 0)]),
+           ('edu_schema.demographic', 'student_key', 'a.year',
+            [('demo_records', 'count(*)', 0),
+             ('demo_school_years', 'count(distinct a.school_year)', 0)]),
+           ('edu_schema.discipline_with_year', 'student_key', 'a.discipline_year', _discipline_columns()),
+           ('cj_schema.juv_case_person_id', 'person_id', 'a.inc_year',
+            [('chips_records', 'count(a.chips)', 0)])]
+
+
+def columns():
+    """return: the roll-up columns of the panel, next to person_id and year"""
+    return [column for _, _, _, rollup in ROLLUPS for column, _, _ in rollup]
+
+
+def offense_group_columns(offense_groups):
+    """
+    return: the column prefixes of the offense groups the panel rolls up, in panel order. Groups it
+    doesn't know have no incidents in the data (e.g. 'foo', which pads one-group tuples)
+    """
+    return [prefix for group, prefix in OFFENSE_GROUPS.items() if group in offense_groups]
+
+
+def source_tables():
+    return sorted(set([source for source, _, _, _ in ROLLUPS] + ['training.mapping']))
+
+
+def panel_query():
+    """
+    the SELECT of the panel: every source rolled up per person_id and year, outer joined on the
+    (person_id, year) pairs that have a row in any of them
+    """
+    rollups = []
+    selected = []
+    for i, (source, key, year_column, rollup) in enumerate(ROLLUPS):
+        rollups.append("""r{i} AS (
+                SELECT m.person_id, CAST({year_column} AS integer) AS year, {aggregates}
+                FROM {source} a
+                JOIN training.mapping m ON m.{key} = a.{key}
+                WHERE {year_column} IS NOT NULL
+                GROUP BY 1, 2
+                )""".format(i=i, year_column=year_column, source=source, key=key,
+                            aggregates=', '.join('{} AS {}'.format(aggregate, column)
+                                                 for column, aggregate, _ in rollup)))
+        for column, _, default in rollup:
+            if default is None:
+                selected.append('r{}.{}'.format(i, column))
+            else:
+                selected.append('COALESCE(r{i}.{column}, {default}) AS {column}'.format(i=i, column=column,
+                                                                                      default=default))
+    return """
+                WITH {rollups}
+                SELECT person_id, year, {selected}
+                FROM ({student_years}) AS student_years
+                {joins}""".format(rollups=',\n                '.join(rollups),
+                                  selected=',\n                       '.join(selected),
+                                  student_years=' UNION '.join('SELECT person_id, year FROM r{}'.format(i)
+                                                               for i in range(len(ROLLUPS))),
+                                  joins='\n                '.join('LEFT JOIN r{} USING (person_id, year)'.format(i)
+                                                                 for i in range(len(ROLLUPS))))
+
+
+def build(conn):
+    """(re)creates the panel, keyed and indexed for the per-student range aggregates over it"""
+    print("building {}".format(PANEL_TABLE))
+    conn.execute("""
+            DROP TABLE IF EXISTS {table};
+            CREATE TABLE {table} AS {query};
+            ALTER TABLE {table} ADD PRIMARY KEY (person_id, year);
+            CREATE INDEX ON {table} (year);
+            ANALYZE {table};
+            """.format(table=PANEL_TABLE, query=panel_query()))
+
+
+def fingerprint(store):
+    """
+    fingerprint of the panel: its query and the state of its source tables, read through store
+    (a fingerprint.FingerprintStore), so a reload of any source rebuilds it
+    """
+    content = json.dumps({'query': panel_query(),
+                          'sources': dict((source, store.source_stats(source)) for source in source_tables())},
+                         sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
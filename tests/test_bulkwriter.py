@@ -0,0 +1,145 @@
+import datetime
+import io
+import struct
+import numpy as np
+import pandas as pd
+import bulkwriter
+
+_EPOCH = datetime.datetime(2000, 1, 1)
+
+_DECODE = {'smallint': lambda data: struct.unpack('>h', data)[0],
+           'integer': lambda data: struct.unpack('>i', data)[0],
+           'bigint': lambda data: struct.unpack('>q', data)[0],
+           'real': lambda data: struct.unpack('>f', data)[0],
+           'double precision': lambda data: struct.unpack('>d', data)[0],
+           'boolean': lambda data: struct.unpack('?', data)[0],
+           'date': lambda data: (_EPOCH + datetime.timedelta(days=struct.unpack('>i', data)[0])).date(),
+           'timestamp without time zone':
+               lambda data: _EPOCH + datetime.timedelta(microseconds=struct.unpack('>q', data)[0]),
+           'text': lambda data: data.decode('utf-8')}
+
+
+def decode(buf, types):
+    """the rows of a PGCOPY buffer, NULLs as None, read the way postgres reads them"""
+    data = buf.getvalue()
+    assert data[:11] == b'PGCOPY\n\xff\r\n\x00'
+    position = 19
+    rows = []
+    while True:
+        count, = struct.unpack('>h', data[position:position + 2])
+        position += 2
+        if count == -1:
+            break
+        assert count == len(types)
+        row = []
+        for pg_type in types:
+            length, = struct.unpack('>i', data[position:position + 4])
+            position += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(_DECODE[pg_type](data[position:position + length]))
+            position += length
+        rows.append(tuple(row))
+    assert position == len(data)
+    return rows
+
+
+def _frame():
+    return pd.DataFrame({'person_id': np.array([1, 2, 3], dtype=np.int64),
+                         'days': np.array([3, 0, 7], dtype=np.int16),
+                         'score': np.array([0.5, np.nan, 2.25], dtype=np.float64),
+                         'flag': [True, False, None],
+                         'school': ['A', None, 'tab\tand "quotes"'],
+                         'day': [datetime.date(2012, 9, 1), None, datetime.date(1999, 12, 31)],
+                         'at': pd.to_datetime(['2012-09-01 08:30', None, '2013-01-02 00:00'])},
+                        columns=['person_id', 'days', 'score', 'flag', 'school', 'day', 'at'])
+
+
+def test_types_of_the_columns():
+    assert [bulkwriter.sql_type(_frame()[column]) for column in _frame().columns] == \
+        ['bigint', 'smallint', 'double precision', 'boolean', 'text', 'date', 'timestamp without time zone']
+
+
+def test_rows_with_nulls_round_trip():
+    frame = _frame()
+    types = [bulkwriter.sql_type(frame[column]) for column in frame.columns]
+    assert decode(bulkwriter.encode(frame, types), types) == [
+        (1, 3, 0.5, True, 'A', datetime.date(2012, 9, 1), datetime.datetime(2012, 9, 1, 8, 30)),
+        # NaN is written as NULL, like to_sql does
+        (2, 0, None, False, None, None, None),
+        (3, 7, 2.25, None, 'tab\tand "quotes"', datetime.date(1999, 12, 31), datetime.datetime(2013, 1, 2))]
+
+
+def test_fixed_width_rows_round_trip():
+    frame = pd.DataFrame({'person_id': np.arange(4, dtype=np.int32),
+                          'value': np.array([0.5, -1.0, 3.0, 1e6], dtype=np.float32),
+                          'flag': np.array([1, 0, 1, 1], dtype=np.uint8)})
+    types = ['integer', 'real', 'smallint']
+    assert decode(bulkwriter.encode(frame, types), types) == [(0, 0.5, 1), (1, -1.0, 0), (2, 3.0, 1), (3, 1e6, 1)]
+
+
+def test_text_rows_escape_and_mark_nulls():
+    frame = pd.DataFrame({'amount': [1.5, np.nan], 'note': ['a\tb\\c\nd', None],
+                          'at': pd.to_datetime(['2012-09-01 08:30', '2013-01-02 00:00'])})
+    assert bulkwriter.encode_text(frame).getvalue().decode('utf-8') == \
+        '1.5\ta\\tb\\\\c\\nd\t2012-09-01 08:30:00\n\\N\t\\N\t2013-01-02 00:00:00\n'
+
+
+class _Cursor(object):
+    def __init__(self, existing):
+        self.existing = existing
+        self.statements = []
+        self.copied = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def fetchall(self):
+        return list(self.existing.items())
+
+    def copy_expert(self, sql, buf):
+        self.copied = (sql, buf.getvalue())
+
+
+class _Engine(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.committed = False
+
+    def raw_connection(self):
+        return self
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.committed = True
+
+    def close(self):
+        pass
+
+
+def test_appending_to_columns_binary_copy_can_not_write_falls_back_to_text():
+    cursor = _Cursor({'person_id': 'integer', 'amount': 'numeric', 'code': 'character varying'})
+    frame = pd.DataFrame({'person_id': [1, 2], 'amount': [1.25, np.nan], 'code': ['x', 'y']})
+    bulkwriter.write_frame(frame, 'scores', _Engine(cursor), schema='training', if_exists='append')
+    sql, data = cursor.copied
+    assert sql == 'COPY training.scores ("person_id", "amount", "code") FROM STDIN WITH (FORMAT text)'
+    assert data == b'1\t1.25\tx\n2\t\\N\ty\n'
+
+
+def test_appending_to_columns_it_can_write_stays_binary():
+    cursor = _Cursor({'person_id': 'integer', 'code': 'character varying'})
+    frame = pd.DataFrame({'person_id': np.array([1, 2], dtype=np.int64), 'code': ['x', None]})
+    bulkwriter.write_frame(frame, 'scores', _Engine(cursor), schema='training', if_exists='append')
+    sql, data = cursor.copied
+    assert sql.endswith('WITH (FORMAT binary)')
+    # written as the types of the existing columns
+    assert decode(io.BytesIO(data), ['integer', 'text']) == [(1, 'x'), (2, None)]
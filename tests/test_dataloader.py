@@ -0,0 +1,157 @@
+import pytest
+import phasehooks
+from dataloader import DataLoader
+
+
+class _Hook(phasehooks.PhaseHook):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_build_tables_closes_the_hooks_when_it_raises():
+    hook = _Hook()
+    # no database: the build raises as soon as it reads the catalog
+    data = DataLoader(['num_chips_records'], None, None, None, None, None, refresh=False,
+                      source_cache_bytes=0, phase_hooks=[hook])
+    with pytest.raises(Exception):
+        data.build_tables(['features2012'])
+    assert hook.closed
+
+
+class _Fingerprints(object):
+    def __init__(self, recorded):
+        self.recorded = recorded
+        self.saved = {}
+
+    def load(self, table):
+        return dict(self.recorded)
+
+    def compute(self, cls, table):
+        return 'new'
+
+    def save(self, table, feature, fingerprint):
+        self.saved[feature] = fingerprint
+
+
+class _Catalog(object):
+    def __init__(self, features):
+        self.features = set(features)
+
+    def has_feature(self, feature, table):
+        return feature in self.features
+
+    def drop_feature(self, feature, table):
+        self.features.discard(feature)
+
+
+class _Conn(object):
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, *args):
+        self.statements.append(sql)
+
+
+def test_features_without_a_fingerprint_are_adopted_not_rebuilt():
+    conn = _Conn()
+    data = DataLoader(['num_chips_records', 'schools_per_student', 'demo_records_per_year'],
+                      None, None, None, None, conn, refresh=True)
+    data.fingerprints = _Fingerprints({'schools_per_student': 'old'})
+    data.catalog = _Catalog(['num_chips_records', 'schools_per_student'])
+    data._drop_stale_features('features2012')
+    # written before fingerprints were kept: recorded as it is
+    assert data.fingerprints.saved == {'num_chips_records': 'new'}
+    assert data.catalog.features == {'num_chips_records'}
+    assert conn.statements == ['ALTER TABLE training.features2012 DROP COLUMN schools_per_student;']
+
+
+
+def test_unrecorded_columns_whose_values_changed_are_rebuilt():
+    conn = _Conn()
+    data = DataLoader(['num_chips_records', 'schools_per_student'], None, None, None, None, conn, refresh=True)
+    data.fingerprints = _Fingerprints({})
+    data.catalog = _Catalog(['num_chips_records', 'schools_per_student'])
+    data._drop_stale_features('features15')
+    assert data.fingerprints.saved == {'num_chips_records': 'new'}
+    assert conn.statements == ['ALTER TABLE training.features15 DROP COLUMN schools_per_student;']
+
+    # its values only changed in the age tables
+    data.catalog = _Catalog(['schools_per_student'])
+    data._drop_stale_features('features2012')
+    assert data.fingerprints.saved == {'num_chips_records': 'new', 'schools_per_student': 'new'}
+    assert len(conn.statements) == 1
+
+def _features_database():
+    """a duckdb database with train and test features tables, their cohorts and the dictionary"""
+    duckdb = pytest.importorskip('duckdb')
+    import duckdbbackend
+    connection = duckdb.connect()
+    connection.execute('CREATE SCHEMA training')
+    connection.execute("""CREATE TABLE training.feature_dictionary AS
+                          SELECT * FROM (VALUES ('days', 'numerical'), ('score', 'numerical'),
+                                                ('flag', 'boolean'), ('school', 'categorical'))
+                                        AS t(feature_name, feature_type)""")
+    rows = {'features2012': """(1, 3, 0.5, 1, 'A'), (2, 0, NULL, 0, 'B'), (3, 7, 2.5, 1, NULL),
+                               (4, 1, 1.0, 0, 'A'), (5, 2, 4.0, 1, 'B')""",
+            # C is a school of the test table only
+            'features2013': "(6, 9, 3.0, 0, 'C'), (7, 4, NULL, 1, 'A'), (8, 5, 0.0, 0, NULL)"}
+    for table, values in rows.items():
+        connection.execute("""CREATE TABLE training.{} AS SELECT * FROM (VALUES {})
+                              AS t(person_id, days, score, flag, school)""".format(table, values))
+        connection.execute('CREATE TABLE training.cohort_{0} AS SELECT person_id FROM training.{0}'.format(table))
+    return duckdbbackend.DuckDBConnection(connection)
+
+
+def _load(conn, monkeypatch, chunksize):
+    import catalog
+    import preprocessing
+    data = DataLoader(['days', 'score', 'flag', 'school'], 'features2012', 'features2013', None, None, conn,
+                      chunksize=chunksize)
+    monkeypatch.setattr(data, 'build_tables', lambda tables: setattr(data, 'catalog', catalog.FeatureCatalog(conn)))
+    monkeypatch.setattr(preprocessing.MinMaxScaler, 'save', lambda self, conn, dataset: None)
+    if chunksize:
+        # the server-side cursor of Postgres, as slices of the whole read
+        def read_chunks(table, columns):
+            frame = data._read_columns(table, columns).sort_values('person_id')
+            for start in range(0, len(frame), chunksize):
+                yield frame.iloc[start:start + chunksize]
+        monkeypatch.setattr(data, '_read_chunks', read_chunks)
+    return data.load_data()
+
+
+def test_streamed_load_matches_the_plain_one(monkeypatch):
+    import numpy as np
+    conn = _features_database()
+    plain = _load(conn, monkeypatch, None)
+    streamed = _load(conn, monkeypatch, 2)
+    for plain_frame, streamed_frame in zip(plain, streamed):
+        assert sorted(plain_frame.columns) == sorted(streamed_frame.columns)
+        assert 'school_C' in streamed_frame.columns
+        plain_frame = plain_frame.sort_values('person_id').reset_index(drop=True)[streamed_frame.columns]
+        streamed_frame = streamed_frame.sort_values('person_id').reset_index(drop=True)
+        assert np.allclose(plain_frame.to_numpy(dtype=np.float64), streamed_frame.to_numpy(dtype=np.float64),
+                           equal_nan=True, atol=1e-6)
+
+
+def test_dtype_plan_keeps_the_values_of_the_plain_read():
+    import numpy as np
+    import pandas as pd
+    import preprocessing as pp
+    conn = _features_database()
+    frames = [pd.read_sql('SELECT * FROM training.{}'.format(table), conn) for table in ('features2012', 'features2013')]
+    types = {'days': 'numerical', 'score': 'numerical', 'flag': 'boolean', 'school': 'categorical'}
+    planned = [pp.apply_dtypes(frame.copy(), pp.plan_dtypes(frame, types)) for frame in frames]
+    assert planned[0]['days'].dtype == np.int16
+    assert planned[0]['score'].dtype == np.float32
+    assert planned[0]['flag'].dtype == np.uint8
+    pp.align_categories(planned, ['school'])
+    assert list(planned[0]['school'].cat.categories) == ['A', 'B', 'C']
+    for frame, compact in zip(frames, planned):
+        for column in ('days', 'score', 'flag'):
+            assert np.allclose(frame[column].astype(float), compact[column].astype(float), equal_nan=True)
+        values = lambda column: [value if pd.notnull(value) else None for value in column]
+        assert values(frame['school']) == values(compact['school'])
+    # categories survive the concatenation of train and test
+    assert pd.concat(planned)['school'].dtype.name == 'category'
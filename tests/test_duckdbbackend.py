@@ -0,0 +1,179 @@
+import datetime
+import decimal
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import abstractfeature
+import duckdbbackend
+import feature_generator
+import studentpanel
+
+duckdb = pytest.importorskip('duckdb')
+
+
+def test_literal_adapts_like_psycopg2():
+    assert duckdbbackend.literal(None) == 'NULL'
+    assert duckdbbackend.literal(True) == 'TRUE'
+    assert duckdbbackend.literal(np.bool_(False)) == 'FALSE'
+    assert duckdbbackend.literal(12) == '12'
+    assert duckdbbackend.literal(np.int64(7)) == '7'
+    assert duckdbbackend.literal(0.5) == '0.5'
+    assert duckdbbackend.literal(float('nan')) == "CAST('nan' AS DOUBLE)"
+    assert duckdbbackend.literal(datetime.date(2012, 9, 1)) == "DATE '2012-09-01'"
+    assert duckdbbackend.literal(datetime.datetime(2012, 9, 1, 8, 30)) == "TIMESTAMP '2012-09-01 08:30:00'"
+    assert duckdbbackend.literal("O'Brien") == "'O''Brien'"
+    assert duckdbbackend.literal(('Weapons', 'foo')) == "('Weapons', 'foo')"
+    assert duckdbbackend.literal([1, 2]) == '[1, 2]'
+    with pytest.raises(TypeError):
+        duckdbbackend.literal(object())
+
+
+def test_translate_inlines_named_parameters():
+    sql = duckdbbackend.translate('SELECT * FROM t WHERE year <= %(timeframe)s AND g IN %(groups)s',
+                                  {'timeframe': 2012, 'groups': ('Weapons',)})
+    assert sql == "SELECT * FROM t WHERE year <= 2012 AND g IN ('Weapons')"
+
+
+def test_translate_inlines_positional_parameters_and_unescapes_percent():
+    sql = duckdbbackend.translate("SELECT %s, %s WHERE name LIKE 'a%%'", ('x', None))
+    assert sql == "SELECT 'x', NULL WHERE name LIKE 'a%'"
+
+
+def test_translate_leaves_sql_without_parameters_alone():
+    assert duckdbbackend.translate("SELECT 'a%%'") == "SELECT 'a%%'"
+
+
+def _write(directory, table, sql):
+    connection = duckdb.connect()
+    connection.execute("COPY ({}) TO '{}' (FORMAT PARQUET)".format(
+        sql, os.path.join(str(directory), table + duckdbbackend.SNAPSHOT_SUFFIX)))
+    connection.close()
+
+
+def _snapshot(directory, chips=("'x'", 'NULL'), relfilenode=1):
+    _write(directory, 'training.mapping',
+           'SELECT * FROM (VALUES (1, 10), (2, 20), (3, 30)) AS t(person_id, student_key)')
+    _write(directory, 'edu_schema.new_demographic', """
+           SELECT student_key, CAST(collection_date AS DATE) AS collection_date, countable_school_name,
+                  CAST(student_birthdate AS DATE) AS student_birthdate
+           FROM (VALUES (10, '2011-09-20', 'A', '2000-05-01'), (10, '2012-01-20', 'B', '2000-05-01'),
+                        (10, '2013-09-20', 'C', '2000-05-01'), (20, '2012-09-20', 'A', '2001-02-03'))
+                AS t(student_key, collection_date, countable_school_name, student_birthdate)""")
+    # the ETL takes the year of a row from its school year
+    _write(directory, 'edu_schema.demographic', """
+           SELECT * FROM (VALUES (10, 2011, '2011-12'), (10, 2011, '2011-12'), (10, 2012, '2012-13'),
+                                 (20, 2010, '2010-11')) AS t(student_key, year, school_year)""")
+    _write(directory, 'edu_schema.enrollment',
+           "SELECT * FROM (VALUES (10, 2012, '2012-13')) AS t(student_key, year, school_year)")
+    _write(directory, 'edu_schema.discipline_with_year', """
+           SELECT student_key, discipline_year, CAST(discipline_days AS DOUBLE) AS discipline_days,
+                  discipline_fed_offense_group
+           FROM (VALUES (10, 2011, 3, 'Weapons'), (10, 2012, 1, 'Learning Environment'), (10, 2013, 5, 'Weapons'))
+                AS t(student_key, discipline_year, discipline_days, discipline_fed_offense_group)""")
+    _write(directory, 'cj_schema.juv_case_person_id', """
+           SELECT person_id, inc_year, chips
+           FROM (VALUES (1, 2011, {}), (1, 2012, {}), (2, 2014, 'y')) AS t(person_id, inc_year, chips)""".format(*chips))
+    tables = [path[:-len(duckdbbackend.SNAPSHOT_SUFFIX)] for path in os.listdir(str(directory))]
+    with open(os.path.join(str(directory), duckdbbackend.MANIFEST), 'w') as f:
+        json.dump(dict((table, [1, relfilenode, 3, 0, 0]) for table in tables), f)
+
+
+
+def test_export_types_the_snapshot_after_the_postgres_columns(tmp_path, monkeypatch):
+    columns = pd.DataFrame({'column_name': ['student_key', 'score', 'collection_date', 'grade', 'school'],
+                            'data_type': ['integer', 'numeric', 'date', 'smallint', 'USER-DEFINED']})
+    # chunks as psycopg2 and pandas hand them out: Decimals and dates as objects, NULL integers as NaN
+    chunks = [pd.DataFrame({'student_key': [10, 20], 'score': [decimal.Decimal('1.25'), None],
+                            'collection_date': [datetime.date(2012, 9, 20), datetime.date(2013, 1, 2)],
+                            'grade': [9.0, np.nan], 'school': ['A', 'B']}),
+              pd.DataFrame({'student_key': [30], 'score': [decimal.Decimal('-3')], 'collection_date': [None],
+                            'grade': [12.0], 'school': [None]})]
+
+    def read_sql_query(sql, conn, params=None, chunksize=None):
+        if 'information_schema.columns' in sql:
+            return columns if params['table'] == 'edu_schema.new_demographic' else columns.iloc[:0]
+        return iter(chunks)
+
+    monkeypatch.setattr(duckdbbackend.pd, 'read_sql_query', read_sql_query)
+    monkeypatch.setattr(duckdbbackend.fingerprint, 'source_table_stats', lambda table, conn: [1, 2, 3, 0, 0])
+    exported = duckdbbackend.export_snapshot(None, str(tmp_path), ['edu_schema.new_demographic', 'edu_schema.missing'])
+    assert exported == ['edu_schema.new_demographic']
+    assert duckdbbackend.read_manifest(str(tmp_path)) == {'edu_schema.new_demographic': [1, 2, 3, 0, 0]}
+
+    connection = duckdb.connect()
+    path = os.path.join(str(tmp_path), 'edu_schema.new_demographic' + duckdbbackend.SNAPSHOT_SUFFIX)
+    types = connection.execute("DESCRIBE SELECT * FROM read_parquet('{}')".format(path)).fetchall()
+    assert [row[:2] for row in types] == [('student_key', 'INTEGER'), ('score', 'DOUBLE'), ('collection_date', 'DATE'),
+                                         ('grade', 'SMALLINT'), ('school', 'VARCHAR')]
+    assert connection.execute("SELECT * FROM read_parquet('{}') ORDER BY student_key".format(path)).fetchall() == \
+        [(10, 1.25, datetime.date(2012, 9, 20), 9, 'A'), (20, None, datetime.date(2013, 1, 2), None, 'B'),
+         (30, -3.0, None, 12, None)]
+
+def test_features_on_a_parquet_snapshot(tmp_path):
+    _snapshot(tmp_path)
+    conn = duckdbbackend.open_snapshot(str(tmp_path))
+    data = duckdbbackend.compute_features(['schools_per_student', 'demo_records_per_year', 'num_chips_records',
+                                           'num_discipline_last_2_years', 'max_discipline_per_year'],
+                                          'features2012', conn)
+    data = data.set_index('person_id').sort_index()
+    assert data['schools_per_student'].tolist() == [2, 1, 0]
+    assert data['demo_records_per_year'].tolist() == [1.5, 1.0, 0.0]
+    assert data['num_chips_records'].tolist() == [1, 0, 0]
+    assert data['num_discipline_last_2_years'].tolist() == [2, 0, 0]
+    assert data['max_discipline_per_year'].tolist() == [3.0, 0.0, 0.0]
+
+
+def test_panel_frames_have_a_row_per_person_and_keep_old_events(tmp_path):
+    _snapshot(tmp_path)
+    # person 1 has two student keys, and person 2 an incident long before the years built
+    _write(tmp_path, 'training.mapping',
+           'SELECT * FROM (VALUES (1, 10), (1, 11), (2, 20), (3, 30)) AS t(person_id, student_key)')
+    _write(tmp_path, 'edu_schema.discipline_with_year', """
+           SELECT student_key, discipline_year, CAST(discipline_days AS DOUBLE) AS discipline_days,
+                  discipline_fed_offense_group
+           FROM (VALUES (10, 2011, 3, 'Weapons'), (11, 2012, 4, 'Weapons'), (20, 2003, 7, 'Weapons'))
+                AS t(student_key, discipline_year, discipline_days, discipline_fed_offense_group)""")
+    conn = duckdbbackend.open_snapshot(str(tmp_path))
+    conn.build_panel()
+    names = ['max_discipline_per_year', 'num_discipline_last_2_years', 'sum_discipline_last_year']
+    features = [getattr(feature_generator, name)('features{}'.format(year), conn)
+                for name in names for year in (2012, 2013)]
+    frames = abstractfeature.compute_panel(features)
+    for feature, frame in frames:
+        assert frame['person_id'].is_unique
+    values = dict(((feature.table_name, feature.feature_col), dict(frame.values)) for feature, frame in frames)
+    assert values[('features2012', 'max_discipline_per_year')] == {1: 4.0, 2: 7.0, 3: 0.0}
+    assert values[('features2012', 'num_discipline_last_2_years')] == {1: 2, 2: 0, 3: 0}
+    assert values[('features2013', 'sum_discipline_last_year')] == {1: 0.0, 2: 0.0, 3: 0.0}
+    # the per table spec query agrees
+    for feature, frame in frames:
+        data = feature.compute()
+        assert data['person_id'].is_unique
+        assert dict(data[['person_id', feature.feature_col]].values) == values[(feature.table_name, feature.feature_col)]
+
+
+def test_panel_is_rebuilt_after_a_new_export(tmp_path):
+    snapshot = tmp_path / 'snapshot'
+    snapshot.mkdir()
+    database = str(tmp_path / 'panel.duckdb')
+    _snapshot(snapshot)
+    conn = duckdbbackend.open_snapshot(str(snapshot), database=database)
+    conn.build_panel()
+    assert conn.execute('SELECT sum(chips_records) FROM {}'.format(studentpanel.PANEL_TABLE)).scalar() == 2
+    conn.close()
+
+    _snapshot(snapshot, chips=("'x'", "'z'"), relfilenode=2)
+    conn = duckdbbackend.open_snapshot(str(snapshot), database=database)
+    conn.build_panel()
+    assert conn.execute('SELECT sum(chips_records) FROM {}'.format(studentpanel.PANEL_TABLE)).scalar() == 3
+    conn.close()
+
+
+def test_stale_tables_compares_the_manifest(tmp_path):
+    _snapshot(tmp_path)
+    conn = duckdbbackend.open_snapshot(str(tmp_path))
+    live = {'training.mapping': [1, 1, 3, 0, 0], 'edu_schema.demographic': [1, 2, 3, 0, 0]}
+    assert conn.stale_tables(['training.mapping', 'edu_schema.demographic', 'edu_schema.programs'],
+                             live.get) == ['edu_schema.demographic']
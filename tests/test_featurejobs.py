@@ -0,0 +1,293 @@
+import contextlib
+import multiprocessing
+import os
+import time
+import pytest
+from sqlalchemy import create_engine
+import featurejobs
+import phasehooks
+
+DATABASE_URL = os.environ.get('FEATURE_TEST_DATABASE_URL')
+
+SPECS = ['schools_per_student', 'num_chips_records', 'demo_records_per_year']
+DISCIPLINE = ['num_discipline_last_year', 'max_discipline_per_year']
+
+
+def test_failed_jobs_back_off_by_attempt_until_the_last_one():
+    assert featurejobs.after_failure(1, 3, 60) == ('pending', 60)
+    assert featurejobs.after_failure(2, 3, 60) == ('pending', 120)
+    assert featurejobs.after_failure(3, 3, 60) == ('failed', 0)
+    assert featurejobs.after_failure(1, 1, 60) == ('failed', 0)
+
+
+def test_expired_leases_are_claimable_until_the_last_attempt():
+    assert featurejobs.after_lease_expired(1, 3) == 'running'
+    assert featurejobs.after_lease_expired(3, 3) == 'failed'
+
+
+class _Result(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+
+class _Connection(object):
+    '''Stands in for the engine: answers the statements returning rows in turn, records the others.'''
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.updates = []
+
+    @contextlib.contextmanager
+    def begin(self):
+        yield self
+
+    def execute(self, sql, params=None):
+        if sql.strip().startswith('SELECT') or 'RETURNING' in sql:
+            return _Result(self.answers.pop(0))
+        self.updates.append(params)
+        return _Result([])
+
+
+def test_fail_applies_the_transition_of_every_held_job():
+    connection = _Connection([(1, 1, 3), (2, 3, 3)])
+    assert featurejobs.fail(connection, [1, 2, 3], 'a', 'boom', retry_seconds=10) == 2
+    assert [(update['job_id'], update['status'], update['delay']) for update in connection.updates] == \
+        [(1, 'pending', 10), (2, 'failed', 0)]
+    assert set(update['error'] for update in connection.updates) == {'boom'}
+
+
+def test_claim_fails_the_expired_jobs_on_their_last_attempt():
+    # the jobs whose lease expired, then none available
+    connection = _Connection([(1, 1, 3), (2, 3, 3)], [])
+    assert featurejobs.claim(connection, 'a') == (None, [])
+    assert connection.updates == [{'job_ids': (2,)}]
+
+
+@pytest.fixture
+def conn():
+    if not DATABASE_URL:
+        pytest.skip('FEATURE_TEST_DATABASE_URL is not set')
+    engine = create_engine(DATABASE_URL)
+    engine.execute('CREATE SCHEMA IF NOT EXISTS training')
+    engine.execute('DROP TABLE IF EXISTS {}'.format(featurejobs.JOBS_TABLE))
+    yield engine
+    engine.dispose()
+
+
+def _jobs(conn):
+    return dict((row[0], row[1:]) for row in conn.execute(
+        'SELECT feature_name, status, attempts, worker FROM {}'.format(featurejobs.JOBS_TABLE)))
+
+
+def test_enqueue_skips_open_jobs(conn):
+    assert featurejobs.enqueue(conn, ['features2012'], SPECS + DISCIPLINE) == 5
+    assert featurejobs.enqueue(conn, ['features2012', 'features2013'], SPECS) == 3
+
+
+def test_claim_takes_one_family_and_skips_locked_jobs(conn):
+    featurejobs.enqueue(conn, ['features2012'], SPECS + DISCIPLINE)
+    table, jobs = featurejobs.claim(conn, 'a')
+    assert table == 'features2012'
+    assert sorted(feature for _, feature in jobs) == sorted(SPECS)
+
+    featurejobs.fail(conn, [job_id for job_id, _ in jobs], 'a', 'error', retry_seconds=0)
+    with conn.begin() as connection:
+        # another worker's claim, still in its transaction
+        connection.execute("SELECT 1 FROM {} WHERE feature_name IN %(features)s FOR UPDATE".format(
+            featurejobs.JOBS_TABLE), {'features': tuple(SPECS)})
+        table, jobs = featurejobs.claim(conn, 'b')
+        assert sorted(feature for _, feature in jobs) == sorted(DISCIPLINE)
+
+
+def test_failed_jobs_back_off_then_fail_for_good(conn):
+    featurejobs.enqueue(conn, ['features2012'], ['num_chips_records'], max_attempts=2)
+    _, jobs = featurejobs.claim(conn, 'a')
+    assert featurejobs.fail(conn, [jobs[0][0]], 'a', 'error', retry_seconds=3600) == 1
+    assert featurejobs.claim(conn, 'a') == (None, [])
+    assert _jobs(conn)['num_chips_records'][:2] == ('pending', 1)
+
+    conn.execute("UPDATE {} SET available_at = now()".format(featurejobs.JOBS_TABLE))
+    _, jobs = featurejobs.claim(conn, 'a')
+    featurejobs.fail(conn, [jobs[0][0]], 'a', 'error', retry_seconds=0)
+    assert _jobs(conn)['num_chips_records'][:2] == ('failed', 2)
+    assert featurejobs.claim(conn, 'a') == (None, [])
+    assert not featurejobs.has_open_jobs(conn)
+
+
+def test_renewed_lease_keeps_jobs_and_expired_one_loses_them(conn):
+    featurejobs.enqueue(conn, ['features2012'], ['num_chips_records'])
+    lease_minutes = 0.02
+    _, jobs = featurejobs.claim(conn, 'a', lease_minutes=lease_minutes)
+    job_ids = [job_id for job_id, _ in jobs]
+    with featurejobs.renewing(conn, job_ids, 'a', 0.2):
+        time.sleep(2)
+        assert featurejobs.claim(conn, 'b', lease_minutes=lease_minutes) == (None, [])
+
+    time.sleep(2)
+    _, jobs = featurejobs.claim(conn, 'b', lease_minutes=lease_minutes)
+    assert [job_id for job_id, _ in jobs] == job_ids
+    # the late worker can neither renew, finish nor fail the job
+    assert featurejobs.renew(conn, job_ids, 'a') == 0
+    assert featurejobs.finish(conn, job_ids, 'a') == 0
+    assert featurejobs.fail(conn, job_ids, 'a', 'error') == 0
+    assert featurejobs.finish(conn, job_ids, 'b') == 1
+    assert _jobs(conn)['num_chips_records'] == ('done', 2, 'b')
+
+
+def test_expired_lease_on_the_last_attempt_fails_the_job(conn):
+    featurejobs.enqueue(conn, ['features2012'], ['num_chips_records'], max_attempts=1)
+    featurejobs.claim(conn, 'a', lease_minutes=0.01)
+    time.sleep(1)
+    assert featurejobs.claim(conn, 'b', lease_minutes=0.01) == (None, [])
+    assert _jobs(conn)['num_chips_records'][0] == 'failed'
+
+
+class _Loader(object):
+    '''Stands in for the DataLoader of work(): closes its hooks like build_tables does.'''
+    loaders = []
+
+    def __init__(self, features, *args, **kwargs):
+        self.features = features
+        self.phase_hooks = kwargs['phase_hooks']
+        _Loader.loaders.append(self)
+
+    def build_tables(self, tables):
+        for hook in self.phase_hooks:
+            assert not hook.closed
+            hook.close()
+        if 'max_discipline_per_year' in self.features:
+            raise RuntimeError('discipline is down')
+
+
+class _Hook(phasehooks.PhaseHook):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class _Queue(object):
+    '''The jobs of the queue in memory, moved by the transitions of featurejobs.'''
+
+    def __init__(self, features, max_attempts=3):
+        self.jobs = dict((job_id, {'feature': feature, 'family': featurejobs.family(feature), 'status': 'pending',
+                                   'attempts': 0, 'max_attempts': max_attempts})
+                         for job_id, feature in enumerate(features, 1))
+
+    def claim(self, conn, worker, limit=50, lease_minutes=60):
+        available = [job_id for job_id, job in sorted(self.jobs.items()) if job['status'] == 'pending']
+        if not available:
+            return None, []
+        family = self.jobs[available[0]]['family']
+        claimed = [job_id for job_id in available if self.jobs[job_id]['family'] == family][:limit]
+        for job_id in claimed:
+            self.jobs[job_id].update(status='running', attempts=self.jobs[job_id]['attempts'] + 1)
+        return 'features2012', [(job_id, self.jobs[job_id]['feature']) for job_id in claimed]
+
+    def finish(self, conn, job_ids, worker):
+        for job_id in job_ids:
+            self.jobs[job_id]['status'] = 'done'
+        return len(job_ids)
+
+    def fail(self, conn, job_ids, worker, error, retry_seconds=60):
+        for job_id in job_ids:
+            job = self.jobs[job_id]
+            job['status'], _ = featurejobs.after_failure(job['attempts'], job['max_attempts'], retry_seconds)
+        return len(job_ids)
+
+    def has_open_jobs(self, conn):
+        return any(job['status'] in ('pending', 'running') for job in self.jobs.values())
+
+    def states(self, features):
+        return set((job['status'], job['attempts']) for job in self.jobs.values() if job['feature'] in features)
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = _Queue(SPECS + DISCIPLINE)
+    for name in ('claim', 'finish', 'fail', 'has_open_jobs'):
+        monkeypatch.setattr(featurejobs, name, getattr(queue, name))
+    monkeypatch.setattr(featurejobs, 'renewing', lambda conn, job_ids, worker, interval: contextlib.suppress())
+    monkeypatch.setattr(featurejobs, 'table_lock', lambda conn: None)
+    monkeypatch.setattr(featurejobs, 'DataLoader', _Loader)
+    _Loader.loaders = []
+    return queue
+
+
+def test_work_retries_a_failing_family_until_its_last_attempt(queue):
+    assert featurejobs.work(None, phase_hooks=lambda: [_Hook()], worker='a', retry_seconds=0, poll_seconds=0) == 3
+    # the specs once, the discipline family on each of its 3 attempts, every claim with new hooks
+    assert len(_Loader.loaders) == 4
+    assert len(set(id(loader.phase_hooks[0]) for loader in _Loader.loaders)) == 4
+    assert queue.states(SPECS) == {('done', 1)}
+    assert queue.states(DISCIPLINE) == {('failed', 3)}
+
+
+def test_work_gives_every_claim_new_hooks(conn, monkeypatch):
+    monkeypatch.setattr(featurejobs, 'DataLoader', _Loader)
+    _Loader.loaders = []
+    featurejobs.enqueue(conn, ['features2012'], SPECS + DISCIPLINE)
+    assert featurejobs.work(conn, phase_hooks=lambda: [_Hook()], worker='a', retry_seconds=0, poll_seconds=0) == 3
+    # the specs once, the discipline family on each of its 3 attempts
+    assert len(_Loader.loaders) == 4
+    assert len(set(id(loader.phase_hooks[0]) for loader in _Loader.loaders)) == 4
+    jobs = _jobs(conn)
+    assert set(jobs[feature][:2] for feature in SPECS) == {('done', 1)}
+    assert set(jobs[feature][:2] for feature in DISCIPLINE) == {('failed', 3)}
+    with pytest.raises(ValueError):
+        featurejobs.work(conn, {'phase_hooks': [_Hook()]})
+
+
+def _claim_all(worker):
+    engine = create_engine(DATABASE_URL)
+    claimed = []
+    while True:
+        _, jobs = featurejobs.claim(engine, worker, limit=2)
+        if not jobs:
+            break
+        job_ids = [job_id for job_id, _ in jobs]
+        time.sleep(0.05)
+        featurejobs.finish(engine, job_ids, worker)
+        claimed.extend(job_ids)
+    engine.dispose()
+    return claimed
+
+
+def test_processes_claim_every_job_once(conn):
+    tables = ['features{}'.format(year) for year in range(2009, 2017)]
+    added = featurejobs.enqueue(conn, tables, SPECS + DISCIPLINE)
+    pool = multiprocessing.Pool(4)
+    try:
+        claimed = pool.map(_claim_all, ['worker{}'.format(i) for i in range(4)])
+    finally:
+        pool.close()
+        pool.join()
+    job_ids = [job_id for jobs in claimed for job_id in jobs]
+    assert len(job_ids) == len(set(job_ids)) == added
+    assert set(status for status, _, _ in _jobs(conn).values()) == {'done'}
+    assert sum(1 for jobs in claimed if jobs) > 1
+
+
+def _try_lock(table):
+    engine = create_engine(DATABASE_URL)
+    connection = engine.connect()
+    locked = connection.execute('SELECT pg_try_advisory_lock(%s, hashtext(%s))',
+                                (featurejobs.LOCK_NAMESPACE, table)).scalar()
+    connection.close()
+    engine.dispose()
+    return locked
+
+
+def test_table_lock_excludes_other_processes(conn):
+    pool = multiprocessing.Pool(1)
+    try:
+        with featurejobs.table_lock(conn)('features2012'):
+            assert not pool.apply(_try_lock, ('features2012',))
+            assert pool.apply(_try_lock, ('features2013',))
+        assert pool.apply(_try_lock, ('features2012',))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,100 @@
+import pytest
+from featurespec import FeatureSpec, compile_specs
+
+
+def _compile(specs, rf_type='year', timeframe=2012):
+    queries = compile_specs(specs, rf_type, timeframe)
+    assert len(queries) == 1
+    return queries[0]
+
+
+def _squash(sql):
+    return ' '.join(sql.split())
+
+
+def test_where_appends_a_filter_to_the_aggregate():
+    spec = FeatureSpec('weapons', 'edu_schema.discipline', 'count(*)', 'discipline_year',
+                       where="discipline_fed_offense_group = %(group)s", params={'group': 'Weapons'})
+    sql, params, specs = _compile([spec])
+    assert "count(*) FILTER (WHERE discipline_fed_offense_group = %(s0_group)s) AS weapons" in _squash(sql)
+    assert params['s0_group'] == 'Weapons'
+    assert params['timeframe'] == 2012
+    assert specs == [spec]
+
+
+def test_filter_goes_where_the_aggregate_marks_it():
+    spec = FeatureSpec('days_per_incident', 'edu_schema.discipline',
+                       'CAST(sum(discipline_days){filter} AS float) / NULLIF(count(*){filter}, 0)',
+                       'discipline_year', where='discipline_days > 0')
+    sql, _, _ = _compile([spec])
+    assert ('CAST(sum(discipline_days) FILTER (WHERE discipline_days > 0) AS float) / '
+            'NULLIF(count(*) FILTER (WHERE discipline_days > 0), 0) AS days_per_incident') in _squash(sql)
+    assert '{filter}' not in sql
+
+
+def test_no_filter_without_where_or_n_years():
+    spec = FeatureSpec('records', 'edu_schema.demographic', 'count(*)', 'year')
+    sql, _, _ = _compile([spec])
+    assert 'FILTER' not in sql
+    assert 'count(*) AS records' in _squash(sql)
+
+
+def test_prefilter_ors_the_filters_when_every_spec_has_one():
+    specs = [FeatureSpec('a', 'edu_schema.discipline', 'count(*)', 'discipline_year', where='x = %(v)s', params={'v': 1}),
+             FeatureSpec('b', 'edu_schema.discipline', 'count(*)', 'discipline_year', where='x = %(v)s', params={'v': 2})]
+    sql, params, _ = _compile(specs)
+    assert 'WHERE discipline_year <= %(timeframe)s AND ((x = %(s0_v)s) OR (x = %(s1_v)s))' in _squash(sql)
+    assert (params['s0_v'], params['s1_v']) == (1, 2)
+
+
+def test_no_prefilter_when_a_spec_takes_every_row():
+    specs = [FeatureSpec('a', 'edu_schema.discipline', 'count(*)', 'discipline_year', where='x = 1'),
+             FeatureSpec('b', 'edu_schema.discipline', 'count(*)', 'discipline_year')]
+    sql, _, _ = _compile(specs)
+    assert 'WHERE discipline_year <= %(timeframe)s GROUP BY' in _squash(sql)
+
+
+def test_n_years_filters_on_the_last_years():
+    spec = FeatureSpec('recent', 'edu_schema.discipline', 'count(*)', 'discipline_year', where='x = 1', n_years=3)
+    sql, params, _ = _compile([spec])
+    assert ('count(*) FILTER (WHERE x = 1 AND discipline_year > %(timeframe)s - %(s0_n_years)s) AS recent'
+            in _squash(sql))
+    assert params['s0_n_years'] == 3
+
+
+def test_default_fills_the_students_without_rows():
+    specs = [FeatureSpec('a', 'edu_schema.demographic', 'count(*)', 'year'),
+             FeatureSpec('b', 'edu_schema.demographic', 'avg(x)', 'year', default=-1)]
+    sql, params, _ = _compile(specs)
+    squashed = _squash(sql)
+    assert 'COALESCE(agg.a, %(s0_default)s) AS a' in squashed
+    assert 'COALESCE(agg.b, %(s1_default)s) AS b' in squashed
+    assert (params['s0_default'], params['s1_default']) == (0, -1)
+    assert 'FROM training.mapping m LEFT JOIN agg ON agg.student_key = m.student_key' in squashed
+
+
+def test_one_query_per_source_and_key():
+    specs = [FeatureSpec('a', 'edu_schema.demographic', 'count(*)', 'year'),
+             FeatureSpec('b', 'cj_schema.juv_case_person_id', 'count(chips)', 'inc_year', key='person_id'),
+             FeatureSpec('c', 'edu_schema.demographic', 'count(distinct school_year)', 'year')]
+    queries = compile_specs(specs, 'year', 2012)
+    assert [[spec.name for spec in group] for _, _, group in queries] == [['a', 'c'], ['b']]
+    assert ('FROM (SELECT DISTINCT person_id FROM training.mapping) m LEFT JOIN agg ON agg.person_id = m.person_id'
+            in _squash(queries[1][0]))
+
+
+def test_age_tables_need_a_birthdate():
+    spec = FeatureSpec('schools', 'edu_schema.new_demographic', 'count(distinct school)',
+                       'extract(year from collection_date)', birthdate_column='student_birthdate')
+    sql, params, _ = _compile([spec], 'age', 15)
+    assert ('WHERE extract(year from collection_date) - extract(year from student_birthdate) <= %(timeframe)s'
+            in _squash(sql))
+    assert params['timeframe'] == 15
+    with pytest.raises(ValueError):
+        compile_specs([FeatureSpec('records', 'edu_schema.demographic', 'count(*)', 'year')], 'age', 15)
+
+
+def test_schools_per_student_builds_age_tables():
+    import feature_generator
+    sql, _, _ = _compile([feature_generator.schools_per_student.spec], 'age', 15)
+    assert 'student_birthdate' in sql
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+import feature_generator
+import fingerprint
+
+
+def test_stats_of_a_missing_table_name_it(monkeypatch):
+    monkeypatch.setattr(fingerprint.pd, 'read_sql_query',
+                        lambda *args, **kwargs: pd.DataFrame(columns=['oid', 'relfilenode', 'n_tup_ins',
+                                                                      'n_tup_upd', 'n_tup_del']))
+    store = fingerprint.FingerprintStore.__new__(fingerprint.FingerprintStore)
+    store.conn = None
+    store._stats = {}
+    with pytest.raises(ValueError) as error:
+        store.compute(feature_generator.max_discipline_per_year, 'features2012')
+    assert 'max_discipline_per_year' in str(error.value)
+    assert 'training.student_year_panel does not exist' in str(error.value)
+
+
+def test_source_tables_of_declared_sources_specs_and_code():
+    # the panel, not the raw table its docstrings and roll-ups name
+    assert fingerprint.source_tables(feature_generator.max_discipline_per_year) == ['training.student_year_panel']
+    assert fingerprint.source_tables(feature_generator.schools_per_student) == \
+        ['edu_schema.new_demographic', 'training.mapping']
+    assert fingerprint.source_tables(feature_generator.num_demo_records) == \
+        ['edu_schema.demographic', 'training.mapping']
@@ -0,0 +1,50 @@
+import pandas as pd
+import abstractfeature
+import feature_generator
+import indexes
+
+
+def _feature_statements(monkeypatch, names, table='features2012'):
+    """the statements the fused queries of the features send, as the StatementRecorder of a build sees them"""
+    features = [getattr(feature_generator, name)(table, None) for name in names]
+    statements = []
+
+    def read_sql_query(sql, conn, params=None):
+        statements.append(sql)
+        return pd.DataFrame(columns=['person_id'] + [feature.spec.name for feature in features])
+
+    monkeypatch.setattr(abstractfeature.pd, 'read_sql_query', read_sql_query)
+    families = {}
+    for feature in features:
+        families.setdefault(feature.fusion_family, []).append(feature)
+    for family in families.values():
+        type(family[0]).fused_feature_code(family)
+    return statements
+
+
+def _database(monkeypatch, columns, existing):
+    monkeypatch.setattr(indexes.pd, 'read_sql_query', lambda sql, conn, params=None: pd.DataFrame(
+        [(table, column) for table, column in columns if table in params['tables']],
+        columns=['table_name', 'column_name']))
+    monkeypatch.setattr(indexes, 'existing_indexes', lambda conn, tables: existing)
+
+
+def test_suggestions_for_the_statements_of_spec_and_discipline_features(monkeypatch):
+    statements = _feature_statements(monkeypatch, ['schools_per_student', 'num_chips_records',
+                                                   'max_discipline_per_year', 'num_discipline_last_2_years'])
+    # the spec family reads new_demographic and the panel, the discipline family the panel
+    assert len(statements) == 3
+    assert indexes.referenced_columns(statements[0]) == \
+        ({('training.mapping', 'student_key')}, ['edu_schema.new_demographic', 'training.mapping'])
+
+    _database(monkeypatch, [('training.mapping', 'person_id'), ('training.mapping', 'student_key'),
+                            ('training.student_year_panel', 'person_id'), ('training.student_year_panel', 'year'),
+                            ('edu_schema.new_demographic', 'student_key')], {})
+    suggestions = indexes.suggest_indexes(statements, None)
+    assert suggestions.values.tolist() == [['training.student_year_panel', 'year', 2, False],
+                                           ['training.mapping', 'student_key', 1, True]]
+
+    # the panel is built with an index on year
+    _database(monkeypatch, [('training.student_year_panel', 'year')],
+              {'training.student_year_panel': [('person_id', 'year'), ('year',)]})
+    assert indexes.suggest_indexes(statements, None).empty
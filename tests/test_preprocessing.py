@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+import preprocessing as pp
+
+
+def _frame():
+    return pd.DataFrame({'person_id': [1, 2, 3, 4],
+                         'count': np.array([0, 4, 2, 8], dtype=np.int64),
+                         'score': np.array([1.5, np.nan, -0.5, 3.5], dtype=np.float32)})
+
+
+def test_fit_skips_nans():
+    scaler = pp.MinMaxScaler().fit(_frame(), ['count', 'score'])
+    assert scaler.columns == ['count', 'score']
+    np.testing.assert_allclose(scaler.minimums, [0, -0.5])
+    np.testing.assert_allclose(scaler.ranges, [8 + 1e-4, 4 + 1e-4], rtol=1e-6)
+
+
+def test_transform_matches_the_pandas_formula_and_leaves_other_columns():
+    data = _frame()
+    expected = (data[['count', 'score']] - data[['count', 'score']].min()) / \
+        (data[['count', 'score']].max() - data[['count', 'score']].min() + 1e-4)
+    scaled = pp.MinMaxScaler().fit(data, ['count', 'score']).transform(data)
+    assert scaled is data
+    assert scaled['count'].dtype == scaled['score'].dtype == np.float32
+    np.testing.assert_allclose(scaled[['count', 'score']].values, expected.values, rtol=1e-5)
+    assert scaled['person_id'].tolist() == [1, 2, 3, 4]
+
+
+def test_transform_of_a_float32_column_does_not_touch_frames_sharing_it():
+    data = _frame()
+    view = data['score']
+    pp.MinMaxScaler().fit(data, ['score']).transform(data)
+    assert view.iloc[0] == np.float32(1.5)
+
+
+def test_from_bounds_scales_like_fit():
+    fitted = pp.MinMaxScaler().fit(_frame(), ['count', 'score'])
+    bounded = pp.MinMaxScaler.from_bounds(['count', 'score'], [0, -0.5], [8, 3.5])
+    np.testing.assert_allclose(bounded.minimums, fitted.minimums)
+    np.testing.assert_allclose(bounded.ranges, fitted.ranges)
+
+
+class _Conn(object):
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+
+def test_saved_scaling_loads_back(monkeypatch):
+    saved = {}
+
+    def write_frame(df, name, conn, schema=None, if_exists='fail'):
+        saved[(schema, name)] = df
+
+    def read_sql_query(sql, conn, params=None):
+        scaling = saved[('training', 'feature_scaling')]
+        return scaling[scaling['dataset'] == params['dataset']][['feature', 'minimum', 'range']]
+
+    monkeypatch.setattr(pp.bulkwriter, 'write_frame', write_frame)
+    monkeypatch.setattr(pp.pd, 'read_sql_query', read_sql_query)
+    conn = _Conn()
+    scaler = pp.MinMaxScaler().fit(_frame(), ['count', 'score'])
+    scaler.save(conn, 'features2012_features2013')
+    assert conn.statements[0][1] == ('features2012_features2013',)
+
+    loaded = pp.MinMaxScaler.load(conn, 'features2012_features2013')
+    assert loaded.columns == ['count', 'score']
+    np.testing.assert_array_equal(loaded.minimums, scaler.minimums)
+    np.testing.assert_array_equal(loaded.ranges, scaler.ranges)
+    pd.testing.assert_frame_equal(loaded.transform(_frame()), scaler.transform(_frame()))
+    with pytest.raises(ValueError, match='features2013_features2014'):
+        pp.MinMaxScaler.load(conn, 'features2013_features2014')
+
+
+def test_sparse_design_matrix_encodes_train_and_test_like_get_dummies():
+    train = pd.DataFrame({'days': [1.0, 0.0, 2.5], 'school': ['A', 'B', None], 'grade': [9, 10, 9]})
+    # school C and grade 11 only occur in test
+    test = pd.DataFrame({'days': [3.0, 0.0], 'school': ['C', 'A'], 'grade': [11, 9]})
+    vocabulary = pp.categorical_vocabulary([test, train], ['school', 'grade'])
+    assert vocabulary == {'school': ['A', 'B', 'C'], 'grade': [9, 10, 11]}
+
+    dummies = pd.get_dummies(pd.concat([train, test], keys=['train', 'test']), columns=['school', 'grade'])
+    assert list(dummies.columns) == ['days'] + pp.dummy_names(vocabulary)
+    for name, frame in (('train', train), ('test', test)):
+        matrix = pp.sparse_design_matrix(frame, ['days'], vocabulary)
+        assert matrix.shape == (len(frame), 7)
+        np.testing.assert_array_equal(matrix.toarray(), dummies.loc[name].to_numpy(dtype=np.float32))